@@ -1,5 +1,6 @@
 # app/__init__.py (Orden Corregido)
 import os # Necesario para la condición del scheduler
+import atexit # Para liberar el lease del scheduler al apagar el proceso
 from flask import Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
@@ -31,31 +32,84 @@ print("Iniciando: Modelos importados.")
 print("Iniciando: Creando instancias Migrate, SocketIO, APScheduler...")
 migrate = Migrate(app, db)
 # !! REVISA cors_allowed_origins para producción más tarde !!
-socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")
+# Con SOCKETIO_MESSAGE_QUEUE los emits se reparten entre todos los workers/máquinas (ver app/broker.py)
+from app.broker import create_client_manager
+socketio_manager = create_client_manager(app.config['SOCKETIO_MESSAGE_QUEUE'], app.config['SOCKETIO_CHANNEL'],
+                                         write_only=app.config['SOCKETIO_WRITE_ONLY'])
+socketio_options = {'client_manager': socketio_manager} if socketio_manager is not None else {}
+if app.config['SOCKETIO_WEBSOCKET_ONLY']:
+    socketio_options['transports'] = ['websocket']
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*", **socketio_options)
+if socketio_manager is not None:
+    print(f"Iniciando: Socket.IO con broker '{socketio_manager.name}' (canal '{app.config['SOCKETIO_CHANNEL']}').")
+    if hasattr(socketio_manager, 'cleanup'):
+        atexit.register(socketio_manager.cleanup)
+    if app.config['INVALIDATION_BACKEND'] == 'local':
+        print("ATENCIÓN: Hay broker de Socket.IO pero INVALIDATION_BACKEND='local': "
+              "las cachés de cada worker no se enterarán de los cambios hechos en otros.")
+# Varios workers sin broker, sin afinidad o con cachés sin sincronizar: los emits a salas solo llegan
+# a 1/N de los clientes, el long-polling falla y cada worker sirve datos distintos. Mejor no arrancar.
+if app.config['WEB_WORKERS'] > 1:
+    missing = []
+    if socketio_manager is None:
+        missing.append("SOCKETIO_MESSAGE_QUEUE (broker)")
+    if not (app.config['SOCKETIO_WEBSOCKET_ONLY'] or app.config['SOCKETIO_STICKY_SESSIONS']):
+        missing.append("SOCKETIO_WEBSOCKET_ONLY=true o SOCKETIO_STICKY_SESSIONS=true (balanceador con afinidad)")
+    if app.config['INVALIDATION_BACKEND'] == 'local':
+        missing.append("INVALIDATION_BACKEND compartido ('postgres' o 'unix')")
+    if missing:
+        raise RuntimeError(f"WEB_WORKERS={app.config['WEB_WORKERS']} requiere: {'; '.join(missing)}. "
+                           "Configúralo o usa WEB_WORKERS=1.")
 scheduler = APScheduler()
 print("Iniciando: Extensiones Migrate, SocketIO, APScheduler creadas.")
 
 # --- Importar el resto de componentes de la app ---
 print("Iniciando: Importando tasks, routes, events...")
-from app.tasks import delete_old_messages
 from app import routes, events
+from app.expiry import message_expiry
 print("Iniciando: Tasks, routes, events importados.")
 
+# --- Límites de la cola de salida de cada cliente (clientes lentos, ver app/backpressure.py) ---
+from app.backpressure import outbound_limiter
+outbound_limiter.install()
+
+# --- Estáticos versionados y precomprimidos servidos por WhiteNoise (ver app/assets.py) ---
+from app.assets import install_static_middleware
+install_static_middleware()
+
+# --- Bus de invalidación de cachés entre procesos (ver app/invalidation.py) ---
+from app.invalidation import invalidation_bus
+invalidation_bus.start()
+
 # --- Configurar y iniciar Scheduler ---
-print("Iniciando: Configurando scheduler...")
-# Registrar la tarea ANTES de iniciar el scheduler
-# Condición para evitar doble registro en modo debug
-if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
-    if not scheduler.get_job('delete_old_messages_job'):
-        # Ejecutar cada hora (ajusta 'hours' para probar)
-        scheduler.add_job(id='delete_old_messages_job', func=delete_old_messages, trigger='interval', hours=1)
-        print("Tarea 'delete_old_messages_job' añadida al scheduler.")
-    else:
-        print("Tarea 'delete_old_messages_job' ya existe en el scheduler.")
-
-# Inicializar y arrancar el scheduler
-scheduler.init_app(app)
-scheduler.start()
-print("Iniciando: Scheduler iniciado.")
+# Con SCHEDULER_ENABLED=false este proceso no arranca el scheduler (ej: web workers cuando
+# las tareas se ejecutan en el proceso dedicado 'clock', ver clock.py y Procfile).
+# Aunque varios procesos lo arranquen, solo el líder (lease en BBDD, ver app/leader.py) ejecuta las tareas.
+if app.config['SCHEDULER_ENABLED']:
+    print("Iniciando: Configurando scheduler...")
+    from app.leader import scheduler_leader
+    # Registrar la tarea ANTES de iniciar el scheduler
+    # Condición para evitar doble registro en modo debug
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if not scheduler.get_job('expire_messages_job'):
+            # Expiración por canal: revisa el heap de vencimientos cada pocos segundos (ver app/expiry.py)
+            scheduler.add_job(id='expire_messages_job', func=scheduler_leader.only_leader(message_expiry.tick),
+                              trigger='interval', seconds=app.config['MESSAGE_EXPIRY_TICK_SECONDS'],
+                              max_instances=1, coalesce=True)
+            print("Tarea 'expire_messages_job' añadida al scheduler.")
+        else:
+            print("Tarea 'expire_messages_job' ya existe en el scheduler.")
+        if not scheduler.get_job('scheduler_lease_renew_job'):
+            # Renovar el lease varias veces por TTL para no perderlo mientras el proceso esté vivo
+            scheduler.add_job(id='scheduler_lease_renew_job', func=scheduler_leader.renew, trigger='interval',
+                              seconds=max(1, app.config['SCHEDULER_LEASE_TTL_SECONDS'] // 3))
+        atexit.register(scheduler_leader.release)
+
+    # Inicializar y arrancar el scheduler
+    scheduler.init_app(app)
+    scheduler.start()
+    print("Iniciando: Scheduler iniciado.")
+else:
+    print("Iniciando: Scheduler DESACTIVADO en este proceso (SCHEDULER_ENABLED=false).")
 
 print("Instancia de la aplicación Flask creada y configurada (modo no-factory).")
\ No newline at end of file
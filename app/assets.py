@@ -0,0 +1,154 @@
+# app/assets.py
+"""
+Estáticos versionados, precomprimidos y con caché inmutable.
+
+chat.js y style.css se servían con su nombre de siempre, sin comprimir y sin cabeceras de caché:
+cada visita los volvía a pedir (o a revalidar). Ahora:
+
+- 'flask build-assets' (se ejecuta antes de arrancar gunicorn, ver Procfile) copia cada archivo de
+  ASSET_DIRS a 'nombre.<hash del contenido>.ext', genera sus variantes .gz (y .br si está instalado
+  el paquete brotli), borra las versiones anteriores y escribe ASSETS_MANIFEST.
+- Las plantillas enlazan con asset_url('js/chat.js'), que devuelve la URL versionada del
+  manifiesto (o la original si no hay build, o con ASSETS_AUTOREFRESH/debug para ver los cambios
+  al momento; run.py lo activa y WhiteNoise vuelve entonces a mirar el disco en cada petición).
+- WhiteNoise sirve los directorios fijos de app/static antes de llegar a Flask: elige la variante
+  comprimida según Accept-Encoding y marca los archivos versionados como inmutables (caché de un año
+  o más), así que en visitas repetidas no se descarga nada. El resto usa STATIC_MAX_AGE_SECONDS.
+- static/uploads cambia en caliente (imágenes y stickers subidos) y lo sigue sirviendo Flask, pero
+  sus nombres son UUIDs que nunca se reutilizan para otro contenido: también se cachean como inmutables.
+"""
+import hashlib
+import json
+import os
+import re
+
+import click
+from flask import request, url_for
+from whitenoise import WhiteNoise
+from whitenoise.compress import Compressor
+
+from app import app
+
+# 'chat.<12 hex>.js': nombre generado por el build
+HASHED_NAME_RE = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _hashed_name(filename, data):
+    root, ext = os.path.splitext(filename)
+    return f'{root}.{hashlib.md5(data).hexdigest()[:12]}{ext}'
+
+
+def _is_generated(filename):
+    return filename.endswith(COMPRESSED_SUFFIXES) or bool(HASHED_NAME_RE.search(filename))
+
+
+# --- Build ('flask build-assets') ---
+
+def build_assets(static_folder, asset_dirs, manifest_path):
+    """Versiona y comprime los archivos de asset_dirs. Devuelve el manifiesto {original: versionado}."""
+    compressor = Compressor(quiet=True)
+    manifest = {}
+    for asset_dir in asset_dirs:
+        directory = os.path.join(static_folder, asset_dir)
+        if not os.path.isdir(directory):
+            continue
+        for dirpath, _, filenames in os.walk(directory):
+            originals = [f for f in filenames if not _is_generated(f)]
+            keep = set()
+            for filename in originals:
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    data = f.read()
+                hashed = _hashed_name(filename, data)
+                hashed_path = os.path.join(dirpath, hashed)
+                if not os.path.exists(hashed_path):
+                    with open(hashed_path, 'wb') as f:
+                        f.write(data)
+                keep.add(hashed)
+                if compressor.should_compress(hashed):
+                    keep.update(os.path.basename(p) for p in compressor.compress(hashed_path))
+                relative = os.path.relpath(path, static_folder).replace(os.sep, '/')
+                manifest[relative] = os.path.relpath(hashed_path, static_folder).replace(os.sep, '/')
+            # Versiones de builds anteriores (y sus variantes comprimidas)
+            for filename in filenames:
+                if _is_generated(filename) and filename not in keep:
+                    os.remove(os.path.join(dirpath, filename))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Versiona y precomprime css/js (ejecutar antes de arrancar el servidor)."""
+    manifest = build_assets(app.static_folder, app.config['ASSET_DIRS'], app.config['ASSETS_MANIFEST'])
+    click.echo(f"{len(manifest)} archivos versionados. Manifiesto: {app.config['ASSETS_MANIFEST']}")
+
+
+# --- URLs en las plantillas ---
+
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"[Assets] Manifiesto ilegible ({path}): {e}. Se usan los nombres sin versionar.")
+        return {}
+
+
+def _autorefresh():
+    # app.debug se consulta en cada llamada: run.py lo activa después de importar la app
+    return app.config['ASSETS_AUTOREFRESH'] or app.debug
+
+
+_manifest_cache = {}
+
+
+def asset_manifest():
+    """Manifiesto del build (se lee una vez por proceso, en el primer uso); vacío en desarrollo."""
+    if _autorefresh():
+        return {}
+    if 'manifest' not in _manifest_cache:
+        _manifest_cache['manifest'] = _load_manifest(app.config['ASSETS_MANIFEST'])
+    return _manifest_cache['manifest']
+
+
+@app.template_global()
+def asset_url(filename):
+    """URL de un estático de ASSET_DIRS: la versionada si hay build, si no la original."""
+    return url_for('static', filename=asset_manifest().get(filename, filename))
+
+
+# --- Servir ---
+
+def _immutable_file_test(path, url):
+    return bool(HASHED_NAME_RE.search(url))
+
+
+def install_static_middleware():
+    """Pone WhiteNoise delante de la app para los directorios fijos de app/static (no uploads/)."""
+    static_url = app.static_url_path.strip('/')
+    whitenoise = WhiteNoise(app.wsgi_app, max_age=app.config['STATIC_MAX_AGE_SECONDS'],
+                            immutable_file_test=_immutable_file_test, autorefresh=_autorefresh())
+    for entry in sorted(os.listdir(app.static_folder)):
+        if entry != 'uploads' and os.path.isdir(os.path.join(app.static_folder, entry)):
+            whitenoise.add_files(os.path.join(app.static_folder, entry), prefix=f'{static_url}/{entry}/')
+    app.wsgi_app = whitenoise
+    if whitenoise.autorefresh:
+        print(f"Iniciando: WhiteNoise sirve /{static_url} (autorefresh, sin versionar).")
+    else:
+        print(f"Iniciando: WhiteNoise sirve /{static_url} ({len(whitenoise.files)} archivos, "
+              f"{len(asset_manifest())} versionados).")
+
+
+@app.after_request
+def cache_uploads(response):
+    """Los archivos subidos tienen nombre único (UUID): se pueden cachear para siempre."""
+    if request.endpoint == 'static' and response.status_code == 200 \
+            and (request.view_args or {}).get('filename', '').startswith('uploads/'):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
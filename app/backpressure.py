@@ -0,0 +1,155 @@
+# app/backpressure.py
+"""
+Contrapresión en los envíos a cada cliente (clientes lentos).
+
+Engine.IO guarda los paquetes pendientes de cada conexión en una cola sin límite que vacía la
+tarea de escritura del WebSocket (o cada GET de long-polling). Un cliente con mala conexión en una
+sala con mucho tráfico hacía crecer esa cola (y la memoria del proceso) sin fin.
+
+OutboundLimiter envuelve Socket.send/poll de engineio y lleva, por conexión, los mensajes y bytes
+encolados y aún no escritos:
+- A partir de OUTBOUND_DROPPABLE_RATIO de cualquiera de los dos límites se descartan los
+  eventos prescindibles (OUTBOUND_DROPPABLE_EVENTS: 'typing_state', 'presence_diff'), que el
+  cliente recupera con el siguiente snapshot o al volver a unirse a la sala.
+- Si se supera OUTBOUND_QUEUE_MAX_MESSAGES u OUTBOUND_QUEUE_MAX_BYTES, se vacía la cola, se envía
+  'resync' ({'reason': 'slow_consumer'}) y se cierra la conexión con motivo 'resync'. El cliente
+  se reconecta solo y recupera lo perdido con la sincronización por secuencia (join_channel con last_seq).
+
+Los bytes son aproximados (longitud del paquete ya codificado). Los paquetes de control de
+Engine.IO (ping, noop, close) nunca se limitan.
+"""
+from engineio import packet as eio_packet
+from socketio import packet as sio_packet
+
+from app import app, socketio
+
+RESYNC_REASON = 'resync'
+
+
+def _packet_size(pkt):
+    return len(pkt.data) if isinstance(pkt.data, (str, bytes)) else 0
+
+
+def _event_name(pkt):
+    """Nombre del evento Socket.IO de un paquete ya codificado ('2["typing_state",{...}]'), o None."""
+    data = pkt.data
+    if not isinstance(data, str) or not data.startswith('2'):
+        return None
+    start = data.find('["', 0, 64)
+    if start == -1:
+        return None
+    end = data.find('"', start + 2)
+    return data[start + 2:end] if end != -1 else None
+
+
+class OutboundLimiter:
+
+    def __init__(self, max_messages, max_bytes, droppable_ratio, droppable_events):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.soft_messages = int(max_messages * droppable_ratio)
+        self.soft_bytes = int(max_bytes * droppable_ratio)
+        self.droppable_events = frozenset(droppable_events)
+        self.installed = False
+        self.dropped = {} # evento -> paquetes descartados por ir la conexión retrasada
+        self.resyncs = 0
+        self.dropped_after_resync = 0
+
+    def _on_send(self, sock, pkt, original_send):
+        if pkt.packet_type != eio_packet.MESSAGE:
+            return original_send(sock, pkt)
+        if getattr(sock, '_resync_pending', False):
+            self.dropped_after_resync += 1 # La conexión se va a cerrar: no acumular más
+            return
+        size = _packet_size(pkt)
+        messages = getattr(sock, '_out_messages', 0)
+        nbytes = getattr(sock, '_out_bytes', 0)
+        if messages >= self.soft_messages or nbytes >= self.soft_bytes:
+            event = _event_name(pkt)
+            if event in self.droppable_events:
+                self.dropped[event] = self.dropped.get(event, 0) + 1
+                return
+        if messages + 1 > self.max_messages or nbytes + size > self.max_bytes:
+            self._resync(sock)
+            return
+        sock._out_messages = messages + 1
+        sock._out_bytes = nbytes + size
+        original_send(sock, pkt)
+
+    def _on_poll(self, sock, packets):
+        for pkt in packets:
+            if pkt.packet_type == eio_packet.MESSAGE:
+                sock._out_messages = max(0, getattr(sock, '_out_messages', 0) - 1)
+                sock._out_bytes = max(0, getattr(sock, '_out_bytes', 0) - _packet_size(pkt))
+        return packets
+
+    def _resync(self, sock):
+        """Vacía la cola de un cliente demasiado retrasado, le avisa con 'resync' y cierra la conexión."""
+        self.resyncs += 1
+        sock._resync_pending = True
+        queue_empty = sock.server.get_queue_empty_exception()
+        while True:
+            try:
+                sock.queue.get(block=False)
+                sock.queue.task_done()
+            except queue_empty:
+                break
+        notice = sio_packet.Packet(sio_packet.EVENT, data=['resync', {'reason': 'slow_consumer'}]).encode()
+        sock.queue.put(eio_packet.Packet(eio_packet.MESSAGE, data=notice))
+        sock._out_messages, sock._out_bytes = 1, len(notice)
+        print(f"[Backpressure] Cliente demasiado lento (EIO SID: {sock.sid}): se desconecta para resincronizar.")
+        # Cerrar fuera de este emit: el disconnect ejecuta handlers (presencia...) que no deben correr a mitad de una difusión
+        sock.server.start_background_task(sock.close, wait=False, abort=False, reason=RESYNC_REASON)
+
+    def install(self):
+        """Sustituye Socket.send/poll de engineio por versiones que aplican los límites."""
+        if self.installed:
+            return
+        from engineio.socket import Socket
+        original_send = Socket.send
+        original_poll = Socket.poll
+        limiter = self
+
+        def send(sock, pkt):
+            return limiter._on_send(sock, pkt, original_send)
+
+        def poll(sock):
+            return limiter._on_poll(sock, original_poll(sock))
+
+        Socket.send = send
+        Socket.poll = poll
+        self.installed = True
+
+    def queue_depths(self, limit=20):
+        """Conexiones con más datos pendientes: [{'sid', 'eio_sid', 'messages', 'bytes'}]."""
+        server = socketio.server
+        depths = []
+        for eio_sid, sock in list(server.eio.sockets.items()):
+            messages = getattr(sock, '_out_messages', 0)
+            if messages:
+                depths.append({
+                    'sid': server.manager.sid_from_eio_sid(eio_sid, '/'),
+                    'eio_sid': eio_sid,
+                    'messages': messages,
+                    'bytes': getattr(sock, '_out_bytes', 0),
+                })
+        depths.sort(key=lambda depth: depth['bytes'], reverse=True)
+        return depths[:limit]
+
+    def stats(self):
+        return {
+            'installed': self.installed,
+            'dropped': dict(self.dropped),
+            'resyncs': self.resyncs,
+            'dropped_after_resync': self.dropped_after_resync,
+            'deepest_queues': self.queue_depths(),
+        }
+
+
+# Instancia global (una por proceso)
+outbound_limiter = OutboundLimiter(
+    max_messages=app.config['OUTBOUND_QUEUE_MAX_MESSAGES'],
+    max_bytes=app.config['OUTBOUND_QUEUE_MAX_BYTES'],
+    droppable_ratio=app.config['OUTBOUND_DROPPABLE_RATIO'],
+    droppable_events=app.config['OUTBOUND_DROPPABLE_EVENTS']
+)
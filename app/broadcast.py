@@ -0,0 +1,25 @@
+# app/broadcast.py
+"""
+Difusión de mensajes a las salas de los canales.
+
+Todos los 'new_message' (mensajes de texto/sticker, imágenes de upload_media y avisos de sistema)
+salen por broadcast_message(). python-socketio ya construye y serializa a JSON el paquete de un
+emit a una sala una sola vez y entrega el MISMO paquete de Engine.IO a cada participante.
+"""
+from app import socketio
+
+
+def broadcast_message(message_data, channel_id):
+    """Emite 'new_message' a la sala del canal (un único paquete para todos los miembros)."""
+    socketio.emit('new_message', message_data, to=str(channel_id))
+
+
+def broadcast_system_message(channel_id, body, timestamp):
+    """Aviso de sistema (ej: "X se ha unido.") para la sala del canal."""
+    broadcast_message({
+        'channel_id': channel_id, # Incluir channel_id para que el JS lo filtre
+        'body': body,
+        'message_type': 'system',
+        'timestamp': timestamp.isoformat(),
+        'username': 'Sistema'
+    }, channel_id)
@@ -0,0 +1,165 @@
+# app/broker.py
+"""
+Cola de mensajes ("broker") de Socket.IO para repartir la app entre varios workers y máquinas.
+
+Sin broker, emit(..., to=sala) solo llega a los sockets conectados al MISMO proceso, por eso el
+Procfile usaba un único worker. Con SOCKETIO_MESSAGE_QUEUE cada emit (y join/leave de salas de
+otros procesos, disconnect...) se publica en el broker y todos los procesos lo entregan a sus clientes.
+
+Valores de SOCKETIO_MESSAGE_QUEUE:
+- vacío: un solo proceso (sin broker).
+- 'unix:///ruta/directorio': UnixSocketManager (abajo). Varios procesos en la MISMA máquina
+  sin servicios externos; pensado para desarrollo y tests.
+- 'redis://...', 'rediss://...': RedisManager (producción; requiere el paquete 'redis').
+- 'kafka://...', 'zmq+tcp://...', 'amqp://...': managers de python-socketio (Kafka, ZeroMQ, Kombu).
+
+Sesiones "pegajosas" (sticky sessions): el transporte long-polling de Engine.IO hace varias
+peticiones HTTP por conexión y TODAS deben llegar al mismo worker. Opciones:
+- Varios gunicorn de 1 worker (cada uno en su puerto) detrás de un balanceador con afinidad
+  (ej: nginx 'ip_hash' o cookie), o
+- SOCKETIO_WEBSOCKET_ONLY=true: el cliente usa solo WebSocket (una única conexión) y se puede
+  usar 'gunicorn -w N' directamente.
+
+Los procesos que no atienden clientes (clock, worker) se crean con SOCKETIO_WRITE_ONLY=true:
+publican sus emits (ej: 'messages_expired') pero no escuchan el broker.
+Las cachés en memoria de cada proceso se sincronizan aparte (INVALIDATION_BACKEND, app/invalidation.py).
+Los workers del Procfile salen de WEB_WORKERS (1 por defecto); con más de uno la app se niega a
+arrancar si falta el broker, WebSocket-only/afinidad o un INVALIDATION_BACKEND compartido.
+"""
+import os
+import pickle
+import socket
+import struct
+import threading
+import uuid
+from urllib.parse import urlparse
+
+import socketio
+
+_HEADER = struct.Struct('!I') # Longitud de cada trama (bytes) antes del mensaje serializado
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    """
+    Broker local sobre sockets UNIX de tipo stream: cada proceso escucha en
+    <directorio>/<pid>-<aleatorio>.sock y publica enviando cada mensaje (pickle con su longitud
+    delante) a todos los demás sockets del directorio por conexiones persistentes.
+    """
+    name = 'unix'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None, send_timeout=2.0):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.directory = os.path.join(urlparse(url).path or '/tmp/appmensajeria-socketio', channel)
+        self.path = None
+        self.send_timeout = send_timeout
+        self._peers = {} # ruta del socket -> conexión abierta para publicar
+        self._publish_lock = threading.Lock()
+
+    def _socket_module(self):
+        # Con eventlet, sockets "verdes" para no bloquear el hub
+        if self.server is not None and self.server.async_mode == 'eventlet':
+            from eventlet.green import socket as green_socket
+            return green_socket
+        return socket
+
+    # --- Publicar ---
+
+    def _publish(self, data):
+        frame = pickle.dumps(data)
+        frame = _HEADER.pack(len(frame)) + frame
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return # Aún no hay ningún proceso escuchando
+        with self._publish_lock:
+            for name in names:
+                target = os.path.join(self.directory, name)
+                if not name.endswith('.sock') or target == self.path:
+                    continue
+                conn = self._peers.get(target)
+                try:
+                    if conn is None:
+                        sock_module = self._socket_module()
+                        conn = sock_module.socket(sock_module.AF_UNIX, sock_module.SOCK_STREAM)
+                        conn.settimeout(self.send_timeout)
+                        conn.connect(target)
+                        self._peers[target] = conn
+                    conn.sendall(frame)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Proceso que ya no existe: borrar su socket
+                    self._drop_peer(target, conn)
+                    try:
+                        os.remove(target)
+                    except OSError:
+                        pass
+                except OSError as e:
+                    # Proceso colgado o conexión rota: se reintentará con una conexión nueva
+                    self._get_logger().warning(f'No se pudo publicar en {target}: {e}')
+                    self._drop_peer(target, conn)
+
+    def _drop_peer(self, target, conn):
+        self._peers.pop(target, None)
+        if conn is not None:
+            conn.close()
+
+    # --- Escuchar ---
+
+    def _listen(self):
+        sock_module = self._socket_module()
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        listener = sock_module.socket(sock_module.AF_UNIX, sock_module.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(64)
+        queue = self.server.eio.create_queue()
+        self.server.start_background_task(self._accept, listener, queue)
+        while True:
+            yield queue.get()
+
+    def _accept(self, listener, queue):
+        while True:
+            conn, _ = listener.accept()
+            self.server.start_background_task(self._read, conn, queue)
+
+    def _read(self, conn, queue):
+        """Lee las tramas de un proceso publicador y las pasa a _listen (mensajes ya deserializados)."""
+        buffer = b''
+        try:
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    return # El publicador cerró la conexión
+                buffer += chunk
+                while len(buffer) >= _HEADER.size:
+                    (length,) = _HEADER.unpack_from(buffer)
+                    if len(buffer) < _HEADER.size + length:
+                        break
+                    queue.put(pickle.loads(buffer[_HEADER.size:_HEADER.size + length]))
+                    buffer = buffer[_HEADER.size + length:]
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def cleanup(self):
+        """Borra el socket de este proceso (al apagarlo)."""
+        try:
+            if self.path:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+
+def create_client_manager(url, channel, write_only=False):
+    """Client manager de Socket.IO para la URL de SOCKETIO_MESSAGE_QUEUE (None si no hay broker)."""
+    if not url:
+        return None
+    if url.startswith('unix://'):
+        return UnixSocketManager(url, channel=channel, write_only=write_only)
+    if url.startswith(('redis://', 'rediss://')):
+        return socketio.RedisManager(url, channel=channel, write_only=write_only)
+    if url.startswith('kafka://'):
+        return socketio.KafkaManager(url, channel=channel, write_only=write_only)
+    if url.startswith('zmq'):
+        return socketio.ZmqManager(url, channel=channel, write_only=write_only)
+    return socketio.KombuManager(url, channel=channel, write_only=write_only)
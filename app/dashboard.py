@@ -0,0 +1,107 @@
+# app/dashboard.py
+"""
+Datos del panel de administración sin cargar tablas completas.
+
+- Usuarios y canales se muestran paginados (ADMIN_PAGE_SIZE) y con búsqueda por nombre:
+  page_of() pide una fila de más para saber si hay página siguiente (sin COUNT(*)).
+- El estado de moderación (mutes/bans activos) se consulta solo para los usuarios de la página
+  visible, en UNA consulta (UNION ALL de mutes y bans, con el nombre del canal).
+- Los contadores (usuarios, canales, stickers y solicitudes pendientes) salen de una única
+  consulta cacheada DASHBOARD_COUNTS_TTL_SECONDS. Quien los cambia (rutas del admin, solicitudes de
+  unión, stickers subidos para aprobar) llama a note_dashboard_counts_changed(): se descarta aquí y
+  en el resto de procesos ('dashboard_counts').
+"""
+import threading
+import time
+
+from sqlalchemy import func, literal, select, union_all
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Ban, Channel, ChannelJoinRequest, Mute, Sticker, User
+
+
+def page_of(query, page, per_page):
+    """Elementos de la página 'page' (desde 1) y si hay más después."""
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    return rows[:per_page], len(rows) > per_page
+
+
+def parse_page(value):
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def moderation_status(user_ids, now):
+    """{user_id: [{'kind': 'mute'|'ban', 'channel_id', 'channel_name', 'expires_at', 'reason'}]} de los usuarios dados."""
+    if not user_ids:
+        return {}
+    selects = []
+    for kind, model in (('mute', Mute), ('ban', Ban)):
+        selects.append(
+            select(literal(kind).label('kind'), model.user_id, model.channel_id, Channel.name.label('channel_name'),
+                   model.expires_at, model.reason)
+            .outerjoin(Channel, Channel.id == model.channel_id)
+            .where(model.user_id.in_(user_ids), (model.expires_at == None) | (model.expires_at > now))
+        )
+    status = {}
+    for row in db.session.execute(union_all(*selects)):
+        status.setdefault(row.user_id, []).append({
+            'kind': row.kind,
+            'channel_id': row.channel_id,
+            'channel_name': row.channel_name,
+            'expires_at': row.expires_at,
+            'reason': row.reason,
+        })
+    return status
+
+
+class DashboardCounts:
+
+    def __init__(self, ttl_seconds):
+        self.ttl = ttl_seconds
+        self._counts = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def get(self):
+        with self._lock:
+            if self._counts is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._counts
+        row = db.session.execute(select(
+            select(func.count(User.id)).scalar_subquery().label('users'),
+            select(func.count(Channel.id)).scalar_subquery().label('channels'),
+            select(func.count(Sticker.id)).where(Sticker.is_approved == False).scalar_subquery().label('pending_stickers'),
+            select(func.count(ChannelJoinRequest.id)).where(ChannelJoinRequest.status == 'pending')
+                .scalar_subquery().label('pending_requests'),
+        )).one()
+        counts = dict(row._mapping)
+        with self._lock:
+            self._counts = counts
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+        return counts
+
+    def invalidate(self, _key=None):
+        with self._lock:
+            self._counts = None
+
+    def stats(self):
+        with self._lock:
+            return {'cached': self._counts, 'loads': self.loads}
+
+
+# Instancia global (una por proceso)
+dashboard_counts = DashboardCounts(ttl_seconds=app.config['DASHBOARD_COUNTS_TTL_SECONDS'])
+
+
+def note_dashboard_counts_changed():
+    """Cambió algún contador del panel: descartarlo aquí y en el resto de procesos."""
+    dashboard_counts.invalidate()
+    invalidation_bus.publish('dashboard_counts')
+
+
+invalidation_bus.subscribe('dashboard_counts', dashboard_counts.invalidate)
@@ -3,11 +3,21 @@
 from flask import request, session
 from flask_socketio import emit, join_room, leave_room, disconnect
 from flask_login import current_user
-from datetime import datetime, timezone # Asegurar que timezone esté importado
+import time
 
 # Importar instancias y modelos
-from app import socketio, db
+from app import app, socketio, db
 from app.models import User, Channel, Message, Mute, Ban, ChannelJoinRequest, channel_members # Importar Mute y Ban
+from app.history import get_history_page, get_messages_since, note_new_message, parse_history_limit, recent_messages, serialize_message
+from app.message_writer import message_writer
+from app.broadcast import broadcast_message
+from app.typing_state import typing_aggregator
+from app.moderation import moderation_cache
+from app.presence import presence
+from app.membership_notices import membership_notices
+from app.rate_limit import rate_limited, rate_limiter
+from app.sidebar import note_channel_read, note_sidebar_changed
+from app.dashboard import note_dashboard_counts_changed
 
 # --- Gestión de Conexiones ---
 
@@ -15,9 +25,7 @@ from app.models import User, Channel, Message, Mute, Ban, ChannelJoinRequest, ch
 def handle_connect():
     if current_user.is_authenticated:
         # Comprobar si está baneado globalmente al conectar (aunque before_request debería pillarlo antes)
-        ban = Ban.query.filter_by(user_id=current_user.id, channel_id=None)\
-                       .filter((Ban.expires_at == None) | (Ban.expires_at > datetime.now(timezone.utc)))\
-                       .first()
+        ban = moderation_cache.active_ban(current_user.id)
         if ban:
             print(f'Cliente baneado intentó conectar: {current_user.username} (SID: {request.sid}). Desconectando.')
             # Podríamos emitir un error específico antes de desconectar
@@ -30,18 +38,22 @@ def handle_connect():
         personal_room = str(current_user.id)
         join_room(personal_room)
         print(f"Usuario {current_user.username} unido a su sala personal: {personal_room}")
+        presence.connect(request.sid, current_user.id, current_user.username)
     else:
         print(f'Cliente NO AUTENTICADO conectado: {request.sid}.')
         # No autenticados no podrán hacer mucho de todas formas
 
 @socketio.on('disconnect')
-def handle_disconnect():
-    print(f'Cliente desconectado: {request.sid}')
+def handle_disconnect(reason=None):
+    print(f'Cliente desconectado: {request.sid} (motivo: {reason})') # 'resync' = cliente demasiado lento (ver app/backpressure.py)
+    # Las salas de canal que tuviera abiertas se anuncian como salidas en el siguiente presence_diff
+    presence.disconnect(request.sid)
 
 
 # --- Gestión de Canales (Salas de SocketIO) ---
 
 @socketio.on('join_channel')
+@rate_limited('join_channel')
 def handle_join_channel(data):
     if not current_user.is_authenticated:
         emit('error', {'message': 'Debes iniciar sesión para unirte a un canal.'}, to=request.sid)
@@ -68,12 +80,7 @@ def handle_join_channel(data):
 
     # --- Validación de Acceso al Canal (¡Seguridad!) ---
     # 1. Comprobar si está baneado (global O específicamente en este canal)
-    now = datetime.now(timezone.utc)
-    active_ban = Ban.query.filter_by(user_id=current_user.id)\
-                          .filter((Ban.channel_id == channel_id) | (Ban.channel_id == None))\
-                          .filter((Ban.expires_at == None) | (Ban.expires_at > now))\
-                          .order_by(Ban.channel_id.desc().nullslast())\
-                          .first() # Priorizar ban de canal sobre global si ambos existen
+    active_ban = moderation_cache.active_ban(current_user.id, channel_id) # Prioriza ban de canal sobre global
     if active_ban:
         scope = f"en '{channel.name}'" if active_ban.channel_id else "globalmente"
         expiry_msg = f" hasta {active_ban.expires_at.strftime('%Y-%m-%d %H:%M')}" if active_ban.expires_at else " permanentemente"
@@ -89,6 +96,7 @@ def handle_join_channel(data):
     # --- Unirse a la sala ---
     room_name = str(channel_id)
     join_room(room_name)
+    presence.join(request.sid, channel.id)
     print(f'Usuario {current_user.username} (SID: {request.sid}) se unió a la sala del canal {channel.name} (ID: {room_name})')
 
     # Emitir estado actual del canal al usuario que se unió
@@ -98,15 +106,39 @@ def handle_join_channel(data):
         'is_protected': bool(channel.password_hash)
     }, to=request.sid)
 
-    # (Opcional) Emitir un mensaje de sistema al canal indicando que alguien se unió
-    system_message = {
-        'channel_id': channel.id, # Incluir channel_id para que el JS lo filtre
-        'body': f'{current_user.username} se ha unido al canal.',
-        'message_type': 'system',
-        'timestamp': datetime.now(timezone.utc).isoformat(), # Usar la hora actual en UTC
-        'username': 'Sistema'
-    }
-    emit('new_message', system_message, to=room_name)
+    # Quién está conectado ahora en el canal; después el cliente recibe solo 'presence_diff'.
+    # La entrada de este usuario se anuncia al resto en el siguiente diff (sin mensaje de sistema por unión).
+    emit('presence_state', {
+        'channel_id': channel.id,
+        'members': presence.online_members(channel.id)
+    }, to=request.sid)
+
+    # Reconexión: el cliente indica el último 'seq' que vio y solo recibe el hueco (delta sync).
+    last_seq = data.get('last_seq')
+    if last_seq is not None:
+        try:
+            _emit_channel_sync(channel.id, int(last_seq))
+        except (ValueError, TypeError):
+            emit('error', {'message': 'Secuencia de sincronización inválida.'}, to=request.sid)
+
+
+def _emit_channel_sync(channel_id, since_seq):
+    """
+    Envía al cliente los mensajes posteriores a 'since_seq' ('channel_sync').
+    Si está demasiado atrasado se envía reset=True y el cliente recarga el historial.
+    """
+    messages_data, last_seq = get_messages_since(channel_id, since_seq)
+    emit('channel_sync', {
+        'channel_id': channel_id,
+        'since_seq': since_seq,
+        'last_seq': last_seq, # Último seq del canal: el cliente lo toma como su nuevo punto de partida
+        'reset': messages_data is None,
+        'messages': messages_data or []
+    }, to=request.sid)
+    if messages_data is None:
+        print(f"Sync canal {channel_id} para {current_user.username}: demasiado atrás (seq {since_seq} de {last_seq}), se pide recarga")
+    else:
+        print(f"Sync canal {channel_id} para {current_user.username}: {len(messages_data)} mensajes desde seq {since_seq}")
 
 
 @socketio.on('leave_channel')
@@ -117,32 +149,40 @@ def handle_leave_channel(data):
 
     try: # Intentar convertir a int por si acaso
         channel_id = int(channel_id)
-        channel = Channel.query.get(channel_id)
-        channel_name = channel.name if channel else f"ID {channel_id}"
     except (ValueError, TypeError):
-        channel_name = f"ID inválido {data.get('channel_id')}"
         return # Salir si el ID no es válido
 
     room_name = str(channel_id)
     leave_room(room_name)
-    print(f'Usuario {current_user.username} (SID: {request.sid}) salió de la sala del canal {channel_name}')
+    # La salida se anuncia en el siguiente presence_diff (sin mensaje de sistema por salida)
+    presence.leave(request.sid, channel_id)
+    print(f'Usuario {current_user.username} (SID: {request.sid}) salió de la sala del canal {channel_id}')
 
-    # (Opcional) Emitir mensaje de sistema de salida
-    system_message = {
-        'channel_id': channel_id,
-        'body': f'{current_user.username} ha salido del canal.',
-        'message_type': 'system',
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'username': 'Sistema'
-    }
-    # Solo emitir si el canal existe realmente
-    if channel:
-        emit('new_message', system_message, to=room_name)
+
+@socketio.on('mark_read')
+@rate_limited('mark_read', silent=True)
+def handle_mark_read(data):
+    """El cliente ya mostró los mensajes del canal hasta 'seq': avanza su marca de lectura (no leídos de la barra lateral)."""
+    if not current_user.is_authenticated: return
+    try:
+        channel_id = int(data.get('channel_id'))
+        seq = int(data.get('seq'))
+    except (TypeError, ValueError): return
+    # Solo hacia adelante y solo si es miembro (la fila de channel_members debe existir)
+    result = db.session.execute(channel_members.update().where(
+        (channel_members.c.user_id == current_user.id) &
+        (channel_members.c.channel_id == channel_id) &
+        (channel_members.c.last_read_seq < seq)
+    ).values(last_read_seq=seq))
+    db.session.commit()
+    if result.rowcount:
+        note_channel_read(current_user.id, channel_id, seq)
 
 
 # --- Envío de Mensajes ---
 
 @socketio.on('send_message')
+@rate_limited('send_message')
 def handle_send_message(data):
     if not current_user.is_authenticated:
         emit('error', {'message': 'Debes estar logueado para enviar mensajes.'}, to=request.sid)
@@ -168,22 +208,29 @@ def handle_send_message(data):
          emit('error', {'message': 'ID de canal inválido.'}, to=request.sid)
          return
 
+    # Modo lento del canal (antes de cualquier consulta; admins y moderadores no están limitados).
+    # Aquí solo se comprueba: el envío se anota cuando el mensaje se acepta (más abajo).
+    slow_mode = not current_user.is_moderator
+    if slow_mode:
+        wait = rate_limiter.check_slow_mode(current_user.id, channel_id)
+        if wait:
+            emit('rate_limited', {
+                'event': 'send_message',
+                'channel_id': channel_id,
+                'retry_after': round(wait, 1),
+                'message': f'Modo lento: podrás escribir de nuevo en {int(wait) + 1} s.'
+            }, to=request.sid)
+            return
+
     channel = Channel.query.get(channel_id)
     if not channel:
         emit('error', {'message': 'El canal no existe.'}, to=request.sid)
         return
 
-    room_name = str(channel_id)
-    now = datetime.now(timezone.utc)
-
-    # --- Validación de Permisos (¡Seguridad!) ---
+    # --- Validación de Permisos (¡Seguridad!) (desde la caché de moderación: sin consultas) ---
 
     # 1. ¿Está baneado (global o canal)?
-    active_ban = Ban.query.filter_by(user_id=current_user.id)\
-                          .filter((Ban.channel_id == channel_id) | (Ban.channel_id == None))\
-                          .filter((Ban.expires_at == None) | (Ban.expires_at > now))\
-                          .order_by(Ban.channel_id.desc().nullslast())\
-                          .first()
+    active_ban = moderation_cache.active_ban(current_user.id, channel_id)
     if active_ban:
          scope = f"en '{channel.name}'" if active_ban.channel_id else "globalmente"
          error_msg = f"No puedes enviar mensajes, estás baneado {scope}."
@@ -192,11 +239,7 @@ def handle_send_message(data):
          return
 
     # 2. ¿Está muteado (global o canal)?
-    active_mute = Mute.query.filter_by(user_id=current_user.id)\
-                           .filter((Mute.channel_id == channel_id) | (Mute.channel_id == None))\
-                           .filter((Mute.expires_at == None) | (Mute.expires_at > now))\
-                           .order_by(Mute.channel_id.desc().nullslast())\
-                           .first()
+    active_mute = moderation_cache.active_mute(current_user.id, channel_id)
     if active_mute:
         scope = f"en '{channel.name}'" if active_mute.channel_id else "globalmente"
         reason_msg = f" Motivo: {active_mute.reason}" if active_mute.reason else ""
@@ -219,25 +262,29 @@ def handle_send_message(data):
         if message_type not in allowed_types:
             message_type = 'text' # O emitir un error
 
+        # Escritura agrupada: el MessageWriter lo guardará junto a otros y emitirá 'new_message' tras el commit
+        if app.config['MESSAGE_WRITE_BATCHING']:
+            message_writer.submit(channel_id, current_user.id, current_user.username,
+                                  message_body, message_type, request.sid)
+            if slow_mode:
+                rate_limiter.record_slow_mode(current_user.id, channel_id) # Si el lote falla, el writer lo libera
+            return
+
+        write_started = time.perf_counter()
         new_msg = Message(body=message_body,
-                        author=current_user,
+                        user_id=current_user.id,
                         channel=channel,
                         message_type=message_type) # <--- USA EL TIPO RECIBIDO/VALIDADO
         db.session.add(new_msg)
         db.session.commit()
+        message_writer.record_direct_write(time.perf_counter() - write_started)
+        if slow_mode:
+            rate_limiter.record_slow_mode(current_user.id, channel_id)
 
         # --- Emitir Mensaje a la Sala ---
-        message_data = {
-            'id': new_msg.id,
-            'body': new_msg.body,
-            'timestamp': new_msg.timestamp.replace(tzinfo=timezone.utc).isoformat().replace('+00:00', 'Z'), # Ya está en UTC
-            'user_id': current_user.id,
-            'username': current_user.username,
-            'channel_id': channel_id,
-            'message_type': new_msg.message_type,
-            'is_pinned': new_msg.is_pinned
-        }
-        emit('new_message', message_data, to=room_name)
+        message_data = serialize_message(new_msg, username=current_user.username, channel_id=channel_id)
+        note_new_message(channel_id, message_data) # Mantener el buffer de historial reciente al día
+        broadcast_message(message_data, channel_id)
         print(f"Mensaje de {current_user.username} enviado al canal {channel.name}: {message_body[:50]}...")
 
     except Exception as e:
@@ -248,26 +295,27 @@ def handle_send_message(data):
 
 # --- Indicador de Escritura ---
 
+# No se reenvía nada aquí: el agregador emite un 'typing_state' por canal cada pocos cientos de ms
+# y solo si cambió quién escribe (ver app/typing_state.py).
+
 @socketio.on('typing_started')
+@rate_limited('typing_started', silent=True)
 def handle_typing_started(data):
     if not current_user.is_authenticated: return
-    channel_id = data.get('channel_id')
-    if not channel_id: return
+    try: channel_id = int(data.get('channel_id'))
+    except (TypeError, ValueError): return
     # Podríamos añadir check de mute/ban aquí también si quisiéramos ser estrictos
-    room_name = str(channel_id)
-    user_info = {'username': current_user.username, 'channel_id': channel_id}
-    emit('user_typing', user_info, to=room_name, include_self=False)
+    typing_aggregator.started(channel_id, current_user.username, request.sid)
 
 @socketio.on('typing_stopped')
 def handle_typing_stopped(data):
     if not current_user.is_authenticated: return
-    channel_id = data.get('channel_id')
-    if not channel_id: return
-    room_name = str(channel_id)
-    user_info = {'username': current_user.username, 'channel_id': channel_id}
-    emit('user_stopped_typing', user_info, to=room_name, include_self=False)
+    try: channel_id = int(data.get('channel_id'))
+    except (TypeError, ValueError): return
+    typing_aggregator.stopped(channel_id, current_user.username)
 
 @socketio.on('find_channel_info')
+@rate_limited('find_channel_info')
 def handle_find_channel_info(data):
     # ... (validaciones iniciales: auth, channel_name) ...
     if not current_user.is_authenticated: return # Cortocircuito si no está autenticado
@@ -295,8 +343,7 @@ def handle_find_channel_info(data):
         print("[DEBUG find_info] Solicitud pendiente encontrada.")
         emit('join_channel_feedback', {'info': f'Ya tienes solicitud pendiente para "{channel.name}".', 'request_pending': True}, to=request.sid); return
 
-    now = datetime.now(timezone.utc)
-    active_ban = Ban.query.filter_by(user_id=current_user.id).filter((Ban.channel_id == channel.id) | (Ban.channel_id == None)).filter((Ban.expires_at == None) | (Ban.expires_at > now)).first()
+    active_ban = moderation_cache.active_ban(current_user.id, channel.id)
     if active_ban:
         print("[DEBUG find_info] Usuario BANEADO.")
         emit('join_channel_feedback', {'error': 'No puedes unirte/solicitar, estás baneado.'}, to=request.sid); return
@@ -308,15 +355,16 @@ def handle_find_channel_info(data):
     if not channel.requires_approval and not channel.password_hash:
         print("[DEBUG find_info] Canal público sin aprobación. Intentando unir directamente...")
         try:
-            insert_stmt = channel_members.insert().values(user_id=current_user.id, channel_id=channel.id)
+            insert_stmt = channel_members.insert().values(user_id=current_user.id, channel_id=channel.id, last_read_seq=channel.last_seq)
             db.session.execute(insert_stmt); db.session.commit()
+            note_sidebar_changed(current_user.id)
             print(f"[DEBUG find_info] ** ÉXITO ** Usuario {current_user.username} unido directamente al canal {channel.name}")
             # --- Acciones post-unión ---
             emit('new_channel_joined', {'id': channel.id, 'name': channel.name}, to=request.sid)
             join_room(str(channel.id))
+            presence.join(request.sid, channel.id)
             emit('channel_status', {'channel_id': channel.id, 'is_writable': channel.is_writable, 'is_protected': False}, to=request.sid)
-            system_message = { 'channel_id': channel.id, 'body': f'{current_user.username} se ha unido.', 'message_type': 'system', 'timestamp': now.isoformat(), 'username': 'Sistema'}
-            emit('new_message', system_message, to=str(channel.id))
+            membership_notices.joined(channel.id, current_user.username) # Se anuncia agrupado con otras altas
             emit('join_channel_feedback', {'info': f'Te has unido a "{channel.name}".', 'already_member': True, 'channel_id': channel.id, 'channel_name': channel.name }, to=request.sid) # Feedback para cerrar modal
             return # Terminar aquí
         except Exception as e:
@@ -333,6 +381,7 @@ def handle_find_channel_info(data):
 
 
 @socketio.on('attempt_join')
+@rate_limited('attempt_join')
 def handle_attempt_join(data):
     # ... (Validaciones iniciales: auth, channel_id, obtener channel) ...
     if not current_user.is_authenticated: return
@@ -350,8 +399,7 @@ def handle_attempt_join(data):
     # --- Doble Checks ---
     is_member = db.session.query(channel_members).filter_by(user_id=current_user.id, channel_id=channel_id).first()
     if is_member: print("[DEBUG attempt_join] Ya es miembro."); emit('join_channel_feedback', {'info': 'Ya eres miembro.', 'already_member': True, 'channel_id': channel.id, 'channel_name': channel.name}, to=request.sid); return
-    now = datetime.now(timezone.utc)
-    active_ban = Ban.query.filter_by(user_id=current_user.id).filter((Ban.channel_id == channel.id) | (Ban.channel_id == None)).filter((Ban.expires_at == None) | (Ban.expires_at > now)).first()
+    active_ban = moderation_cache.active_ban(current_user.id, channel.id)
     if active_ban: print("[DEBUG attempt_join] Usuario baneado."); emit('join_channel_feedback', {'error': 'No puedes unirte, estás baneado.'}, to=request.sid); return
     # --- Fin Doble Checks ---
 
@@ -373,15 +421,16 @@ def handle_attempt_join(data):
         # --- Unir Directamente ---
         print("[DEBUG attempt_join] Canal no requiere aprobación. Uniendo...")
         try:
-            insert_stmt = channel_members.insert().values(user_id=current_user.id, channel_id=channel.id)
+            insert_stmt = channel_members.insert().values(user_id=current_user.id, channel_id=channel.id, last_read_seq=channel.last_seq)
             db.session.execute(insert_stmt); db.session.commit()
+            note_sidebar_changed(current_user.id)
             print(f"[DEBUG attempt_join] ** ÉXITO ** Usuario {current_user.username} unido al canal {channel.name}")
             # --- Acciones post-unión ---
             emit('new_channel_joined', {'id': channel.id, 'name': channel.name}, to=request.sid)
             join_room(str(channel.id))
+            presence.join(request.sid, channel.id)
             emit('channel_status', {'channel_id': channel.id, 'is_writable': channel.is_writable, 'is_protected': bool(channel.password_hash)}, to=request.sid)
-            system_message = { 'channel_id': channel.id, 'body': f'{current_user.username} se ha unido.', 'message_type': 'system', 'timestamp': now.isoformat(), 'username': 'Sistema'}
-            emit('new_message', system_message, to=str(channel.id))
+            membership_notices.joined(channel.id, current_user.username) # Se anuncia agrupado con otras altas
             emit('join_channel_feedback', {'info': f'Te has unido a "{channel.name}".', 'already_member': True, 'channel_id': channel.id, 'channel_name': channel.name }, to=request.sid) # Feedback para cerrar modal
         except Exception as e:
              db.session.rollback(); print(f"[DEBUG attempt_join] Error DB uniendo: {e}"); emit('join_channel_feedback', {'error': 'Error al intentar unirse.'}, to=request.sid)
@@ -395,6 +444,7 @@ def handle_attempt_join(data):
         try:
             new_request = ChannelJoinRequest(user_id=current_user.id, channel_id=channel.id)
             db.session.add(new_request); db.session.commit()
+            note_dashboard_counts_changed() # Una solicitud pendiente más en el panel
             print(f"[DEBUG attempt_join] ** ÉXITO ** Creada solicitud user {current_user.id} -> canal {channel.id}")
             emit('join_channel_feedback', {'success': f'Solicitud enviada para "{channel.name}".'}, to=request.sid)
         except Exception as e:
@@ -431,6 +481,8 @@ def handle_self_leave(data):
         # -----------------------------------------------------
 
         db.session.commit() # Hacer commit DESPUÉS de ambas eliminaciones
+        if result.rowcount > 0:
+            note_sidebar_changed(current_user.id)
 
         if result.rowcount > 0 or deleted_requests_count > 0: # Si se eliminó membresía O solicitud
             print(f"Usuario {current_user.username} salió del canal {channel.name} (Miembro: {result.rowcount}, Solicitudes: {deleted_requests_count})")
@@ -439,10 +491,10 @@ def handle_self_leave(data):
             # Abandonar la sala SocketIO
             room_name = str(channel_id)
             leave_room(room_name)
-            # Emitir mensaje de sistema al canal (solo si era miembro)
+            presence.leave(request.sid, channel_id)
+            # Aviso de sistema al canal, agrupado con otras bajas (solo si era miembro)
             if result.rowcount > 0:
-                system_message = { 'channel_id': channel_id, 'body': f'{current_user.username} ha salido del canal.', 'message_type': 'system', 'timestamp': datetime.now(timezone.utc).isoformat(), 'username': 'Sistema'}
-                emit('new_message', system_message, to=room_name)
+                membership_notices.left(channel_id, current_user.username)
         else:
             print(f"Usuario {current_user.username} intentó salir de canal {channel.name} pero no era miembro ni tenía solicitudes.")
 
@@ -452,6 +504,7 @@ def handle_self_leave(data):
         emit('error', {'message': 'Error al intentar salir del canal.'}, to=request.sid)
 
 @socketio.on('join_channel_with_password')
+@rate_limited('join_channel_with_password')
 def handle_join_channel_password(data):
     """Intenta unir a un usuario a un canal protegido usando contraseña."""
     # --- Validaciones iniciales ---
@@ -469,7 +522,6 @@ def handle_join_channel_password(data):
         emit('error', {'message': f'Canal {channel_id} no encontrado.'}, to=request.sid); return
     # --- Fin Validaciones ---
 
-    now = datetime.now(timezone.utc)
     password_check_passed = False # Flag para saber si pasamos la validación de contraseña
 
     # 1. Validar Contraseña si el canal la requiere
@@ -489,9 +541,7 @@ def handle_join_channel_password(data):
     # Si llegamos aquí, la contraseña es correcta o no era necesaria (password_check_passed es True)
 
     # 2. Validar Ban
-    active_ban = Ban.query.filter_by(user_id=current_user.id)\
-                          .filter((Ban.channel_id == channel_id) | (Ban.channel_id == None))\
-                          .filter((Ban.expires_at == None) | (Ban.expires_at > now)).first()
+    active_ban = moderation_cache.active_ban(current_user.id, channel_id)
     if active_ban:
         emit('error', {'message': 'No puedes unirte, estás baneado.'}, to=request.sid)
         return
@@ -512,9 +562,10 @@ def handle_join_channel_password(data):
     user_was_added_now = False
     if not is_member:
         try:
-            insert_stmt = channel_members.insert().values(user_id=current_user.id, channel_id=channel.id)
+            insert_stmt = channel_members.insert().values(user_id=current_user.id, channel_id=channel.id, last_read_seq=channel.last_seq)
             db.session.execute(insert_stmt)
             db.session.commit()
+            note_sidebar_changed(current_user.id)
             user_was_added_now = True
             print(f"Usuario {current_user.username} añadido a miembros de canal {channel_id} (password OK / no pwd needed)")
         except Exception as e:
@@ -529,6 +580,7 @@ def handle_join_channel_password(data):
     try:
         room_name = str(channel_id)
         join_room(room_name)
+        presence.join(request.sid, channel.id)
         print(f'Usuario {current_user.username} unido/re-unido a sala {room_name}')
 
         # Emitir eventos CLAVE para que el cliente actualice la UI
@@ -538,8 +590,7 @@ def handle_join_channel_password(data):
 
         # Opcional: Mensaje de sistema (quizás solo si se añadió ahora?)
         if user_was_added_now:
-             system_message = { 'channel_id': channel.id, 'body': f'{current_user.username} se ha unido.', 'message_type': 'system', 'timestamp': now.isoformat(), 'username': 'Sistema'}
-             emit('new_message', system_message, to=room_name)
+             membership_notices.joined(channel.id, current_user.username)
 
     except Exception as e:
          print(f"Error al unirse a sala o emitir confirmación (pwd ok): {e}")
@@ -549,6 +600,7 @@ def handle_join_channel_password(data):
 # --- Carga de Historial ---
 
 @socketio.on('request_history')
+@rate_limited('request_history')
 def handle_request_history(data):
     if not current_user.is_authenticated:
         emit('error', {'message': 'Autenticación requerida.'}, to=request.sid)
@@ -559,35 +611,53 @@ def handle_request_history(data):
         return
     try:
         channel_id = int(channel_id)
-        channel = Channel.query.get(channel_id)
-        if not channel:
-             emit('error', {'message': f'Canal {channel_id} no encontrado.'}, to=request.sid)
-             return
-
-        # Validar acceso (ban) ANTES de enviar historial
-        now = datetime.now(timezone.utc)
-        active_ban = Ban.query.filter_by(user_id=current_user.id)\
-                              .filter((Ban.channel_id == channel_id) | (Ban.channel_id == None))\
-                              .filter((Ban.expires_at == None) | (Ban.expires_at > now))\
-                              .first()
+        # Cursores opcionales para paginar (scroll hacia arriba / hacia adelante)
+        before_id = int(data['before_id']) if data.get('before_id') is not None else None
+        after_id = int(data['after_id']) if data.get('after_id') is not None else None
+        # Validar acceso (ban) ANTES de enviar historial; moderation_cache está en memoria
+        active_ban = moderation_cache.active_ban(current_user.id, channel_id)
         if active_ban:
             emit('error', {'message': 'No puedes ver el historial, estás baneado.'}, to=request.sid)
             return
 
-        print(f"Usuario {current_user.username} solicitó historial del canal {channel.name}")
-        messages = Message.query.filter_by(channel_id=channel_id).order_by(Message.timestamp.asc()).all()
-        messages_data = [
-            {
-                'id': msg.id, 'body': msg.body, 'timestamp': msg.timestamp.replace(tzinfo=timezone.utc).isoformat().replace('+00:00', 'Z'),
-                'user_id': msg.author.id, 'username': msg.author.username,
-                'message_type': msg.message_type, 'is_pinned': msg.is_pinned
-            } for msg in messages
-        ]
-        emit('channel_history', {'channel_id': channel_id, 'messages': messages_data}, to=request.sid)
+        since_seq = int(data['since_seq']) if data.get('since_seq') is not None else None
+        limit = parse_history_limit(data.get('limit'))
+        is_latest_page = since_seq is None and before_id is None and after_id is None
+
+        # La primera página (la más reciente) se sirve desde memoria si es posible, sin tocar la BBDD:
+        # el búfer se vacía al borrar el canal, así que un acierto implica que el canal existe
+        cached_page = recent_messages.latest(channel_id, limit) if is_latest_page else None
+        if cached_page is not None:
+            messages_data, has_more = cached_page
+            print(f"Usuario {current_user.username} solicitó historial del canal {channel_id} (desde memoria)")
+        else:
+            channel = Channel.query.get(channel_id)
+            if not channel:
+                 emit('error', {'message': f'Canal {channel_id} no encontrado.'}, to=request.sid)
+                 return
+
+            # Detección de huecos: el cliente pide solo lo posterior al último 'seq' que tiene
+            if since_seq is not None:
+                _emit_channel_sync(channel_id, since_seq)
+                return
+
+            print(f"Usuario {current_user.username} solicitó historial del canal {channel.name} (before={before_id}, after={after_id})")
+            generation = recent_messages.generation(channel_id)
+            # Una sola consulta de columnas (JOIN a user), ya serializada por serialize_message
+            messages_data, has_more = get_history_page(channel_id, before_id=before_id, after_id=after_id, limit=limit)
+            if is_latest_page:
+                recent_messages.prime(channel_id, messages_data, has_more, generation)
+        emit('channel_history', {
+            'channel_id': channel_id,
+            'messages': messages_data,
+            'has_more': has_more, # ¿Quedan más páginas en esa dirección?
+            'before_id': before_id, # Se devuelven los cursores para que el cliente sepa qué página es
+            'after_id': after_id
+        }, to=request.sid)
         print(f"Historial de {len(messages_data)} mensajes enviado a {current_user.username}")
 
     except ValueError:
-         emit('error', {'message': 'ID de canal inválido.'}, to=request.sid)
+         emit('error', {'message': 'ID de canal o cursor de historial inválido.'}, to=request.sid)
     except Exception as e:
         print(f"Error al obtener historial para canal {channel_id}: {e}")
         emit('error', {'message': 'Error interno al obtener el historial.'}, to=request.sid)
\ No newline at end of file
@@ -0,0 +1,140 @@
+# app/expiry.py
+"""
+Expiración precisa de mensajes según la retención de cada canal.
+
+En lugar de barrer todo cada hora (los mensajes vivían entre 3 y 4 horas y cada barrido
+borraba miles de filas de golpe), se mantiene un min-heap con el PRÓXIMO vencimiento de cada canal:
+(timestamp del mensaje más antiguo + retención del canal, channel_id).
+
+Cada MESSAGE_EXPIRY_TICK_SECONDS el líder del scheduler (ver app/leader.py) llama a tick():
+- Saca del heap los canales cuyo vencimiento ya pasó.
+- Borra como mucho MESSAGE_EXPIRY_BATCH_SIZE mensajes vencidos de cada uno (delete_expired_chunk,
+  que también borra las imágenes y emite 'messages_expired' a la sala).
+- Vuelve a meter el canal con el vencimiento de su siguiente mensaje más antiguo.
+
+Así cada mensaje se borra como mucho un tick después de caducar, en lotes pequeños y repartidos.
+El heap se recalcula desde la BBDD cada MESSAGE_EXPIRY_REFRESH_SECONDS para recoger canales
+que estaban vacíos o mensajes escritos por otros procesos (la retención mínima es de 1 minuto).
+"""
+import heapq
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import func
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Channel, Message
+from app.tasks import channel_retention, delete_expired_chunk
+
+
+def _as_utc(timestamp):
+    # SQLite devuelve datetimes "naive" (guardados en UTC)
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
+
+
+class MessageExpiryScheduler:
+    """Min-heap de (vencimiento, channel_id) con como mucho una entrada válida por canal."""
+
+    def __init__(self):
+        self._heap = []
+        self._due = {} # channel_id -> vencimiento vigente (las entradas del heap que no coinciden están obsoletas)
+        self._last_refresh = None
+        self._lock = threading.Lock()
+        self.expired_total = 0
+        self.last_tick = {}
+
+    def _schedule(self, channel_id, due):
+        current = self._due.get(channel_id)
+        if current is None or due < current:
+            self._due[channel_id] = due
+            heapq.heappush(self._heap, (due, channel_id))
+
+    def _next_due(self, channel_id, retention_minutes):
+        """Vencimiento del mensaje más antiguo que queda en el canal (None si está vacío)."""
+        oldest = db.session.query(func.min(Message.timestamp)).filter(Message.channel_id == channel_id).scalar()
+        if oldest is None:
+            return None
+        return _as_utc(oldest) + channel_retention(app, retention_minutes)
+
+    def refresh(self):
+        """Reconstruye el heap desde la BBDD: un MIN(timestamp) por canal (usa el índice compuesto)."""
+        rows = db.session.query(Channel.id, Channel.retention_minutes, func.min(Message.timestamp))\
+                         .join(Message, Message.channel_id == Channel.id)\
+                         .group_by(Channel.id, Channel.retention_minutes)\
+                         .all()
+        heap = []
+        due = {}
+        for channel_id, retention_minutes, oldest in rows:
+            due[channel_id] = _as_utc(oldest) + channel_retention(app, retention_minutes)
+            heap.append((due[channel_id], channel_id))
+        heapq.heapify(heap)
+        self._heap, self._due = heap, due
+        self._last_refresh = time.monotonic()
+
+    def reschedule_channel(self, channel_id):
+        """Recalcula el vencimiento de un canal (ej: tras cambiar su retención en el panel de admin)."""
+        with self._lock:
+            retention_minutes = db.session.query(Channel.retention_minutes).filter(Channel.id == channel_id).scalar()
+            self._due.pop(channel_id, None) # La entrada anterior del heap queda obsoleta
+            due = self._next_due(channel_id, retention_minutes)
+            if due is not None:
+                self._schedule(channel_id, due)
+
+    def tick(self):
+        """Tarea periódica: borra los mensajes vencidos de los canales cuyo vencimiento ya pasó."""
+        with self._lock, app.app_context():
+            try:
+                refresh_every = app.config['MESSAGE_EXPIRY_REFRESH_SECONDS']
+                if self._last_refresh is None or time.monotonic() - self._last_refresh >= refresh_every:
+                    self.refresh()
+
+                batch_size = app.config['MESSAGE_EXPIRY_BATCH_SIZE']
+                now = datetime.now(timezone.utc)
+                expired = 0
+                channels = 0
+                started = time.perf_counter()
+                requeue = []
+                while self._heap and self._heap[0][0] <= now:
+                    due, channel_id = heapq.heappop(self._heap)
+                    if self._due.get(channel_id) != due:
+                        continue # Entrada obsoleta
+                    del self._due[channel_id]
+
+                    retention_minutes = db.session.query(Channel.retention_minutes)\
+                                                  .filter(Channel.id == channel_id).scalar()
+                    result = delete_expired_chunk(channel_id, now - channel_retention(app, retention_minutes), batch_size)
+                    expired += result['messages']
+                    channels += 1
+
+                    next_due = self._next_due(channel_id, retention_minutes)
+                    if next_due is not None:
+                        # Si aún quedan vencidos (más que batch_size) se siguen borrando en el próximo tick
+                        requeue.append((channel_id, next_due))
+                for channel_id, next_due in requeue:
+                    self._schedule(channel_id, next_due)
+
+                self.expired_total += expired
+                if expired:
+                    self.last_tick = {'at': now.isoformat(), 'channels': channels, 'messages': expired,
+                                      'seconds': round(time.perf_counter() - started, 4)}
+                    print(f"[Expiry] {expired} mensajes expirados en {channels} canales.")
+            except Exception as e:
+                db.session.rollback()
+                print(f"[Expiry] Error al expirar mensajes: {e}")
+
+    def stats(self):
+        return {
+            'scheduled_channels': len(self._due),
+            'next_due': min(self._due.values()).isoformat() if self._due else None,
+            'expired_total': self.expired_total,
+            'last_tick': self.last_tick,
+        }
+
+
+# Instancia global (una por proceso; solo el líder del scheduler ejecuta tick())
+message_expiry = MessageExpiryScheduler()
+
+# La retención de un canal editado en otro proceso cambia su vencimiento
+invalidation_bus.subscribe('channel', message_expiry.reschedule_channel)
@@ -1,13 +1,13 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, SelectField, HiddenField
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, SelectField, HiddenField, IntegerField
 # Importa los validadores necesarios
-from wtforms.validators import DataRequired, Length, EqualTo, Optional, ValidationError
+from wtforms.validators import DataRequired, Length, EqualTo, Optional, ValidationError, NumberRange
 
 from flask_wtf.file import FileField, FileRequired, FileAllowed
 # Importa modelos si necesitas validar contra la base de datos (ej: username único)
 from app.models import User, Channel
 # Importa el objeto app para acceder a su configuración
-from app import app
+from app import app, db
 
 
 def coerce_int_or_none(x):
@@ -19,6 +19,12 @@ def coerce_int_or_none(x):
     except (ValueError, TypeError): # Capturar ambos errores
         return None # Devolver None si la conversión falla
 
+
+def load_channel_choices():
+    """Opciones del selector de canal de mute/ban: Global + todos los canales (solo id y nombre)."""
+    return [(None, '--- Global ---')] + \
+           [(c.id, c.name) for c in db.session.query(Channel.id, Channel.name).order_by(Channel.name)]
+
 # --- Formulario de Inicio de Sesión ---
 # Este es el formulario que 'app/routes.py' intentaba importar.
 class LoginForm(FlaskForm):
@@ -75,6 +81,12 @@ class CreateChannelForm(FlaskForm):
         EqualTo('password', message='Las contraseñas deben coincidir.')
     ])
     is_writable = BooleanField('Permitir escritura', default=True)
+    # Minutos que se conservan los mensajes. Vacío = valor global del servidor
+    retention_minutes = IntegerField('Retención de mensajes en minutos (Opcional)',
+                                     validators=[Optional(), NumberRange(min=1, max=525600)])
+    # Segundos entre dos mensajes del mismo usuario. Vacío o 0 = sin modo lento
+    slow_mode_seconds = IntegerField('Modo lento en segundos (Opcional)',
+                                     validators=[Optional(), NumberRange(min=0, max=3600)])
     submit = SubmitField('Crear Canal')
 
     # Validación personalizada para nombre de canal único
@@ -105,6 +117,12 @@ class EditChannelForm(FlaskForm):
         EqualTo('password', message='Las contraseñas deben coincidir.')
     ])
     is_writable = BooleanField('Permitir escritura', default=True)
+    # Minutos que se conservan los mensajes. Vacío = valor global del servidor
+    retention_minutes = IntegerField('Retención de mensajes en minutos (Opcional)',
+                                     validators=[Optional(), NumberRange(min=1, max=525600)])
+    # Segundos entre dos mensajes del mismo usuario. Vacío o 0 = sin modo lento
+    slow_mode_seconds = IntegerField('Modo lento en segundos (Opcional)',
+                                     validators=[Optional(), NumberRange(min=0, max=3600)])
     # TODO: Añadir requires_approval cuando se implemente en el modelo
     submit = SubmitField('Guardar Cambios')
 
@@ -145,11 +163,10 @@ class MuteUserForm(FlaskForm):
     reason = TextAreaField('Motivo (Opcional)', validators=[Optional(), Length(max=255)])
     submit = SubmitField('Aplicar Mute')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, channel_choices=None, **kwargs):
         super(MuteUserForm, self).__init__(*args, **kwargs)
-        # Podemos mantener None o usar '', ambos funcionarán con la nueva coerción
-        self.channel_id.choices = [(None, '--- Global ---')] + \
-                                  [(c.id, c.name) for c in Channel.query.order_by(Channel.name).all()]
+        # 'channel_choices' permite compartir las opciones entre formularios (el panel usa mute y ban)
+        self.channel_id.choices = channel_choices if channel_choices is not None else load_channel_choices()
 
 class BanUserForm(FlaskForm):
     user_id = HiddenField()
@@ -159,11 +176,10 @@ class BanUserForm(FlaskForm):
     reason = TextAreaField('Motivo (Opcional)', validators=[Optional(), Length(max=255)])
     submit = SubmitField('Aplicar Ban')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, channel_choices=None, **kwargs):
         super(BanUserForm, self).__init__(*args, **kwargs)
-         # Podemos mantener None o usar '', ambos funcionarán con la nueva coerción
-        self.channel_id.choices = [(None, '--- Global ---')] + \
-                                  [(c.id, c.name) for c in Channel.query.order_by(Channel.name).all()]
+        # 'channel_choices' permite compartir las opciones entre formularios (el panel usa mute y ban)
+        self.channel_id.choices = channel_choices if channel_choices is not None else load_channel_choices()
 
 class AdminUploadStickerForm(FlaskForm):
     """Formulario para que el admin suba un sticker directamente como aprobado."""
@@ -0,0 +1,556 @@
+# app/history.py
+"""
+Paginación por cursor (keyset) del historial de mensajes de un canal.
+
+En lugar de enviar TODO el historial de un canal, se envían páginas de N mensajes:
+- Sin cursor: los N mensajes más recientes.
+- before_id: los N mensajes anteriores a ese mensaje (scroll hacia arriba).
+- after_id: los N mensajes posteriores a ese mensaje.
+
+Las consultas usan el índice compuesto (channel_id, timestamp, id) de Message,
+así que el coste de cada página no depende del tamaño total del canal.
+
+get_messages_since() implementa la sincronización incremental: cada mensaje lleva un número
+de secuencia por canal (Message.seq) y el cliente, al reconectar, solo recibe los mensajes
+posteriores al último que vio (o una señal de 'reset' si se ha quedado demasiado atrás).
+
+stream_history() exporta el historial completo en streaming (JSON o NDJSON) sin cargarlo entero
+en memoria.
+
+Además, RecentMessageBuffer guarda en memoria los últimos mensajes (ya serializados)
+de cada canal para servir la primera página sin consultar la BBDD. Con varios procesos, los
+mensajes nuevos viajan en avisos 'history_append' (uno por lote escrito) y cada proceso los
+añade a su buffer, y los expirados viajan en 'history_expired' y solo se quitan esos; los kicks
+descartan el canal entero ('history').
+"""
+import json
+import threading
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import click
+
+from sqlalchemy import and_, or_, event
+from sqlalchemy.engine import Engine
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Channel, Message, User
+from app.sidebar import sidebar_cache
+
+
+# --- Serialización Compartida ---
+
+# Columnas EXACTAS que necesita el payload del historial. Se consultan con un JOIN a 'user'
+# en una sola consulta, sin hidratar objetos ORM ni disparar la carga perezosa de msg.author.
+HISTORY_COLUMNS = (
+    Message.id, Message.body, Message.timestamp, Message.user_id,
+    User.username, Message.message_type, Message.is_pinned, Message.seq
+)
+
+
+def format_timestamp(timestamp):
+    """Formatea un datetime (guardado en UTC) como ISO 8601 con sufijo 'Z'."""
+    return timestamp.replace(tzinfo=timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def serialize_message(msg, username=None, channel_id=None):
+    """
+    Convierte un mensaje (fila de HISTORY_COLUMNS o instancia de Message) al dict que se envía al cliente.
+    'username' permite pasar el autor ya conocido (ej: current_user) cuando 'msg' es un objeto Message.
+    'channel_id' se incluye cuando el mensaje se emite suelto (new_message) y no dentro de un historial.
+    """
+    data = {
+        'id': msg.id,
+        'body': msg.body,
+        'timestamp': format_timestamp(msg.timestamp),
+        'user_id': msg.user_id,
+        'username': username if username is not None else (msg.username or 'Usuario eliminado'),
+        'message_type': msg.message_type,
+        'is_pinned': msg.is_pinned,
+        'seq': msg.seq
+    }
+    if channel_id is not None:
+        data['channel_id'] = channel_id
+    return data
+
+
+# --- Contador de Consultas (control de O(1) consultas por página) ---
+
+_query_counter = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_query_counter, 'depth', 0) > 0:
+        _query_counter.count += 1
+
+
+@contextmanager
+def count_queries():
+    """Cuenta las sentencias SQL ejecutadas dentro del bloque (solo en el hilo/greenlet actual)."""
+    if getattr(_query_counter, 'depth', 0) == 0:
+        _query_counter.count = 0
+    _query_counter.depth = getattr(_query_counter, 'depth', 0) + 1
+    result = {'count': 0}
+    start = _query_counter.count
+    try:
+        yield result
+    finally:
+        result['count'] = _query_counter.count - start
+        _query_counter.depth -= 1
+
+
+# --- Paginación por Cursor ---
+
+# Consultas por página servida (expuesto en /admin/stats)
+history_page_stats = {'pages': 0, 'queries': 0, 'max_queries_seen': 0, 'over_limit': 0}
+
+
+def parse_history_limit(value):
+    """Convierte el 'limit' pedido por el cliente a un entero válido (con tope máximo)."""
+    default = app.config['HISTORY_PAGE_SIZE']
+    try:
+        limit = int(value) if value is not None else default
+    except (ValueError, TypeError):
+        limit = default
+    return max(1, min(limit, app.config['HISTORY_MAX_PAGE_SIZE']))
+
+
+def get_history_page(channel_id, before_id=None, after_id=None, limit=None):
+    """
+    Devuelve una tupla (mensajes, has_more) con los mensajes YA SERIALIZADOS en orden cronológico ascendente.
+    'has_more' indica si quedan más mensajes en la dirección pedida
+    (más antiguos si no hay cursor o se usa before_id; más nuevos si se usa after_id).
+
+    Las páginas que superan HISTORY_MAX_QUERIES_PER_PAGE consultas se registran en el log y en
+    history_page_stats (/admin/stats), para detectar regresiones tipo N+1 (ej: volver a usar msg.author).
+    'flask check-history-queries' lo comprueba (falla si se supera el máximo).
+    """
+    limit = parse_history_limit(limit)
+    with count_queries() as counter:
+        rows, has_more = _fetch_history_rows(channel_id, before_id, after_id, limit)
+        messages = [serialize_message(row) for row in rows]
+
+    history_page_stats['pages'] += 1
+    history_page_stats['queries'] += counter['count']
+    history_page_stats['max_queries_seen'] = max(history_page_stats['max_queries_seen'], counter['count'])
+    max_queries = app.config['HISTORY_MAX_QUERIES_PER_PAGE']
+    if counter['count'] > max_queries:
+        history_page_stats['over_limit'] += 1
+        print(f"[History] Canal {channel_id}: {counter['count']} consultas para una página (máx {max_queries}). ¿N+1?")
+    return messages, has_more
+
+
+@app.cli.command('check-history-queries')
+@click.option('--authors', default=5, show_default=True, help='Autores distintos en la página de prueba.')
+def check_history_queries_command(authors):
+    """Sirve páginas con varios autores y falla si alguna pasa de HISTORY_MAX_QUERIES_PER_PAGE consultas."""
+    max_queries = app.config['HISTORY_MAX_QUERIES_PER_PAGE']
+    suffix = uuid.uuid4().hex[:8]
+    try:
+        # Datos de prueba dentro de una transacción que se deshace al final: no queda nada en la BBDD
+        channel = Channel(name=f'check-history-{suffix}')
+        users = [User(username=f'check-{suffix}-{i}', password_hash='!') for i in range(authors)]
+        db.session.add(channel)
+        db.session.add_all(users)
+        db.session.flush()
+        base = datetime.now(timezone.utc) - timedelta(minutes=1)
+        db.session.add_all([Message(body=f'mensaje {i}', user_id=users[i % authors].id, channel_id=channel.id,
+                                    timestamp=base + timedelta(milliseconds=i))
+                            for i in range(authors * 3)])
+        db.session.flush()
+        channel_id = channel.id
+        # Sin los objetos en la sesión: un acceso por autor (N+1) tiene que ir a la BBDD y contar
+        db.session.expunge_all()
+
+        latest, _ = get_history_page(channel_id, limit=authors * 2)
+        cursor_id = latest[authors]['id']
+        pages = {
+            'última': {},
+            'before_id': {'before_id': cursor_id},
+            'after_id': {'after_id': cursor_id},
+        }
+        failed = []
+        for label, cursor in pages.items():
+            with count_queries() as counter:
+                messages, _ = get_history_page(channel_id, limit=authors * 2, **cursor)
+            distinct_authors = len({message['user_id'] for message in messages})
+            click.echo(f"Página {label}: {len(messages)} mensajes de {distinct_authors} autores, "
+                       f"{counter['count']} consultas (máx {max_queries})")
+            if counter['count'] > max_queries:
+                failed.append(label)
+    finally:
+        db.session.rollback()
+    if failed:
+        raise click.ClickException(f"Demasiadas consultas por página ({', '.join(failed)}). ¿N+1 en serialize_message?")
+    click.echo("OK")
+
+
+def _history_query(channel_id):
+    return db.session.query(*HISTORY_COLUMNS)\
+                     .outerjoin(User, User.id == Message.user_id)\
+                     .filter(Message.channel_id == channel_id)
+
+
+def _apply_cursor(query, channel_id, before_id, after_id):
+    """Limita la consulta a los mensajes anteriores/posteriores al cursor. None si el cursor no está en el canal."""
+    cursor_id = before_id if before_id is not None else after_id
+    if cursor_id is None:
+        return query
+    # Obtener la posición (timestamp, id) del mensaje cursor dentro del MISMO canal
+    cursor = db.session.query(Message.timestamp, Message.id)\
+                       .filter(Message.id == cursor_id, Message.channel_id == channel_id)\
+                       .first()
+    if cursor is None:
+        return None
+    if before_id is not None:
+        return query.filter(or_(Message.timestamp < cursor.timestamp,
+                                and_(Message.timestamp == cursor.timestamp, Message.id < cursor.id)))
+    return query.filter(or_(Message.timestamp > cursor.timestamp,
+                            and_(Message.timestamp == cursor.timestamp, Message.id > cursor.id)))
+
+
+def _fetch_history_rows(channel_id, before_id, after_id, limit):
+    """Ejecuta la consulta keyset de solo-columnas. Máximo 2 consultas (cursor + página)."""
+    query = _history_query(channel_id)
+
+    query = _apply_cursor(query, channel_id, before_id, after_id)
+    if query is None:
+        return [], False # Cursor inexistente (¿mensaje ya borrado?) -> página vacía
+
+    if after_id is not None:
+        # Hacia adelante: orden ascendente directo
+        rows = query.order_by(Message.timestamp.asc(), Message.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        return rows[:limit], has_more
+
+    # Página más reciente o hacia atrás: pedir en orden descendente y dar la vuelta
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+# --- Exportación en Streaming ---
+
+EXPORT_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def stream_history(channel_id, export_format, after_id=None, batch_size=None):
+    """
+    Generador con el historial completo del canal (o el posterior a after_id), en orden ascendente,
+    ya codificado: un objeto JSON {"channel_id", "messages": [...]} o NDJSON (un mensaje por línea).
+
+    Las filas se leen con yield_per (cursor de servidor en PostgreSQL) y se escriben por lotes,
+    así que ni la consulta ni la respuesta acumulan el canal entero en memoria.
+    Necesita contexto de aplicación mientras se consume (usar stream_with_context).
+    """
+    if batch_size is None:
+        batch_size = app.config['HISTORY_EXPORT_BATCH_SIZE']
+    ndjson = export_format == 'ndjson'
+    if not ndjson:
+        yield f'{{"channel_id":{channel_id},"messages":['
+    query = _apply_cursor(_history_query(channel_id), channel_id, None, after_id)
+    if query is not None:
+        rows = query.order_by(Message.timestamp.asc(), Message.id.asc()).yield_per(batch_size)
+        chunk = []
+        first = True
+        for row in rows:
+            encoded = json.dumps(serialize_message(row), separators=(',', ':'))
+            if ndjson:
+                chunk.append(encoded + '\n')
+            else:
+                chunk.append(encoded if first else ',' + encoded)
+                first = False
+            if len(chunk) >= batch_size:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+    if not ndjson:
+        yield ']}'
+
+
+# --- Sincronización Incremental (delta sync) ---
+
+def get_messages_since(channel_id, since_seq, max_gap=None):
+    """
+    Devuelve (mensajes, last_seq) con los mensajes del canal cuyo seq es mayor que 'since_seq',
+    ya serializados y en orden ascendente. 'last_seq' es el último número asignado en el canal.
+
+    Si el cliente se ha quedado más de 'max_gap' mensajes atrás (o su since_seq no tiene sentido,
+    ej: mayor que last_seq tras restaurar la BBDD), devuelve (None, last_seq): el cliente debe
+    recargar el historial desde cero en lugar de aplicar el hueco.
+    """
+    if max_gap is None:
+        max_gap = app.config['HISTORY_SYNC_MAX_GAP']
+    last_seq = db.session.query(Channel.last_seq).filter(Channel.id == channel_id).scalar() or 0
+
+    if since_seq == last_seq:
+        return [], last_seq # Al día: nada que enviar
+    if since_seq < 0 or since_seq > last_seq or last_seq - since_seq > max_gap:
+        return None, last_seq
+
+    rows = db.session.query(*HISTORY_COLUMNS)\
+                     .outerjoin(User, User.id == Message.user_id)\
+                     .filter(Message.channel_id == channel_id, Message.seq > since_seq)\
+                     .order_by(Message.seq.asc())\
+                     .limit(max_gap)\
+                     .all()
+    # Puede haber menos filas que (last_seq - since_seq) si se borraron mensajes; no es un error
+    return [serialize_message(row) for row in rows], last_seq
+
+
+# --- Buffer en Memoria de Mensajes Recientes ---
+
+class _ChannelBuffer:
+    """Mensajes recientes de UN canal, en orden cronológico (el más nuevo al final)."""
+    __slots__ = ('messages', 'nbytes', 'complete')
+
+    def __init__(self):
+        self.messages = deque() # Elementos: (tamaño_aprox, mensaje_serializado)
+        self.nbytes = 0
+        self.complete = False # True si el buffer contiene TODO el historial del canal
+
+
+class RecentMessageBuffer:
+    """
+    Ring buffer acotado por canal con los últimos mensajes ya serializados (dicts listos para emitir).
+
+    - prime(): carga el buffer con la página más reciente leída de la BBDD.
+    - append(): añade un mensaje nuevo (solo si el canal ya estaba cargado y su 'seq' es el siguiente,
+      para no servir huecos).
+    - latest(): devuelve la primera página desde memoria, o None si no se puede servir (miss).
+    - remove(): quita mensajes concretos (expirados) sin descartar el resto del canal.
+    - invalidate(): descarta un canal (o todos) tras kicks o borrados de canal.
+
+    La memoria total está limitada por max_bytes: al superarla se descartan canales completos
+    empezando por el usado hace más tiempo (LRU).
+    """
+
+    def __init__(self, per_channel, max_bytes):
+        self.per_channel = per_channel
+        self.max_bytes = max_bytes
+        self._channels = OrderedDict() # channel_id -> _ChannelBuffer (orden LRU)
+        self._generations = {} # channel_id -> contador de cambios (evita cargar datos obsoletos en prime)
+        self._epoch = 0 # Se incrementa al invalidar TODO el buffer
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _estimate_size(message):
+        # Tamaño aproximado en memoria/red del mensaje serializado
+        return len(json.dumps(message, default=str)) + 64
+
+    def generation(self, channel_id):
+        """Devuelve la 'versión' actual del canal. Se pasa a prime() para detectar escrituras intermedias."""
+        with self._lock:
+            return (self._epoch, self._generations.get(channel_id, 0))
+
+    def _bump(self, channel_id):
+        self._generations[channel_id] = self._generations.get(channel_id, 0) + 1
+
+    def _drop(self, channel_id):
+        buf = self._channels.pop(channel_id, None)
+        if buf is not None:
+            self._total_bytes -= buf.nbytes
+
+    def _enforce_budget(self):
+        # Descartar canales completos (los menos usados primero) hasta volver al presupuesto
+        while self._total_bytes > self.max_bytes and self._channels:
+            channel_id, buf = self._channels.popitem(last=False)
+            self._total_bytes -= buf.nbytes
+            self.evictions += 1
+
+    def prime(self, channel_id, messages, has_more, generation):
+        """
+        Carga el buffer de un canal con la página más reciente (orden ascendente).
+        Se ignora si el canal cambió (append/invalidate) desde que se leyó 'generation'.
+        """
+        with self._lock:
+            if (self._epoch, self._generations.get(channel_id, 0)) != generation:
+                return False
+            self._drop(channel_id)
+            buf = _ChannelBuffer()
+            for message in list(messages)[-self.per_channel:]:
+                size = self._estimate_size(message)
+                buf.messages.append((size, message))
+                buf.nbytes += size
+            buf.complete = not has_more and len(messages) <= self.per_channel
+            self._channels[channel_id] = buf
+            self._total_bytes += buf.nbytes
+            self._enforce_budget()
+            return True
+
+    def append(self, channel_id, message):
+        """Añade un mensaje recién guardado al final del buffer del canal."""
+        with self._lock:
+            self._bump(channel_id) # Cualquier prime() en curso para este canal queda invalidado
+            buf = self._channels.get(channel_id)
+            if buf is None:
+                return # Canal no cargado: se cargará desde la BBDD en la próxima petición
+            last_seq = buf.messages[-1][1].get('seq') if buf.messages else None
+            if last_seq is not None and message.get('seq') is not None and message['seq'] != last_seq + 1:
+                # Hueco o desorden (aviso de otro proceso perdido, adelantado o repetido): recargar de la BBDD
+                self._drop(channel_id)
+                return
+            size = self._estimate_size(message)
+            buf.messages.append((size, message))
+            buf.nbytes += size
+            self._total_bytes += size
+            while len(buf.messages) > self.per_channel:
+                old_size, _ = buf.messages.popleft()
+                buf.nbytes -= old_size
+                self._total_bytes -= old_size
+                buf.complete = False
+            self._channels.move_to_end(channel_id)
+            self._enforce_budget()
+
+    def latest(self, channel_id, limit):
+        """Devuelve (mensajes, has_more) de la página más reciente, o None si hay que ir a la BBDD."""
+        with self._lock:
+            buf = self._channels.get(channel_id)
+            if buf is None or (len(buf.messages) < limit and not buf.complete):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._channels.move_to_end(channel_id)
+            page = [message for _, message in list(buf.messages)[-limit:]]
+            has_more = len(buf.messages) > limit or not buf.complete
+            return page, has_more
+
+    def remove(self, channel_id, message_ids):
+        """Quita del buffer del canal los mensajes borrados (ej: expirados), conservando el resto."""
+        message_ids = set(message_ids)
+        with self._lock:
+            self._bump(channel_id) # Un prime() en curso pudo leerlos antes del borrado
+            buf = self._channels.get(channel_id)
+            if buf is None:
+                return
+            kept = deque()
+            for size, message in buf.messages:
+                if message['id'] in message_ids:
+                    buf.nbytes -= size
+                    self._total_bytes -= size
+                else:
+                    kept.append((size, message))
+            buf.messages = kept
+
+    def invalidate(self, channel_id=None):
+        """Descarta el buffer de un canal (o de todos si channel_id es None)."""
+        with self._lock:
+            if channel_id is None:
+                self._epoch += 1
+                self._generations.clear()
+                self._channels.clear()
+                self._total_bytes = 0
+            else:
+                self._bump(channel_id)
+                self._drop(channel_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Instancia global (una por proceso)
+recent_messages = RecentMessageBuffer(
+    per_channel=max(app.config['HISTORY_BUFFER_PER_CHANNEL'], app.config['HISTORY_PAGE_SIZE']),
+    max_bytes=app.config['HISTORY_BUFFER_MAX_BYTES']
+)
+
+
+# Margen para el resto del aviso ({'o', 'v', 'e', 'k'}) dentro del tamaño máximo del backend
+NOTICE_OVERHEAD_BYTES = 128
+
+
+def note_new_messages(messages):
+    """
+    Añade mensajes recién guardados [(channel_id, message_data), ...] al buffer y los envía al resto
+    de procesos en el menor número posible de avisos 'history_append', para que los añadan al suyo
+    en vez de descartarlo. Un mensaje que no cabe en un aviso se publica como 'history' (ese canal
+    se recargará desde la BBDD en los otros procesos).
+    """
+    for channel_id, message_data in messages:
+        recent_messages.append(channel_id, message_data)
+        sidebar_cache.message_added(channel_id, message_data.get('seq'), message_data.get('user_id')) # No leídos
+    if not invalidation_bus.distributed:
+        return
+    limit = invalidation_bus.max_payload_bytes - NOTICE_OVERHEAD_BYTES
+    chunk, chunk_bytes = [], 0
+    for channel_id, message_data in messages:
+        item = [channel_id, message_data]
+        size = len(json.dumps(item).encode('utf-8')) + 1
+        if size > limit:
+            invalidation_bus.publish('history', channel_id)
+            continue
+        if chunk and chunk_bytes + size > limit:
+            invalidation_bus.publish('history_append', chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        invalidation_bus.publish('history_append', chunk)
+
+
+def note_messages_expired(channel_id, message_ids):
+    """
+    Mensajes borrados por la expiración: quitarlos del buffer y avisar al resto de procesos
+    ('history_expired', [channel_id, [ids]], en tantos avisos como haga falta) para que hagan lo mismo.
+    Suelen ser los más antiguos del canal, así que normalmente ni siquiera estaban en el buffer.
+    """
+    recent_messages.remove(channel_id, message_ids)
+    if not invalidation_bus.distributed:
+        return
+    limit = invalidation_bus.max_payload_bytes - NOTICE_OVERHEAD_BYTES
+    chunk, chunk_bytes = [], 0
+    for message_id in message_ids:
+        size = len(str(message_id)) + 2
+        if chunk and chunk_bytes + size > limit:
+            invalidation_bus.publish('history_expired', [channel_id, chunk])
+            chunk, chunk_bytes = [], 0
+        chunk.append(message_id)
+        chunk_bytes += size
+    if chunk:
+        invalidation_bus.publish('history_expired', [channel_id, chunk])
+
+
+def note_new_message(channel_id, message_data):
+    """Versión de note_new_messages() para un solo mensaje (escritura directa, subidas)."""
+    note_new_messages([(channel_id, message_data)])
+
+
+def _append_remote_messages(items):
+    """Mensajes guardados por otro proceso: añadirlos al buffer (se descarta el canal si hay huecos)."""
+    for channel_id, message_data in items:
+        recent_messages.append(channel_id, message_data)
+        sidebar_cache.message_added(channel_id, message_data.get('seq'), message_data.get('user_id'))
+
+
+def _remove_remote_expired(key):
+    channel_id, message_ids = key
+    recent_messages.remove(channel_id, message_ids)
+
+
+# Avisos de otros procesos: mensajes nuevos, expirados, borrados o canal borrado
+invalidation_bus.subscribe('history_append', _append_remote_messages)
+invalidation_bus.subscribe('history_expired', _remove_remote_expired)
+invalidation_bus.subscribe('history', recent_messages.invalidate)
+invalidation_bus.subscribe('channel_deleted', recent_messages.invalidate)
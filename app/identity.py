@@ -0,0 +1,108 @@
+# app/identity.py
+"""
+Caché de identidades para current_user (Flask-Login user_loader).
+
+load_user se ejecuta en cada petición HTTP y en cada evento de Socket.IO que usa current_user
+(un SELECT por pulsación en 'typing'). Ahora se devuelve un UserIdentity: copia ligera y
+desacoplada de la sesión de SQLAlchemy con solo id, username y role.
+
+- Caché LRU acotada (IDENTITY_CACHE_MAX_USERS) con TTL (IDENTITY_CACHE_TTL_SECONDS).
+- admin_edit_user_role y admin_delete_user la invalidan al momento y avisan al resto de
+  procesos por el bus de invalidación ('user').
+- Para modificar el usuario hay que cargar el modelo User (User.query.get(current_user.id)).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Channel, User, channel_members
+
+
+class UserIdentity(UserMixin):
+    """Lo que la app necesita de current_user, sin objeto ORM (se comparte entre peticiones)."""
+
+    def __init__(self, id, username, role):
+        self.id = id
+        self.username = username
+        self.role = role
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+    @property
+    def is_moderator(self):
+        # Un admin también es considerado moderador en términos de permisos base.
+        return self.role == 'moderator' or self.role == 'admin'
+
+    @property
+    def approved_channels(self):
+        """Misma consulta que la relación dinámica User.approved_channels."""
+        return Channel.query.join(channel_members, channel_members.c.channel_id == Channel.id)\
+                            .filter(channel_members.c.user_id == self.id)
+
+    def __repr__(self):
+        return f'<UserIdentity {self.username} (ID: {self.id}, Role: {self.role})>'
+
+
+class IdentityCache:
+
+    def __init__(self, max_users, ttl_seconds):
+        self.max_users = max_users
+        self.ttl = ttl_seconds
+        self._users = OrderedDict() # user_id -> (UserIdentity, cargado_en) en orden LRU
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """UserIdentity del usuario, o None si ya no existe (los inexistentes no se guardan)."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None and now - cached[1] < self.ttl:
+                self.hits += 1
+                self._users.move_to_end(user_id)
+                return cached[0]
+            self.misses += 1
+
+        row = db.session.query(User.id, User.username, User.role).filter(User.id == user_id).first()
+        if row is None:
+            self.invalidate(user_id)
+            return None
+        identity = UserIdentity(row.id, row.username, row.role)
+        with self._lock:
+            self._users[user_id] = (identity, now)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'max_users': self.max_users,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Instancia global (una por proceso)
+identity_cache = IdentityCache(
+    max_users=app.config['IDENTITY_CACHE_MAX_USERS'],
+    ttl_seconds=app.config['IDENTITY_CACHE_TTL_SECONDS']
+)
+
+invalidation_bus.subscribe('user', identity_cache.invalidate)
@@ -0,0 +1,271 @@
+# app/invalidation.py
+"""
+Bus de invalidación de cachés entre procesos (workers de gunicorn, proceso clock...).
+
+Cada proceso tiene sus propias cachés en memoria (historial reciente, moderación, canales, ajustes).
+Cuando un admin cambia algo, el proceso que atiende la petición actualiza SUS cachés y publica un
+aviso "entidad cambiada" (entity, key); el resto de procesos lo recibe y descarta esa entrada.
+
+Avisos: {'o': origen, 'v': versión, 'e': entidad, 'k': clave}. La versión crece por proceso
+de origen y solo sirve para descartar avisos repetidos (misma versión ya aplicada); los que llegan
+desordenados se aplican igual (cada uno afecta a su entidad/clave). Los propios (mismo origen) se
+ignoran porque quien publica ya actualizó sus cachés.
+
+Entidades usadas: 'channel' (id, canal editado), 'channel_deleted' (id), 'moderation' (user_id,
+o None = todo), 'user' (id, rol cambiado o usuario borrado), 'setting' (clave), 'stickers' (id, cambió el conjunto de stickers
+aprobados), 'sidebar' (user_id, altas/bajas en canales o mensajes marcados como leídos), 'dashboard_counts'
+(None, contadores del panel de administración),
+'history_append' ([[channel_id, mensaje serializado], ...]: mensajes nuevos que se añaden al buffer de
+historial), 'history_expired' ([channel_id, [ids]]: mensajes expirados que se quitan del buffer) y
+'history' (channel_id: kicks o mensajes nuevos que no cabían en un aviso; se descarta el canal).
+
+Backends (INVALIDATION_BACKEND):
+- 'local': un solo proceso; no se envía nada (por defecto).
+- 'unix': sockets UNIX de datagramas en INVALIDATION_SOCKET_DIR; para desarrollo/tests con varios
+  procesos en la misma máquina.
+- 'postgres': LISTEN/NOTIFY sobre la propia BBDD PostgreSQL (producción).
+"""
+import atexit
+import json
+import os
+import threading
+import uuid
+from collections import defaultdict, deque
+
+from sqlalchemy import text
+
+from app import app, db, socketio
+
+
+# --- Backends ---
+
+def _green(module_name):
+    """Versión 'verde' de socket/select si Socket.IO corre con eventlet (para no bloquear el hub)."""
+    if socketio.async_mode == 'eventlet':
+        from eventlet import green
+        return getattr(green, module_name)
+    return __import__(module_name)
+
+
+class LocalBackend:
+    """Un solo proceso: las cachés ya se actualizan en el propio proceso, no hay nada que enviar."""
+    name = 'local'
+    distributed = False
+    max_payload_bytes = None
+
+    def start(self, deliver):
+        pass
+
+    def send(self, payload):
+        pass
+
+
+class UnixSocketBackend:
+    """
+    Cada proceso escucha en un socket UNIX de datagramas dentro de 'directory' y publica enviando
+    el aviso a todos los sockets del directorio (los de procesos muertos se borran al fallar).
+    """
+    name = 'unix'
+    distributed = True
+    max_payload_bytes = 65536 # Tamaño del recv() de _listen
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self._socket = _green('socket')
+
+    def start(self, deliver):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        listener = self._socket.socket(self._socket.AF_UNIX, self._socket.SOCK_DGRAM)
+        listener.bind(self.path)
+        atexit.register(self._cleanup)
+        socketio.start_background_task(self._listen, listener, deliver)
+
+    def _listen(self, listener, deliver):
+        while True:
+            try:
+                deliver(listener.recv(65536).decode('utf-8'))
+            except Exception as e:
+                print(f"[Invalidation] Error recibiendo aviso (unix): {e}")
+
+    def _cleanup(self):
+        try:
+            if self.path:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+    def send(self, payload):
+        data = payload.encode('utf-8')
+        sender = self._socket.socket(self._socket.AF_UNIX, self._socket.SOCK_DGRAM)
+        try:
+            for name in os.listdir(self.directory):
+                target = os.path.join(self.directory, name)
+                if not name.endswith('.sock') or target == self.path:
+                    continue
+                try:
+                    sender.sendto(data, target)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Proceso que ya no existe: borrar su socket
+                    try:
+                        os.remove(target)
+                    except OSError:
+                        pass
+                except OSError as e:
+                    print(f"[Invalidation] No se pudo avisar a {target}: {e}")
+        finally:
+            sender.close()
+
+
+class PostgresBackend:
+    """LISTEN/NOTIFY de PostgreSQL: una conexión dedicada escucha; publicar es un pg_notify()."""
+    name = 'postgres'
+    distributed = True
+    max_payload_bytes = 7999 # NOTIFY rechaza payloads de 8000 bytes o más
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def start(self, deliver):
+        socketio.start_background_task(self._listen, deliver)
+
+    def _listen(self, deliver):
+        select = _green('select')
+        while True:
+            try:
+                # Conexión DBAPI (psycopg2) propia, fuera del pool, en modo autocommit
+                with app.app_context():
+                    raw = db.engine.raw_connection()
+                conn = raw.driver_connection
+                raw.detach()
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN "{self.channel}"')
+                print(f"[Invalidation] Escuchando avisos en el canal Postgres '{self.channel}'.")
+                while True:
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue # Timeout: volver a esperar
+                    conn.poll()
+                    while conn.notifies:
+                        deliver(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"[Invalidation] Conexión LISTEN perdida ({e}). Reintentando en 2s...")
+                socketio.sleep(2)
+
+    def send(self, payload):
+        with db.engine.connect() as connection:
+            connection.execute(text('SELECT pg_notify(:channel, :payload)'),
+                               {'channel': self.channel, 'payload': payload})
+            connection.commit()
+
+
+# --- Bus ---
+
+class InvalidationBus:
+
+    # Versiones recordadas por origen para descartar avisos repetidos. Un duplicado más antiguo que
+    # la ventana se volvería a aplicar, lo que es inocuo: los handlers solo descartan o añaden con control de seq.
+    SEEN_WINDOW = 4096
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.origin = uuid.uuid4().hex[:12]
+        self._version = 0
+        self._seen = {} # origen -> (set, deque) de las últimas SEEN_WINDOW versiones aplicadas
+        self._handlers = defaultdict(list) # entidad -> [handler(key), ...]
+        self._lock = threading.Lock()
+        self._started = False
+        self.published = 0
+        self.received = 0
+        self.ignored = 0
+
+    @property
+    def distributed(self):
+        return self.backend.distributed
+
+    @property
+    def max_payload_bytes(self):
+        """Tamaño máximo de un aviso serializado (None si el backend no envía nada)."""
+        return self.backend.max_payload_bytes
+
+    def subscribe(self, entity, handler):
+        """Registra handler(key) para los avisos de 'entity' que lleguen de OTROS procesos."""
+        self._handlers[entity].append(handler)
+
+    def publish(self, entity, key=None):
+        """
+        Avisa al resto de procesos de que 'entity'/'key' cambió. NO ejecuta los handlers locales:
+        quien publica debe haber actualizado ya sus propias cachés.
+        """
+        if not self.backend.distributed:
+            return
+        with self._lock:
+            self._version += 1
+            notice = {'o': self.origin, 'v': self._version, 'e': entity, 'k': key}
+        try:
+            self.backend.send(json.dumps(notice))
+            self.published += 1
+        except Exception as e:
+            # Las cachés del resto de procesos caducarán por TTL; no romper la petición del admin
+            print(f"[Invalidation] Error publicando aviso {entity}:{key}: {e}")
+
+    def _deliver(self, payload):
+        try:
+            notice = json.loads(payload)
+            origin, version = notice['o'], notice['v']
+        except (ValueError, KeyError, TypeError):
+            print(f"[Invalidation] Aviso mal formado ignorado: {payload!r}")
+            return
+        with self._lock:
+            # Solo se descartan los propios y los duplicados exactos: publish() envía fuera del lock,
+            # así que avisos de entidades distintas pueden llegar en otro orden y todos deben aplicarse.
+            if origin == self.origin:
+                self.ignored += 1
+                return
+            seen, order = self._seen.setdefault(origin, (set(), deque()))
+            if version in seen:
+                self.ignored += 1
+                return
+            seen.add(version)
+            order.append(version)
+            if len(order) > self.SEEN_WINDOW:
+                seen.discard(order.popleft())
+            self.received += 1
+        with app.app_context():
+            for handler in self._handlers.get(notice['e'], []):
+                try:
+                    handler(notice['k'])
+                except Exception as e:
+                    print(f"[Invalidation] Error aplicando aviso {notice['e']}:{notice['k']}: {e}")
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        self.backend.start(self._deliver)
+        print(f"[Invalidation] Bus iniciado (backend '{self.backend.name}', origen {self.origin}).")
+
+    def stats(self):
+        return {
+            'backend': self.backend.name,
+            'origin': self.origin,
+            'published': self.published,
+            'received': self.received,
+            'ignored': self.ignored,
+            'known_origins': len(self._seen),
+        }
+
+
+def _create_backend():
+    kind = app.config['INVALIDATION_BACKEND']
+    if kind == 'unix':
+        return UnixSocketBackend(app.config['INVALIDATION_SOCKET_DIR'])
+    if kind == 'postgres':
+        return PostgresBackend(app.config['INVALIDATION_PG_CHANNEL'])
+    if kind != 'local':
+        print(f"[Invalidation] Backend desconocido '{kind}', usando 'local'.")
+    return LocalBackend()
+
+
+# Instancia global (una por proceso)
+invalidation_bus = InvalidationBus(_create_backend())
@@ -0,0 +1,111 @@
+# app/leader.py
+"""
+Elección de líder para el scheduler mediante un "lease" (candado con caducidad) en la BBDD.
+
+Cada proceso que importa 'app' arranca APScheduler, así que con varios workers de gunicorn
+(o el proceso 'clock') todos ejecutarían delete_old_messages a la vez. Con el lease:
+
+- Solo el proceso que posee la fila 'scheduler' de SchedulerLease (y no caducada) ejecuta las tareas.
+- El líder renueva el lease cada SCHEDULER_LEASE_TTL_SECONDS / 3 segundos.
+- Si el líder muere, su lease caduca y el siguiente proceso que intente renovarlo se convierte en líder.
+
+La adquisición es un único UPDATE condicional (o INSERT si la fila no existe), por lo que
+dos procesos nunca pueden creerse líderes a la vez mientras sus relojes estén razonablemente sincronizados.
+"""
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from sqlalchemy import insert, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.models import SchedulerLease
+
+
+class SchedulerLeader:
+    """Gestiona el lease 'name' para este proceso."""
+
+    def __init__(self, name, ttl_seconds):
+        self.name = name
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+
+    def try_acquire(self):
+        """
+        Intenta tomar o renovar el lease. Devuelve True si este proceso es el líder.
+        Necesita contexto de aplicación.
+        """
+        lease_table = SchedulerLease.__table__
+        now = datetime.now(timezone.utc)
+        try:
+            # Renovar si ya es nuestro, o robarlo si ha caducado
+            result = db.session.execute(
+                update(lease_table)
+                .where(lease_table.c.name == self.name)
+                .where(or_(lease_table.c.holder == self.holder, lease_table.c.expires_at < now))
+                .values(holder=self.holder, expires_at=now + self.ttl)
+            )
+            acquired = result.rowcount == 1
+            if not acquired:
+                # ¿No existe la fila todavía? Crearla (si otro proceso se adelanta, falla por clave primaria)
+                exists = db.session.query(lease_table.c.name).filter(lease_table.c.name == self.name).first()
+                if exists is None:
+                    db.session.execute(insert(lease_table).values(name=self.name, holder=self.holder,
+                                                                  expires_at=now + self.ttl))
+                    acquired = True
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            acquired = False
+        except Exception as e:
+            db.session.rollback()
+            print(f"[Leader] Error al renovar el lease '{self.name}': {e}")
+            acquired = False
+
+        if acquired != self.is_leader:
+            print(f"[Leader] {self.holder} {'ES AHORA' if acquired else 'YA NO ES'} líder del scheduler.")
+        self.is_leader = acquired
+        return acquired
+
+    def renew(self):
+        """Tarea periódica del scheduler: mantiene (o intenta conseguir) el lease."""
+        with app.app_context():
+            self.try_acquire()
+
+    def release(self):
+        """Libera el lease si es nuestro (al apagar el proceso) para que otro lo tome sin esperar al TTL."""
+        if not self.is_leader:
+            return
+        lease_table = SchedulerLease.__table__
+        with app.app_context():
+            try:
+                db.session.execute(
+                    update(lease_table)
+                    .where(lease_table.c.name == self.name, lease_table.c.holder == self.holder)
+                    .values(expires_at=datetime.now(timezone.utc))
+                )
+                db.session.commit()
+                print(f"[Leader] Lease '{self.name}' liberado por {self.holder}.")
+            except Exception as e:
+                db.session.rollback()
+                print(f"[Leader] Error al liberar el lease '{self.name}': {e}")
+        self.is_leader = False
+
+    def only_leader(self, func):
+        """Decorador para tareas programadas: solo se ejecutan si este proceso es (o pasa a ser) el líder."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with app.app_context():
+                if not self.try_acquire():
+                    print(f"[Leader] Tarea '{func.__name__}' omitida: este proceso no es el líder.")
+                    return None
+            return func(*args, **kwargs)
+        return wrapper
+
+
+# Instancia global (una por proceso)
+scheduler_leader = SchedulerLeader('scheduler', app.config['SCHEDULER_LEASE_TTL_SECONDS'])
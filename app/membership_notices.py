@@ -0,0 +1,151 @@
+# app/membership_notices.py
+"""
+Avisos de sistema de altas y bajas de miembros ("X se ha unido.") agrupados por canal.
+
+Antes cada unión/salida (find_channel_info, attempt_join, join_channel_with_password,
+self_leave_channel) emitía su propio 'new_message' a toda la sala: tras un despliegue, cientos de
+usuarios volviendo a unirse eran cientos de avisos para cada cliente (O(N²) paquetes).
+Ahora se acumulan por canal y cada MEMBERSHIP_NOTICE_WINDOW_MS se emite como mucho UN aviso:
+
+    "ana se ha unido."  /  "ana, luis y eva se han unido."  /  "12 usuarios se han unido."
+
+- Quien se une y sale (o al revés) dentro del mismo intervalo no se anuncia.
+- En salas con MEMBERSHIP_NOTICE_BUSY_ROOM o más conexiones (presence.room_size, en memoria) se emite
+  como mucho un aviso (solo con el número de usuarios) cada MEMBERSHIP_NOTICE_BUSY_INTERVAL_SECONDS; los
+  cambios de mientras se van sumando.
+- Cada worker agrupa los cambios de sus propios clientes.
+
+La entrada/salida de la sala de un canal ya abierto no genera avisos (ver app/presence.py).
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from app import app, db, socketio
+from app.broadcast import broadcast_system_message
+from app.presence import presence
+
+
+class MembershipNotices:
+
+    def __init__(self, window_ms, max_names, busy_room, busy_interval_seconds):
+        self.window = max(100, window_ms) / 1000.0
+        self.max_names = max_names
+        self.busy_room = busy_room
+        self.busy_interval = busy_interval_seconds
+        self._joined = {} # channel_id -> {username: None} (dict para conservar el orden)
+        self._left = {} # channel_id -> {username: None}
+        self._held = {} # channel_id -> [unidos, salidos] acumulados en salas concurridas
+        self._last_busy_notice = {} # channel_id -> último aviso en sala concurrida (monotonic)
+        self._lock = threading.Lock()
+        self._started = False
+        self.events = 0
+        self.notices = 0
+        self.held_back = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run)
+
+    # --- Altas y bajas (llamadas desde events.py) ---
+
+    def joined(self, channel_id, username):
+        self._record(channel_id, username, self._joined, self._left)
+
+    def left(self, channel_id, username):
+        self._record(channel_id, username, self._left, self._joined)
+
+    def _record(self, channel_id, username, pending, opposite):
+        self._ensure_started()
+        with self._lock:
+            self.events += 1
+            cancelled = opposite.get(channel_id)
+            if cancelled and username in cancelled:
+                del cancelled[username] # Cambio contrario en el mismo intervalo: no anunciar ninguno
+            else:
+                pending.setdefault(channel_id, {})[username] = None
+
+    # --- Envío ---
+
+    def _describe(self, usernames, count, singular, plural):
+        """Texto de un grupo: nombres si son pocos (y se conocen), si no el número de usuarios."""
+        if usernames and count <= self.max_names:
+            if count == 1:
+                return f'{usernames[0]} {singular}'
+            return f"{', '.join(usernames[:-1])} y {usernames[-1]} {plural}"
+        if count == 1:
+            return f'1 usuario {singular}'
+        return f'{count} usuarios {plural}'
+
+    def _body(self, joined, joined_count, left, left_count):
+        parts = []
+        if joined_count:
+            parts.append(self._describe(joined, joined_count, 'se ha unido', 'se han unido'))
+        if left_count:
+            parts.append(self._describe(left, left_count, 'ha salido del canal', 'han salido del canal'))
+        return '; '.join(parts) + '.'
+
+    def flush(self):
+        """Emite los avisos pendientes (uno por canal). Necesita contexto de aplicación."""
+        with self._lock:
+            joined, self._joined = self._joined, {}
+            left, self._left = self._left, {}
+        now = time.monotonic()
+        for channel_id in set(joined) | set(left) | set(self._held):
+            joined_names = list(joined.get(channel_id, ()))
+            left_names = list(left.get(channel_id, ()))
+            held = self._held.get(channel_id)
+            if held is None and presence.room_size(channel_id) < self.busy_room:
+                if joined_names or left_names:
+                    self._emit(channel_id, self._body(joined_names, len(joined_names), left_names, len(left_names)))
+                continue
+            # Sala concurrida: acumular y avisar solo con el número de usuarios cada busy_interval
+            held = self._held.setdefault(channel_id, [0, 0])
+            held[0] += len(joined_names)
+            held[1] += len(left_names)
+            if now - self._last_busy_notice.get(channel_id, 0) < self.busy_interval:
+                self.held_back += len(joined_names) + len(left_names)
+                continue
+            del self._held[channel_id]
+            if held[0] or held[1]:
+                self._last_busy_notice[channel_id] = now
+                self._emit(channel_id, self._body(None, held[0], None, held[1]))
+        # Olvidar salas que ya no están concurridas
+        for channel_id in [c for c, sent in self._last_busy_notice.items() if now - sent >= self.busy_interval and c not in self._held]:
+            del self._last_busy_notice[channel_id]
+
+    def _emit(self, channel_id, body):
+        self.notices += 1
+        broadcast_system_message(channel_id, body, datetime.now(timezone.utc))
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.window)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception as e: # El bucle nunca debe morir
+                db.session.rollback()
+                print(f"[MembershipNotices] Error emitiendo avisos de altas/bajas: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_channels': len(set(self._joined) | set(self._left)),
+                'busy_channels': len(self._held),
+                'events': self.events,
+                'notices': self.notices,
+                'held_back': self.held_back,
+            }
+
+
+# Instancia global (una por proceso)
+membership_notices = MembershipNotices(
+    window_ms=app.config['MEMBERSHIP_NOTICE_WINDOW_MS'],
+    max_names=app.config['MEMBERSHIP_NOTICE_MAX_NAMES'],
+    busy_room=app.config['MEMBERSHIP_NOTICE_BUSY_ROOM'],
+    busy_interval_seconds=app.config['MEMBERSHIP_NOTICE_BUSY_INTERVAL_SECONDS']
+)
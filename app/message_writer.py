@@ -0,0 +1,224 @@
+# app/message_writer.py
+"""
+Escritura agrupada (group commit) de los mensajes enviados por socket.
+
+Sin agrupar, cada send_message hace su propio INSERT + COMMIT (y su fsync) antes de emitir,
+así que los commits limitan los mensajes por segundo. Con MESSAGE_WRITE_BATCHING activado,
+handle_send_message solo encola el mensaje y un proceso en segundo plano:
+
+1. Espera como mucho MESSAGE_WRITE_BATCH_MAX_DELAY_MS desde el primer mensaje pendiente
+   (o hasta juntar MESSAGE_WRITE_BATCH_MAX_SIZE mensajes).
+2. Reserva los 'seq' de cada canal y escribe todo el lote con UN INSERT multi-fila y UN COMMIT.
+3. Con los ids devueltos (RETURNING) emite 'new_message' a la sala de cada mensaje.
+
+Los contadores (stats()) cubren también la escritura directa (un commit por mensaje),
+así que /admin/stats permite comparar mensajes por commit y por segundo de BBDD en ambos modos.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import insert
+
+from app import app, db, socketio
+from app.broadcast import broadcast_message
+from app.history import note_new_messages, serialize_message
+from app.models import Message, allocate_channel_seq
+from app.rate_limit import rate_limiter
+
+
+class _PendingMessage:
+    """Mensaje validado a la espera de ser escrito en el siguiente lote."""
+    __slots__ = ('channel_id', 'user_id', 'username', 'body', 'message_type', 'timestamp', 'sid')
+
+    def __init__(self, channel_id, user_id, username, body, message_type, sid):
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.username = username
+        self.body = body
+        self.message_type = message_type
+        self.timestamp = datetime.now(timezone.utc) # Hora de llegada, no la del commit
+        self.sid = sid
+
+
+class MessageWriter:
+    """
+    Cola de mensajes pendientes + tarea en segundo plano que los escribe en lotes.
+    La tarea se arranca con socketio.start_background_task la primera vez que se encola algo,
+    y la cola/esperas son las del modo async de Socket.IO (eventlet en producción).
+    """
+
+    def __init__(self, max_batch_size, max_delay_ms):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max(0, max_delay_ms) / 1000.0
+        self._queue = None
+        self._queue_empty = None
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # Contadores acumulados por modo: 'batched' (este writer) y 'direct' (un commit por mensaje)
+        self._counters = {
+            mode: {'messages': 0, 'commits': 0, 'failed_messages': 0, 'retried_batches': 0, 'db_seconds': 0.0, 'largest_batch': 0}
+            for mode in ('batched', 'direct')
+        }
+
+    # --- Encolar ---
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._started:
+                return
+            eio = socketio.server.eio
+            self._queue = eio.create_queue()
+            self._queue_empty = eio.get_queue_empty_exception()
+            socketio.start_background_task(self._run)
+            self._started = True
+            print(f"MessageWriter iniciado (lote máx {self.max_batch_size}, espera máx {self.max_delay * 1000:.0f} ms)")
+
+    def submit(self, channel_id, user_id, username, body, message_type, sid):
+        """Encola un mensaje ya validado. Se emitirá a la sala cuando su lote haga commit."""
+        self._ensure_started()
+        self._queue.put(_PendingMessage(channel_id, user_id, username, body, message_type, sid))
+
+    # --- Bucle en segundo plano ---
+
+    def _collect_batch(self):
+        batch = [self._queue.get()] # Bloquea hasta que llegue el primer mensaje
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait()) # Vaciar lo que ya esté esperando
+            except self._queue_empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                with app.app_context():
+                    self.flush(batch)
+            except Exception as e: # El bucle nunca debe morir: se pierde este lote, no los siguientes
+                print(f"[MessageWriter] Error inesperado procesando lote de {len(batch)} mensajes: {e}")
+
+    # --- Escritura del lote ---
+
+    def flush(self, batch):
+        """
+        Escribe un lote con un INSERT multi-fila y un COMMIT, y emite cada mensaje a su sala.
+        Si el lote falla se reintenta mensaje a mensaje: solo el autor del que falle recibe el error.
+        """
+        started = time.perf_counter()
+        try:
+            connection = db.session.connection()
+            # Reservar los 'seq' de cada canal de una vez (un UPDATE por canal del lote)
+            per_channel = {}
+            for pending in batch:
+                per_channel[pending.channel_id] = per_channel.get(pending.channel_id, 0) + 1
+            next_seq = {}
+            for channel_id, count in per_channel.items():
+                next_seq[channel_id] = allocate_channel_seq(connection, channel_id, count) - count + 1
+
+            rows = []
+            for pending in batch:
+                rows.append({
+                    'body': pending.body,
+                    'timestamp': pending.timestamp,
+                    'user_id': pending.user_id,
+                    'channel_id': pending.channel_id,
+                    'message_type': pending.message_type,
+                    'is_pinned': False,
+                    'seq': next_seq[pending.channel_id],
+                })
+                next_seq[pending.channel_id] += 1
+
+            # sort_by_parameter_order garantiza que los ids vuelven en el mismo orden que 'rows'
+            result = db.session.execute(
+                insert(Message).returning(Message.id, sort_by_parameter_order=True), rows
+            )
+            ids = result.scalars().all()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) > 1:
+                # Un mensaje que falla no debe tumbar el lote: reintentar uno a uno y avisar solo a su autor
+                self._record('batched', 0, time.perf_counter() - started, retried=True)
+                print(f"[MessageWriter] Error al guardar lote de {len(batch)} mensajes ({e}). Reintentando uno a uno.")
+                for pending in batch:
+                    self.flush([pending])
+                return
+            self._record('batched', 0, time.perf_counter() - started, failed=1)
+            print(f"[MessageWriter] Error al guardar el mensaje de {batch[0].username} en el canal {batch[0].channel_id}: {e}")
+            rate_limiter.release_slow_mode(batch[0].user_id, batch[0].channel_id) # No cuenta para el modo lento
+            socketio.emit('error', {'message': 'Error interno al procesar tu mensaje.'}, to=batch[0].sid)
+            return
+
+        self._record('batched', len(batch), time.perf_counter() - started)
+
+        written = [
+            (pending.channel_id, serialize_message(
+                _WrittenMessage(message_id, row), username=pending.username, channel_id=pending.channel_id
+            ))
+            for pending, row, message_id in zip(batch, rows, ids)
+        ]
+        note_new_messages(written) # Un aviso por lote al resto de procesos, no uno por mensaje
+        for channel_id, message_data in written:
+            broadcast_message(message_data, channel_id)
+
+    # --- Métricas ---
+
+    def _record(self, mode, messages, elapsed, failed=0, retried=False):
+        with self._stats_lock:
+            counters = self._counters[mode]
+            counters['messages'] += messages
+            counters['failed_messages'] += failed
+            counters['retried_batches'] += int(retried)
+            counters['db_seconds'] += elapsed
+            if messages:
+                counters['commits'] += 1
+                counters['largest_batch'] = max(counters['largest_batch'], messages)
+
+    def record_direct_write(self, elapsed):
+        """Registra una escritura directa (sin agrupar) para poder comparar ambos modos."""
+        self._record('direct', 1, elapsed)
+
+    def stats(self):
+        with self._stats_lock:
+            result = {
+                'enabled': app.config['MESSAGE_WRITE_BATCHING'],
+                'max_batch_size': self.max_batch_size,
+                'max_delay_ms': self.max_delay * 1000,
+                'queued': self._queue.qsize() if self._queue is not None else 0,
+            }
+            for mode, counters in self._counters.items():
+                data = dict(counters)
+                data['db_seconds'] = round(counters['db_seconds'], 4)
+                data['messages_per_commit'] = round(counters['messages'] / counters['commits'], 2) if counters['commits'] else 0
+                data['messages_per_db_second'] = round(counters['messages'] / counters['db_seconds'], 1) if counters['db_seconds'] else 0
+                result[mode] = data
+            return result
+
+
+class _WrittenMessage:
+    """Vista mínima de una fila recién insertada con los atributos que usa serialize_message."""
+    __slots__ = ('id', 'body', 'timestamp', 'user_id', 'message_type', 'is_pinned', 'seq')
+
+    def __init__(self, message_id, row):
+        self.id = message_id
+        self.body = row['body']
+        self.timestamp = row['timestamp']
+        self.user_id = row['user_id']
+        self.message_type = row['message_type']
+        self.is_pinned = row['is_pinned']
+        self.seq = row['seq']
+
+
+# Instancia global (una por proceso)
+message_writer = MessageWriter(
+    max_batch_size=app.config['MESSAGE_WRITE_BATCH_MAX_SIZE'],
+    max_delay_ms=app.config['MESSAGE_WRITE_BATCH_MAX_DELAY_MS']
+)
@@ -2,19 +2,23 @@ from datetime import datetime, timezone # Usamos timezone para asegurar UTC
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin # Mixin especial para modelos de usuario con Flask-Login
 from app import db, login # Importamos la instancia db y login desde app/__init__.py
-from sqlalchemy import Index # Importamos Index para definir índices personalizados
+from sqlalchemy import Index, event, update # Index para índices personalizados; event/update para la secuencia por canal
 
 # --- User Loader para Flask-Login ---
 # Flask-Login necesita saber cómo cargar un usuario dado su ID (que almacena en la sesión).
 # Este decorador registra la función 'load_user' con Flask-Login.
 @login.user_loader
 def load_user(id):
-    # Convierte el ID (que viene como string de la sesión) a entero y busca en la BBDD.
-    return User.query.get(int(id))
+    # Convierte el ID (que viene como string de la sesión) a entero y lo busca en la caché de
+    # identidades (ver app/identity.py): sin consulta salvo la primera vez o tras un cambio.
+    from app.identity import identity_cache # Importar aquí para evitar importación circular
+    return identity_cache.get(int(id))
 
 channel_members = db.Table('channel_members',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('channel_id', db.Integer, db.ForeignKey('channel.id'), primary_key=True)
+    db.Column('channel_id', db.Integer, db.ForeignKey('channel.id'), primary_key=True),
+    # Último Message.seq del canal que el usuario ha visto (contador de no leídos, ver app/sidebar.py)
+    db.Column('last_read_seq', db.Integer, default=0, nullable=False, server_default='0')
 )
 
 # --- Modelo User ---
@@ -73,6 +77,12 @@ class Channel(db.Model):
     is_writable = db.Column(db.Boolean, default=True, nullable=False) # Control admin para permitir/denegar mensajes
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc)) # Fecha creación (UTC)
     requires_approval = db.Column(db.Boolean, default=False, nullable=False)
+    # Último número de secuencia asignado a un mensaje de este canal (ver Message.seq)
+    last_seq = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    # Minutos que se conservan los mensajes del canal. None = valor global (MESSAGE_RETENTION_MINUTES)
+    retention_minutes = db.Column(db.Integer, nullable=True)
+    # Modo lento: segundos mínimos entre dos mensajes de un mismo usuario. None/0 = sin límite
+    slow_mode_seconds = db.Column(db.Integer, nullable=True)
     # Relación uno-a-muchos con Message: Un canal contiene muchos mensajes.
     # cascade='all, delete-orphan' significa que si se borra un canal, se borran todos sus mensajes.
     messages = db.relationship('Message', backref='channel', lazy='dynamic', cascade='all, delete-orphan')
@@ -129,11 +139,45 @@ class Message(db.Model):
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=False) # Dónde se envió (Clave foránea a Channel.id)
     message_type = db.Column(db.String(10), default='text', nullable=False) # 'text', 'image', 'sticker', 'system'
     is_pinned = db.Column(db.Boolean, default=False, nullable=False) # Para mensajes fijados por admin/mod
+    # Número de secuencia dentro del canal (1, 2, 3...). Lo asigna _assign_channel_seq al insertar.
+    # El cliente recuerda el último que vio y al reconectar solo pide los posteriores (delta sync).
+    seq = db.Column(db.Integer, nullable=True)
+
+    # Índice compuesto para la paginación por cursor del historial (ver app/history.py):
+    # permite servir "los N más recientes" o "los N anteriores a X" sin recorrer todo el canal.
+    # El índice único (channel_id, seq) sirve la sincronización "mensajes con seq > X".
+    __table_args__ = (
+        Index('ix_message_channel_timestamp_id', 'channel_id', 'timestamp', 'id'),
+        Index('ix_message_channel_seq', 'channel_id', 'seq', unique=True),
+    )
 
     def __repr__(self):
         return f'<Message {self.id} ({self.message_type}) in C:{self.channel_id} by U:{self.user_id}>'
 
 
+def allocate_channel_seq(connection, channel_id, count=1):
+    """
+    Reserva 'count' números de secuencia consecutivos para un canal y devuelve el ÚLTIMO.
+    El UPDATE ... RETURNING es atómico: bloquea la fila del canal hasta el commit,
+    así dos mensajes simultáneos nunca reciben el mismo número.
+    """
+    channel_table = Channel.__table__
+    return connection.execute(
+        update(channel_table)
+        .where(channel_table.c.id == channel_id)
+        .values(last_seq=channel_table.c.last_seq + count)
+        .returning(channel_table.c.last_seq)
+    ).scalar_one()
+
+
+@event.listens_for(Message, 'before_insert')
+def _assign_channel_seq(mapper, connection, target):
+    # Se ejecuta dentro del flush, en la misma transacción que el INSERT del mensaje
+    if target.seq is None:
+        channel_id = target.channel_id if target.channel_id is not None else target.channel.id
+        target.seq = allocate_channel_seq(connection, channel_id)
+
+
 # --- Modelos Adicionales (Añadir más tarde cuando se implementen) ---
 
 class Sticker(db.Model):
@@ -192,4 +236,32 @@ class Setting(db.Model): # Para ajustes globales como el cierre del sitio
     key = db.Column(db.String(50), unique=True, nullable=False, index=True) # ej: 'site_closed'
     value = db.Column(db.String(255)) # ej: 'True' / 'False'
     def __repr__(self):
-        return f'<Setting {self.key}={self.value}>'
\ No newline at end of file
+        return f'<Setting {self.key}={self.value}>'
+
+# --- Modelo SchedulerLease ---
+# Fila de "candado" con caducidad para elegir UN solo proceso que ejecute las tareas programadas
+# (ver app/leader.py). El líder renueva expires_at periódicamente; si muere, otro la toma al caducar.
+class SchedulerLease(db.Model):
+    name = db.Column(db.String(50), primary_key=True) # ej: 'scheduler'
+    holder = db.Column(db.String(128), nullable=False) # Identificador del proceso líder (host:pid:aleatorio)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    def __repr__(self):
+        return f'<SchedulerLease {self.name} holder={self.holder} expires={self.expires_at}>'
+
+# --- Modelo ChannelPresence ---
+# Quién está conectado ahora mismo en la sala de cada canal (una fila por sid y canal), compartido
+# entre workers (ver app/presence.py). Cada proceso renueva last_seen de sus filas periódicamente;
+# las de un proceso caído caducan solas.
+class ChannelPresence(db.Model):
+    sid = db.Column(db.String(64), primary_key=True) # SID de Socket.IO
+    channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    worker = db.Column(db.String(64), nullable=False, index=True) # Proceso que atiende la conexión
+    last_seen = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_channel_presence_channel_last_seen', 'channel_id', 'last_seen'),
+    )
+
+    def __repr__(self):
+        return f'<ChannelPresence U:{self.user_id} en C:{self.channel_id} ({self.sid} @ {self.worker})>'
@@ -0,0 +1,206 @@
+# app/moderation.py
+"""
+Caché en memoria (por proceso) del estado de moderación: bans y mutes activos de cada usuario.
+
+Antes, cada send_message hacía una consulta de Ban y otra de Mute, y cada petición HTTP y cada
+conexión de socket consultaban el ban global. Ahora:
+
+- La primera vez que se pregunta por un usuario se cargan TODOS sus bans/mutes activos
+  (2 consultas) y se guardan como registros simples (_Sanction), sin objetos ORM.
+- Las siguientes comprobaciones no tocan la BBDD.
+- Un min-heap con los expires_at descarta cada sanción justo cuando caduca.
+- admin_apply_ban/admin_apply_mute actualizan la caché al momento (set_sanction) y los borrados
+  de usuario/canal eliminan sus entradas (invalidate_user / invalidate_channel).
+- Los cambios hechos en otros procesos llegan por el bus de invalidación (app/invalidation.py);
+  por si se pierde algún aviso, cada usuario se recarga como muy tarde a los MODERATION_CACHE_TTL_SECONDS.
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from app import app
+from app.invalidation import invalidation_bus
+from app.models import Ban, Mute
+
+KINDS = {'ban': Ban, 'mute': Mute}
+
+
+class _Sanction:
+    """Copia mínima de un Ban/Mute (mismos atributos que usan events.py y routes.py)."""
+    __slots__ = ('id', 'user_id', 'channel_id', 'reason', 'expires_at')
+
+    def __init__(self, id, user_id, channel_id, reason, expires_at):
+        self.id = id
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.reason = reason
+        # Normalizar a UTC "aware" (SQLite devuelve datetimes naive)
+        if expires_at is not None and expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls(obj.id, obj.user_id, obj.channel_id, obj.reason, obj.expires_at)
+
+    def is_active(self, now):
+        return self.expires_at is None or self.expires_at > now
+
+
+class _UserModeration:
+    __slots__ = ('sanctions', 'loaded_at')
+
+    def __init__(self):
+        self.sanctions = {'ban': {}, 'mute': {}} # kind -> {channel_id (None = global): _Sanction}
+        self.loaded_at = time.monotonic()
+
+
+class ModerationCache:
+
+    def __init__(self, max_users, ttl_seconds):
+        self.max_users = max_users
+        self.ttl = ttl_seconds
+        self._users = OrderedDict() # user_id -> _UserModeration (orden LRU)
+        self._expiry_heap = [] # (expires_at, user_id, kind, channel_id, sanction_id)
+        self._scheduled = set() # Entradas ya presentes en el heap (evita duplicados al recargar usuarios)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- Carga ---
+
+    def _load_user(self, user_id):
+        """Carga los bans y mutes activos del usuario (2 consultas). Se llama con el lock tomado."""
+        now = datetime.now(timezone.utc)
+        entry = _UserModeration()
+        for kind, model in KINDS.items():
+            rows = model.query.filter(model.user_id == user_id)\
+                              .filter((model.expires_at == None) | (model.expires_at > now))\
+                              .all()
+            for row in rows:
+                self._store(entry, kind, _Sanction.from_model(row))
+        self._users[user_id] = entry
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return entry
+
+    def _store(self, entry, kind, sanction):
+        entry.sanctions[kind][sanction.channel_id] = sanction
+        if sanction.expires_at is not None:
+            item = (sanction.expires_at, sanction.user_id, kind, sanction.channel_id, sanction.id)
+            if item not in self._scheduled:
+                self._scheduled.add(item)
+                heapq.heappush(self._expiry_heap, item)
+
+    def _purge_expired(self, now):
+        # Descartar las sanciones cuyo vencimiento ya pasó (las entradas obsoletas del heap se ignoran)
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            item = heapq.heappop(self._expiry_heap)
+            self._scheduled.discard(item)
+            _, user_id, kind, channel_id, sanction_id = item
+            entry = self._users.get(user_id)
+            if entry is None:
+                continue
+            sanction = entry.sanctions[kind].get(channel_id)
+            if sanction is not None and sanction.id == sanction_id and not sanction.is_active(now):
+                del entry.sanctions[kind][channel_id]
+
+    def _get_user(self, user_id, now):
+        self._purge_expired(now)
+        entry = self._users.get(user_id)
+        if entry is None or time.monotonic() - entry.loaded_at > self.ttl:
+            self.misses += 1
+            return self._load_user(user_id)
+        self.hits += 1
+        self._users.move_to_end(user_id)
+        return entry
+
+    # --- Consultas (hot path) ---
+
+    def active(self, kind, user_id, channel_id=None):
+        """
+        Sanción activa de tipo 'ban'/'mute' que afecta al usuario en 'channel_id' (o global si None).
+        Como las consultas originales, la de canal tiene prioridad sobre la global. None si no hay ninguna.
+        """
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            sanctions = self._get_user(user_id, now).sanctions[kind]
+            for key in ((channel_id, None) if channel_id is not None else (None,)):
+                sanction = sanctions.get(key)
+                if sanction is not None and sanction.is_active(now):
+                    return sanction
+        return None
+
+    def active_ban(self, user_id, channel_id=None):
+        return self.active('ban', user_id, channel_id)
+
+    def active_mute(self, user_id, channel_id=None):
+        return self.active('mute', user_id, channel_id)
+
+    def banned_channel_ids(self, user_id):
+        """IDs de canales con ban ESPECÍFICO activo para el usuario."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            sanctions = self._get_user(user_id, now).sanctions['ban']
+            return [cid for cid, s in sanctions.items() if cid is not None and s.is_active(now)]
+
+    # --- Actualización (panel de admin) ---
+
+    def set_sanction(self, kind, user_id, channel_id, obj):
+        """Refleja en la caché un Ban/Mute creado o actualizado (obj) o eliminado (obj=None)."""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return # No está en caché: se cargará de la BBDD cuando haga falta
+            if obj is None:
+                entry.sanctions[kind].pop(channel_id, None)
+            else:
+                self._store(entry, kind, _Sanction.from_model(obj))
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def invalidate_channel(self, channel_id):
+        """Quita las sanciones de un canal borrado de todos los usuarios en caché."""
+        with self._lock:
+            for entry in self._users.values():
+                entry.sanctions['ban'].pop(channel_id, None)
+                entry.sanctions['mute'].pop(channel_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._expiry_heap = []
+            self._scheduled.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'max_users': self.max_users,
+                'pending_expiries': len(self._expiry_heap),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Instancia global (una por proceso)
+moderation_cache = ModerationCache(
+    max_users=app.config['MODERATION_CACHE_MAX_USERS'],
+    ttl_seconds=app.config['MODERATION_CACHE_TTL_SECONDS']
+)
+
+
+def _on_moderation_changed(user_id):
+    # Aviso de otro proceso: user_id None = cambios que afectan a varios usuarios
+    if user_id is None:
+        moderation_cache.clear()
+    else:
+        moderation_cache.invalidate_user(user_id)
+
+
+invalidation_bus.subscribe('moderation', _on_moderation_changed)
+invalidation_bus.subscribe('channel_deleted', moderation_cache.invalidate_channel)
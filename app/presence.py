@@ -0,0 +1,294 @@
+# app/presence.py
+"""
+Presencia: quién está conectado ahora mismo en la sala de cada canal.
+
+En memoria (por proceso), con estructuras compactas:
+- sid -> _Connection(user_id, username, canales en cuya sala está)
+- channel_id -> {user_id: nº de sids de este proceso en la sala} (un usuario con dos pestañas cuenta una vez)
+
+Compartido entre workers: tabla ChannelPresence (una fila por sid y canal). Las altas y bajas se
+acumulan y se escriben juntas en cada flush (cada PRESENCE_FLUSH_INTERVAL_MS). Cada proceso renueva
+last_seen de sus filas cada PRESENCE_HEARTBEAT_SECONDS y las filas sin renovar en
+PRESENCE_TIMEOUT_SECONDS (proceso caído) se borran y dejan de contar. Si el commit falla, las
+altas/bajas y los diffs del intervalo vuelven a la cola para el siguiente flush.
+
+Tras escribir, el flush lee en UNA consulta quién está conectado (en cualquier worker) en los canales
+con conexiones en este proceso o con cambios, y guarda esa foto en memoria: online_members() y los
+diffs la usan sin consultar la BBDD (salvo el primer usuario de un canal en este proceso, que aún
+no está en la foto).
+
+En lugar de un mensaje de sistema por cada entrada/salida, cada flush emite a la sala UN
+'presence_diff' por canal con los cambios del intervalo (una entrada y salida dentro del mismo
+intervalo se anulan):
+
+    {'channel_id': 5, 'joined': [{'id': 3, 'username': 'ana'}], 'left': [7]}
+
+Un usuario solo aparece en 'left' si ya no le queda ninguna conexión en el canal en ningún worker.
+Al unirse a la sala, el cliente recibe la lista completa ('presence_state', ver online_members()).
+"""
+import atexit
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, insert, tuple_, update
+
+from app import app, db, socketio
+from app.invalidation import invalidation_bus
+from app.models import ChannelPresence, User
+
+
+class _Connection:
+    __slots__ = ('user_id', 'username', 'channels')
+
+    def __init__(self, user_id, username):
+        self.user_id = user_id
+        self.username = username
+        self.channels = set()
+
+
+class PresenceRegistry:
+
+    def __init__(self, flush_interval_ms, heartbeat_seconds, timeout_seconds):
+        self.flush_interval = max(100, flush_interval_ms) / 1000.0
+        self.heartbeat = heartbeat_seconds
+        self.timeout = timedelta(seconds=timeout_seconds)
+        self.worker = invalidation_bus.origin # Mismo identificador de proceso que el bus
+        self._connections = {} # sid -> _Connection
+        self._members = {} # channel_id -> {user_id: nº de sids de este proceso}
+        self._joined = {} # channel_id -> {user_id: username} pendientes de anunciar
+        self._left = {} # channel_id -> set(user_id) pendientes de anunciar
+        self._rows = {} # (sid, channel_id) -> user_id (alta) o None (baja) pendientes de escribir
+        self._shared = {} # channel_id -> {user_id: (username, nº de sids)} en todos los workers (foto del último flush)
+        self._last_heartbeat = 0.0
+        self._lock = threading.Lock()
+        self._started = False
+        self.diffs = 0
+        self.flushes = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run)
+        atexit.register(self._remove_own_rows)
+
+    # --- Eventos de conexión (llamados desde events.py) ---
+
+    def connect(self, sid, user_id, username):
+        self._ensure_started()
+        with self._lock:
+            self._connections[sid] = _Connection(user_id, username)
+
+    def disconnect(self, sid):
+        with self._lock:
+            conn = self._connections.pop(sid, None)
+            if conn is not None:
+                for channel_id in conn.channels:
+                    self._remove_member(sid, conn, channel_id)
+
+    def join(self, sid, channel_id):
+        with self._lock:
+            conn = self._connections.get(sid)
+            if conn is None or channel_id in conn.channels:
+                return
+            conn.channels.add(channel_id)
+            counts = self._members.setdefault(channel_id, {})
+            counts[conn.user_id] = counts.get(conn.user_id, 0) + 1
+            if counts[conn.user_id] == 1:
+                self._mark(channel_id, conn.user_id, conn.username)
+            self._rows[(sid, channel_id)] = conn.user_id
+
+    def leave(self, sid, channel_id):
+        with self._lock:
+            conn = self._connections.get(sid)
+            if conn is not None and channel_id in conn.channels:
+                conn.channels.discard(channel_id)
+                self._remove_member(sid, conn, channel_id)
+
+    def _remove_member(self, sid, conn, channel_id):
+        """Se llama con el lock tomado."""
+        counts = self._members.get(channel_id, {})
+        remaining = counts.get(conn.user_id, 1) - 1
+        if remaining > 0:
+            counts[conn.user_id] = remaining
+        else:
+            counts.pop(conn.user_id, None)
+            if not counts:
+                self._members.pop(channel_id, None)
+            self._mark(channel_id, conn.user_id, None)
+        self._rows[(sid, channel_id)] = None
+
+    def _mark(self, channel_id, user_id, username):
+        """Anota una entrada (username) o salida (None); si anula un cambio pendiente contrario, no se anuncia nada."""
+        if username is not None:
+            pending_left = self._left.get(channel_id)
+            if pending_left and user_id in pending_left:
+                pending_left.discard(user_id) # Salió y volvió a entrar en el mismo intervalo
+            else:
+                self._joined.setdefault(channel_id, {})[user_id] = username
+        else:
+            pending_joined = self._joined.get(channel_id)
+            if pending_joined and user_id in pending_joined:
+                del pending_joined[user_id] # Entró y salió en el mismo intervalo
+            else:
+                self._left.setdefault(channel_id, set()).add(user_id)
+
+    # --- Consultas ---
+
+    def _read_shared(self, channel_ids, now):
+        """Conectados en esos canales según ChannelPresence (todos los workers): {channel_id: {user_id: (username, sids)}}."""
+        shared = {channel_id: {} for channel_id in channel_ids}
+        if not channel_ids:
+            return shared
+        rows = db.session.query(ChannelPresence.channel_id, ChannelPresence.user_id, User.username,
+                                func.count(ChannelPresence.sid))\
+                         .join(User, User.id == ChannelPresence.user_id)\
+                         .filter(ChannelPresence.channel_id.in_(channel_ids),
+                                 ChannelPresence.last_seen > now - self.timeout)\
+                         .group_by(ChannelPresence.channel_id, ChannelPresence.user_id, User.username).all()
+        for channel_id, user_id, username, sids in rows:
+            shared[channel_id][user_id] = (username, sids)
+        return shared
+
+    def online_members(self, channel_id):
+        """Usuarios conectados en la sala del canal (todos los workers): [{'id', 'username'}] por nombre."""
+        with self._lock:
+            shared = self._shared.get(channel_id)
+        if shared is None:
+            # Primera conexión del canal en este proceso: aún no está en la foto del flush
+            shared = self._read_shared([channel_id], datetime.now(timezone.utc))[channel_id]
+        members = {user_id: username for user_id, (username, _) in shared.items()}
+        with self._lock:
+            # Añadir las conexiones de este proceso que aún no se han escrito en la BBDD
+            for sid, conn in self._connections.items():
+                if channel_id in conn.channels:
+                    members[conn.user_id] = conn.username
+        return [{'id': user_id, 'username': username}
+                for user_id, username in sorted(members.items(), key=lambda item: item[1].lower())]
+
+    def room_size(self, channel_id):
+        """Conexiones (sids) en la sala del canal en todos los workers, según la foto del último flush. Sin consultas."""
+        with self._lock:
+            shared = sum(sids for _, sids in self._shared.get(channel_id, {}).values())
+            local = sum(self._members.get(channel_id, {}).values())
+        return max(shared, local)
+
+    # --- Flush periódico ---
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception as e: # El bucle nunca debe morir
+                db.session.rollback()
+                print(f"[Presence] Error en el flush de presencia: {e}")
+
+    def flush(self):
+        """Escribe las altas/bajas pendientes, renueva el heartbeat y emite los diffs. Necesita contexto de aplicación."""
+        with self._lock:
+            rows, self._rows = self._rows, {}
+            joined, self._joined = self._joined, {}
+            left, self._left = self._left, {}
+            channel_ids = set(self._members) | set(joined) | set(left)
+        now = datetime.now(timezone.utc)
+        presence = ChannelPresence.__table__
+
+        try:
+            if rows:
+                db.session.execute(delete(presence).where(tuple_(presence.c.sid, presence.c.channel_id).in_(list(rows))))
+                added = [{'sid': sid, 'channel_id': channel_id, 'user_id': user_id, 'worker': self.worker, 'last_seen': now}
+                         for (sid, channel_id), user_id in rows.items() if user_id is not None]
+                if added:
+                    db.session.execute(insert(presence), added)
+            heartbeat = time.monotonic() - self._last_heartbeat >= self.heartbeat
+            if heartbeat:
+                db.session.execute(update(presence).where(presence.c.worker == self.worker).values(last_seen=now))
+                db.session.execute(delete(presence).where(presence.c.last_seen < now - self.timeout)) # Procesos caídos
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            self._requeue(rows, joined, left)
+            raise
+        if heartbeat:
+            self._last_heartbeat = time.monotonic()
+        self.flushes += 1
+
+        # Foto compartida de los canales de este proceso y de los que cambiaron (una consulta)
+        shared = self._read_shared(list(channel_ids), now)
+        with self._lock:
+            self._shared = shared
+
+        for channel_id in set(joined) | set(left):
+            # Quitar a quien sigue conectado en el canal desde otro worker
+            gone = left.get(channel_id, set()) - set(shared.get(channel_id, {}))
+            arrived = joined.get(channel_id, {})
+            if not arrived and not gone:
+                continue
+            self.diffs += 1
+            socketio.emit('presence_diff', {
+                'channel_id': channel_id,
+                'joined': [{'id': user_id, 'username': username} for user_id, username in arrived.items()],
+                'left': sorted(gone),
+            }, to=str(channel_id))
+
+    def _requeue(self, rows, joined, left):
+        """Devuelve a la cola un flush que no se pudo escribir; lo ocurrido después tiene prioridad."""
+        with self._lock:
+            newer_rows, newer_joined, newer_left = self._rows, self._joined, self._left
+            self._rows = dict(rows)
+            self._rows.update(newer_rows)
+            self._joined, self._left = joined, left
+            for channel_id, users in newer_joined.items():
+                for user_id, username in users.items():
+                    self._mark(channel_id, user_id, username)
+            for channel_id, user_ids in newer_left.items():
+                for user_id in user_ids:
+                    self._mark(channel_id, user_id, None)
+
+    def _remove_own_rows(self):
+        """Al apagar el proceso sus conexiones dejan de contar sin esperar a PRESENCE_TIMEOUT_SECONDS."""
+        with app.app_context():
+            try:
+                db.session.execute(delete(ChannelPresence.__table__).where(ChannelPresence.worker == self.worker))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[Presence] Error borrando la presencia de este proceso: {e}")
+
+    # --- Métricas ---
+
+    def _memory_bytes(self):
+        """Tamaño aproximado (sys.getsizeof) de las estructuras en memoria. Se llama con el lock tomado."""
+        total = sys.getsizeof(self._connections) + sys.getsizeof(self._members)
+        for sid, conn in self._connections.items():
+            total += sys.getsizeof(sid) + sys.getsizeof(conn) + sys.getsizeof(conn.channels)
+        for counts in self._members.values():
+            total += sys.getsizeof(counts)
+        return total
+
+    def stats(self):
+        with self._lock:
+            connections = len(self._connections)
+            memory = self._memory_bytes()
+            return {
+                'connections': connections,
+                'channels': len(self._members),
+                'memory_bytes': memory,
+                'bytes_per_connection': round(memory / connections) if connections else None,
+                'pending_rows': len(self._rows),
+                'flushes': self.flushes,
+                'diffs': self.diffs,
+            }
+
+
+# Instancia global (una por proceso)
+presence = PresenceRegistry(
+    flush_interval_ms=app.config['PRESENCE_FLUSH_INTERVAL_MS'],
+    heartbeat_seconds=app.config['PRESENCE_HEARTBEAT_SECONDS'],
+    timeout_seconds=app.config['PRESENCE_TIMEOUT_SECONDS']
+)
@@ -0,0 +1,157 @@
+# app/rate_limit.py
+"""
+Límite de frecuencia de los eventos Socket.IO (token bucket por usuario y evento) y modo lento por canal.
+
+- Cada (usuario, evento) de RATE_LIMITS tiene un cubo de 'burst' fichas que se rellena a 'rate'
+  fichas por segundo; cada evento gasta una. Sin fichas, el evento se rechaza ANTES de tocar la
+  BBDD: el decorador @rate_limited('evento') responde con 'rate_limited' (salvo en eventos
+  silenciosos como typing_started, que simplemente se descartan).
+- Modo lento (Channel.slow_mode_seconds, lo configura el admin al crear/editar el canal): cada
+  usuario puede enviar un mensaje por canal cada N segundos. Administradores y moderadores no
+  están limitados. El valor de cada canal se guarda en memoria (una consulta por canal) y se
+  invalida con el bus ('channel', 'channel_deleted').
+
+Todo es O(1) por evento. Los cubos se guardan por proceso: con varios workers el límite efectivo
+es por conexión/worker, suficiente para cortar ráfagas de un cliente.
+"""
+import threading
+import time
+from functools import wraps
+
+from flask import request
+from flask_login import current_user
+from flask_socketio import emit
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Channel
+
+
+class RateLimiter:
+
+    def __init__(self, limits, max_keys):
+        self.limits = limits # evento -> (fichas por segundo, ráfaga máxima)
+        self.max_keys = max_keys
+        self._buckets = {} # (user_id, evento) -> [fichas, último relleno (monotonic)]
+        self._slow_mode = {} # channel_id -> segundos (0 = sin modo lento)
+        self._next_message = {} # (user_id, channel_id) -> cuándo puede volver a escribir (monotonic)
+        self._lock = threading.Lock()
+        self.allowed = {}
+        self.shed = {} # evento (o 'slow_mode') -> rechazados
+
+    # --- Token bucket ---
+
+    def hit(self, user_id, event):
+        """Gasta una ficha. Devuelve 0 si se permite o los segundos hasta la siguiente ficha si se rechaza."""
+        limit = self.limits.get(event)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        now = time.monotonic()
+        key = (user_id, event)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._prune_buckets(now)
+                bucket = self._buckets[key] = [burst, now]
+            else:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed[event] = self.allowed.get(event, 0) + 1
+                return 0
+            self.shed[event] = self.shed.get(event, 0) + 1
+            return (1 - bucket[0]) / rate
+
+    def _prune_buckets(self, now):
+        """Olvida los cubos que ya estarían llenos (usuarios inactivos). Se llama con el lock tomado."""
+        for key, (tokens, last) in list(self._buckets.items()):
+            rate, burst = self.limits[key[1]]
+            if tokens + (now - last) * rate >= burst:
+                del self._buckets[key]
+
+    # --- Modo lento por canal ---
+
+    def slow_mode_seconds(self, channel_id):
+        seconds = self._slow_mode.get(channel_id)
+        if seconds is None:
+            seconds = db.session.query(Channel.slow_mode_seconds).filter(Channel.id == channel_id).scalar() or 0
+            self._slow_mode[channel_id] = seconds
+        return seconds
+
+    def check_slow_mode(self, user_id, channel_id):
+        """0 si el usuario puede escribir ya en el canal, si no los segundos que le faltan. No anota nada (ver record_slow_mode)."""
+        if not self.slow_mode_seconds(channel_id):
+            return 0
+        with self._lock:
+            wait = self._next_message.get((user_id, channel_id), 0) - time.monotonic()
+            if wait > 0:
+                self.shed['slow_mode'] = self.shed.get('slow_mode', 0) + 1
+                return wait
+            return 0
+
+    def record_slow_mode(self, user_id, channel_id):
+        """Mensaje aceptado (validado y guardado o encolado): el siguiente tendrá que esperar el modo lento."""
+        seconds = self.slow_mode_seconds(channel_id)
+        if not seconds:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._next_message) >= self.max_keys:
+                for old_key in [k for k, due in self._next_message.items() if due <= now]:
+                    del self._next_message[old_key]
+            self._next_message[(user_id, channel_id)] = now + seconds
+
+    def release_slow_mode(self, user_id, channel_id):
+        """El mensaje anotado no llegó a guardarse: el usuario puede volver a intentarlo ya."""
+        with self._lock:
+            self._next_message.pop((user_id, channel_id), None)
+
+    def invalidate_channel(self, channel_id):
+        self._slow_mode.pop(channel_id, None)
+
+    # --- Métricas ---
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked_buckets': len(self._buckets),
+                'slow_mode_channels': sum(1 for seconds in self._slow_mode.values() if seconds),
+                'allowed': dict(self.allowed),
+                'shed': dict(self.shed),
+            }
+
+
+# Instancia global (una por proceso)
+rate_limiter = RateLimiter(
+    limits=app.config['RATE_LIMITS'],
+    max_keys=app.config['RATE_LIMIT_MAX_KEYS']
+)
+
+invalidation_bus.subscribe('channel', rate_limiter.invalidate_channel)
+invalidation_bus.subscribe('channel_deleted', rate_limiter.invalidate_channel)
+
+
+def rate_limited(event, silent=False):
+    """
+    Decorador para handlers de Socket.IO: rechaza el evento si el usuario se quedó sin fichas.
+    'silent' = descartarlo sin avisar al cliente (eventos que se repiten solos, ej: typing_started).
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            if current_user.is_authenticated:
+                retry_after = rate_limiter.hit(current_user.id, event)
+                if retry_after:
+                    if not silent:
+                        emit('rate_limited', {
+                            'event': event,
+                            'retry_after': round(retry_after, 1),
+                            'message': 'Demasiadas peticiones seguidas. Espera un momento.'
+                        }, to=request.sid)
+                    return
+            return handler(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,6 +1,6 @@
 # --- app/routes.py ---
 
-from flask import render_template, flash, redirect, url_for, request, abort, jsonify
+from flask import render_template, flash, redirect, url_for, request, abort, jsonify, Response, stream_with_context
 from flask_login import login_user, logout_user, current_user, login_required
 from urllib.parse import urlparse # Para redirección segura
 from functools import wraps
@@ -13,11 +13,29 @@ import uuid
 
 # Importar instancias globales y modelos/formularios
 from app import app, db, socketio
-from app.models import User, Channel, Message, Mute, Ban, ChannelJoinRequest, channel_members, Setting, Sticker
+from app.models import User, Channel, Message, Mute, Ban, ChannelJoinRequest, channel_members, Sticker, ChannelPresence
 from app.forms import (
     LoginForm, CreateChannelForm, EditChannelForm,
-    CreateUserForm, EditUserRoleForm, MuteUserForm, BanUserForm, AdminUploadStickerForm 
+    CreateUserForm, EditUserRoleForm, MuteUserForm, BanUserForm, AdminUploadStickerForm,
+    load_channel_choices
 )
+from app.history import EXPORT_FORMATS, get_history_page, history_page_stats, note_new_message, recent_messages, serialize_message, stream_history
+from app.message_writer import message_writer
+from app.broadcast import broadcast_message, broadcast_system_message
+from app.typing_state import typing_aggregator
+from app.presence import presence
+from app.membership_notices import membership_notices
+from app.rate_limit import rate_limiter
+from app.backpressure import outbound_limiter
+from app.tasks import last_sweep_stats
+from app.expiry import message_expiry
+from app.moderation import moderation_cache
+from app.invalidation import invalidation_bus
+from app.settings import site_settings
+from app.dashboard import dashboard_counts, moderation_status, note_dashboard_counts_changed, page_of, parse_page
+from app.stickers import sticker_manifest
+from app.identity import identity_cache
+from app.sidebar import note_sidebar_changed, sidebar_cache
 
 
 # --- FUNCIÓN AUXILIAR PARA EXTENSIONES ---
@@ -47,9 +65,12 @@ def moderator_required(f):
 
 @app.before_request # <-- ASEGÚRATE DE QUE ESTE DECORADOR ESTÉ AQUÍ
 def before_request_checks():
+    # Los archivos estáticos no necesitan ningún check (ni cargar current_user)
+    if request.endpoint == 'static':
+        return None
+
     # --- Check Mantenimiento (Se ejecuta primero) ---
-    maint_setting = Setting.query.filter_by(key='site_closed').first()
-    is_site_closed = maint_setting.value.lower() == 'true' if maint_setting else False
+    is_site_closed = site_settings.get('site_closed') # Sin consulta: registro de ajustes en memoria
 
     allowed_while_closed = ['static', 'login', 'logout', 'maintenance_page', 'banned_page']
     is_admin_access = current_user.is_authenticated and current_user.is_admin
@@ -67,9 +88,7 @@ def before_request_checks():
 
     # Comprobar solo si está autenticado y el endpoint no es uno de los siempre permitidos
     if current_user.is_authenticated and request.endpoint not in allowed_endpoints_ban:
-        ban = Ban.query.filter_by(user_id=current_user.id, channel_id=None)\
-                       .filter((Ban.expires_at == None) | (Ban.expires_at > datetime.now(timezone.utc)))\
-                       .first()
+        ban = moderation_cache.active_ban(current_user.id) # Sin consulta: caché de moderación
         if ban:
             # Redirigir a la página de baneo (evitar bucle si ya está allí)
             if request.endpoint != 'banned_page':
@@ -85,8 +104,7 @@ def before_request_checks():
 @app.route('/maintenance') # <-- ¡AÑADIR ESTA LÍNEA!
 def maintenance_page():
     # Verificar si el sitio realmente está cerrado (por si alguien llega directo a la URL)
-    maint_setting = Setting.query.filter_by(key='site_closed').first()
-    is_site_closed = maint_setting.value.lower() == 'true' if maint_setting else False
+    is_site_closed = site_settings.get('site_closed')
     # Si el sitio está abierto Y no soy admin, redirigir a index
     if not is_site_closed and not (current_user.is_authenticated and current_user.is_admin):
         return redirect(url_for('index'))
@@ -101,9 +119,7 @@ def banned_page():
          return redirect(url_for('login')) # Si no está logueado, al login
 
     # Verificar si realmente tiene un ban global activo
-    ban = Ban.query.filter_by(user_id=current_user.id, channel_id=None)\
-                   .filter((Ban.expires_at == None) | (Ban.expires_at > datetime.now(timezone.utc)))\
-                   .first()
+    ban = moderation_cache.active_ban(current_user.id)
     if not ban:
          # Si no está baneado, fuera de aquí
          return redirect(url_for('index'))
@@ -119,46 +135,27 @@ def banned_page():
 @login_required
 def index():
     """Página principal - Muestra la interfaz de chat con los canales del usuario."""
-    now = datetime.now(timezone.utc) # Necesitamos la hora actual
     try:
-        # --- INICIO DEL BLOQUE A MODIFICAR / REEMPLAZAR ---
-
-        # Obtener IDs de los canales donde el usuario actual tiene un ban ACTIVO específico de canal
-        banned_channel_ids_query = db.session.query(Ban.channel_id).filter(
-            Ban.user_id == current_user.id,
-            Ban.channel_id != None, # Solo bans específicos de canal
-            (Ban.expires_at == None) | (Ban.expires_at > now)
-        )
-        banned_channel_ids = [item[0] for item in banned_channel_ids_query.all()]
-
-        # Obtener los canales aprobados para el usuario usando la relación
-        # y FILTRAR los baneados si es necesario
-        query = current_user.approved_channels # Empezamos con la relación
-
-        if banned_channel_ids:
-             # Excluir los canales baneados
-             query = query.filter(Channel.id.notin_(banned_channel_ids))
-
-        # Ejecutar la consulta final ordenada por nombre
-        user_channels = query.order_by(Channel.name).all()
-
-        # --- FIN DEL BLOQUE A MODIFICAR / REEMPLAZAR ---
-
-        # Check de Ban Global (mantenemos por seguridad)
-        global_ban = Ban.query.filter_by(user_id=current_user.id, channel_id=None)\
-                               .filter((Ban.expires_at == None) | (Ban.expires_at > now))\
-                               .first()
-        if global_ban:
-            user_channels = [] # No mostrar canales si hay ban global
+        # Canales, indicadores, bans y no leídos en un solo payload cacheado (ver app/sidebar.py).
+        # Se incrusta en la página: chat.js no necesita pedir nada más para pintar la lista.
+        sidebar = sidebar_cache.payload(current_user.id)
+        if sidebar['banned']:
             flash("Tu cuenta está baneada globalmente.", "danger")
 
     except Exception as e:
+        db.session.rollback()
         flash(f"Error al cargar tus canales: {e}", "danger")
         print(f"Error DB al cargar canales para usuario {current_user.id}: {e}")
-        user_channels = [] # Asegurar que sea una lista vacía en caso de error
+        sidebar = {'banned': False, 'channels': []} # Asegurar que sea una lista vacía en caso de error
 
-    # Pasar SOLO la lista 'user_channels' (filtrada) a la plantilla
-    return render_template('chat_interface.html', title='Chat', channels=user_channels)
+    return render_template('chat_interface.html', title='Chat', sidebar=sidebar)
+
+
+@app.route('/sidebar')
+@login_required
+def get_sidebar():
+    """El mismo payload de la barra lateral que index, en JSON (chat.js lo pide al reconectar)."""
+    return jsonify(sidebar_cache.payload(current_user.id))
 
 # --- Rutas de Autenticación ---
 
@@ -174,9 +171,7 @@ def login():
             return redirect(url_for('login'))
 
         # Comprobar si está baneado globalmente ANTES de loguear
-        ban = Ban.query.filter_by(user_id=user.id, channel_id=None)\
-                       .filter((Ban.expires_at == None) | (Ban.expires_at > datetime.now(timezone.utc)))\
-                       .first()
+        ban = moderation_cache.active_ban(user.id)
         if ban:
              flash('Tu cuenta está baneada globalmente. No puedes iniciar sesión.', 'danger')
              return redirect(url_for('login')) # De vuelta al login
@@ -200,19 +195,30 @@ def logout():
 @app.route('/get_channel_messages/<int:channel_id>')
 @login_required
 def get_channel_messages(channel_id):
-    """Devuelve mensajes (usado por SocketIO ahora, esta ruta puede ser obsoleta o para carga inicial AJAX)."""
+    """
+    Devuelve una página del historial (usado por SocketIO ahora, esta ruta puede ser obsoleta o para carga inicial AJAX).
+    Parámetros opcionales: ?before_id=<id>, ?after_id=<id>, ?limit=<n>. Sin cursores: los N más recientes.
+    Con ?export=json|ndjson devuelve TODO el historial (o el posterior a after_id) en streaming.
+    """
     channel = Channel.query.get_or_404(channel_id)
-    # TODO: Añadir check de contraseña/acceso aquí si es necesario
-
-    messages = Message.query.filter_by(channel_id=channel.id).order_by(Message.timestamp.asc()).all()
-    messages_data = [
-        {
-            'id': msg.id, 'body': msg.body, 'timestamp': msg.timestamp.isoformat() + 'Z',
-            'user_id': msg.author.id, 'username': msg.author.username,
-            'message_type': msg.message_type, 'is_pinned': msg.is_pinned
-        } for msg in messages
-    ]
-    return jsonify(messages_data)
+    # Solo miembros del canal sin ban activo (global o de este canal); el ban se mira en memoria
+    is_member = db.session.query(channel_members).filter_by(user_id=current_user.id, channel_id=channel.id).first()
+    if not is_member or moderation_cache.active_ban(current_user.id, channel.id):
+        abort(403)
+
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    export_format = request.args.get('export')
+    if export_format is not None:
+        if export_format not in EXPORT_FORMATS:
+            abort(400)
+        response = Response(stream_with_context(stream_history(channel.id, export_format, after_id=after_id)),
+                            mimetype=EXPORT_FORMATS[export_format])
+        response.headers['Content-Disposition'] = f'attachment; filename=canal-{channel.id}.{export_format}'
+        return response
+    messages_data, has_more = get_history_page(channel.id, before_id=before_id, after_id=after_id,
+                                               limit=request.args.get('limit'))
+    return jsonify({'channel_id': channel.id, 'messages': messages_data, 'has_more': has_more})
 
 
 # --- Rutas del Panel de Administración ---
@@ -221,60 +227,82 @@ def get_channel_messages(channel_id):
 @login_required
 @admin_required
 def admin_dashboard():
-    """Muestra el panel de control principal del admin con listas y formularios de modal."""
+    """
+    Panel de control del admin: usuarios y canales paginados con búsqueda (?user_q, ?user_page,
+    ?channel_q, ?channel_page) y formularios de modal. Ver app/dashboard.py.
+    """
     now = datetime.now(timezone.utc)
+    per_page = app.config['ADMIN_PAGE_SIZE']
+    user_q = request.args.get('user_q', '').strip()
+    channel_q = request.args.get('channel_q', '').strip()
+    user_page = parse_page(request.args.get('user_page'))
+    channel_page = parse_page(request.args.get('channel_page'))
     try:
-        users = User.query.order_by(User.username).all()
-        channels = Channel.query.order_by(Channel.name).all()
-
-        # --- OBTENER MUTES/BANS ACTIVOS ---
-        active_mutes_list = Mute.query.filter(
-            (Mute.expires_at == None) | (Mute.expires_at > now)
-        ).all()
-        active_bans_list = Ban.query.filter(
-            (Ban.expires_at == None) | (Ban.expires_at > now)
-        ).all()
-
-        # Crear diccionarios para acceso rápido en la plantilla:
-        # { user_id: [(channel_id_or_None, mute_object), ...], ... }
-        active_mutes = {}
-        for mute in active_mutes_list:
-            if mute.user_id not in active_mutes:
-                active_mutes[mute.user_id] = []
-            active_mutes[mute.user_id].append((mute.channel_id, mute))
-
-        active_bans = {}
-        for ban in active_bans_list:
-            if ban.user_id not in active_bans:
-                active_bans[ban.user_id] = []
-            active_bans[ban.user_id].append((ban.channel_id, ban))
-        # --- FIN OBTENER MUTES/BANS ---
-
-        pending_sticker_count = Sticker.query.filter_by(is_approved=False).count() # Contar pendientes
+        users_query = User.query.order_by(User.username)
+        if user_q:
+            users_query = users_query.filter(User.username.ilike(f'%{user_q}%'))
+        users, users_has_next = page_of(users_query, user_page, per_page)
+
+        channels_query = Channel.query.order_by(Channel.name)
+        if channel_q:
+            channels_query = channels_query.filter(Channel.name.ilike(f'%{channel_q}%'))
+        channels, channels_has_next = page_of(channels_query, channel_page, per_page)
+
+        # Mutes/bans activos SOLO de los usuarios de esta página (una consulta)
+        moderation = moderation_status([user.id for user in users], now)
+        counts = dashboard_counts.get()
 
     except Exception as e:
         flash(f"Error al cargar datos para el panel: {e}", "danger")
         print(f"Error DB al cargar dashboard: {e}")
-        users = []
-        channels = []
-        active_mutes = {}
-        active_bans = {}
-        pending_sticker_count = 0
+        users, users_has_next = [], False
+        channels, channels_has_next = [], False
+        moderation = {}
+        counts = {'users': 0, 'channels': 0, 'pending_stickers': 0, 'pending_requests': 0}
 
-    mute_form = MuteUserForm()
-    ban_form = BanUserForm()
+    # Una sola consulta de canales para los selectores de ambos formularios
+    choices = load_channel_choices()
+    mute_form = MuteUserForm(channel_choices=choices)
+    ban_form = BanUserForm(channel_choices=choices)
 
     # --- OBTENER ESTADO MANTENIMIENTO ---
-    site_closed_setting = Setting.query.filter_by(key='site_closed').first()
-    is_site_closed = site_closed_setting.value.lower() == 'true' if site_closed_setting else False
+    is_site_closed = site_settings.get('site_closed')
     # --- FIN OBTENER ESTADO ---
 
     return render_template('admin_panel.html', title='Panel Admin',
                            users=users, channels=channels,
+                           user_q=user_q, user_page=user_page, users_has_next=users_has_next,
+                           channel_q=channel_q, channel_page=channel_page, channels_has_next=channels_has_next,
+                           per_page=per_page, counts=counts,
                            mute_form=mute_form, ban_form=ban_form,
-                           active_mutes=active_mutes, active_bans=active_bans,
-                           is_site_closed=is_site_closed, 
-                           pending_sticker_count=pending_sticker_count) # <-- Pasar diccionarios
+                           moderation=moderation,
+                           is_site_closed=is_site_closed)
+
+@app.route('/admin/stats')
+@login_required
+@admin_required
+def admin_stats():
+    """Contadores internos en JSON (buffer de historial, escritura de mensajes) para diagnosticar rendimiento."""
+    return jsonify({
+        'history_buffer': recent_messages.stats(),
+        'history_pages': history_page_stats,
+        'message_writer': message_writer.stats(),
+        'retention_sweep': last_sweep_stats,
+        'message_expiry': message_expiry.stats(),
+        'moderation_cache': moderation_cache.stats(),
+        'invalidation_bus': invalidation_bus.stats(),
+        'site_settings': site_settings.stats(),
+        'identity_cache': identity_cache.stats(),
+        'typing': typing_aggregator.stats(),
+        'presence': presence.stats(),
+        'membership_notices': membership_notices.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'outbound': outbound_limiter.stats(),
+        'dashboard_counts': dashboard_counts.stats(),
+        'sticker_manifest': sticker_manifest.stats(),
+        'sidebar_cache': sidebar_cache.stats(),
+        'socketio_broker': getattr(socketio.server.manager, 'name', None), # None = un solo proceso, sin broker
+    })
 
 # --- Rutas Gestión Canales ---
 
@@ -286,12 +314,15 @@ def admin_create_channel():
     if form.validate_on_submit():
         new_channel = Channel(name=form.name.data,
                               description=form.description.data,
-                              is_writable=form.is_writable.data)
+                              is_writable=form.is_writable.data,
+                              retention_minutes=form.retention_minutes.data,
+                              slow_mode_seconds=form.slow_mode_seconds.data or None)
         if form.password.data:
             new_channel.set_password(form.password.data)
         try:
             db.session.add(new_channel)
             db.session.commit()
+            note_dashboard_counts_changed()
             flash(f'Canal "{new_channel.name}" creado exitosamente!', 'success')
             return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -312,6 +343,8 @@ def admin_edit_channel(channel_id):
         channel.description = form.description.data
         channel.is_writable = form.is_writable.data
         channel.requires_approval = form.requires_approval.data # Asegúrate que este campo esté en el form
+        channel.retention_minutes = form.retention_minutes.data # None = retención global
+        channel.slow_mode_seconds = form.slow_mode_seconds.data or None # None = sin modo lento
 
         # --- SOLO establecer contraseña SI se proporcionó una nueva ---
         if form.password.data:
@@ -327,6 +360,10 @@ def admin_edit_channel(channel_id):
             db.session.add(channel)
             db.session.commit()
             print(f"[DEBUG edit_channel POST] Commit realizado. Hash final: {channel.password_hash}")
+            message_expiry.reschedule_channel(channel.id) # La retención puede haber cambiado
+            rate_limiter.invalidate_channel(channel.id) # Y el modo lento
+            sidebar_cache.channel_changed(channel.id) # Y el nombre/contraseña en la barra lateral
+            invalidation_bus.publish('channel', channel.id)
             flash(f'Canal "{channel.name}" actualizado exitosamente!', 'success')
             return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -351,9 +388,15 @@ def admin_delete_channel(channel_id):
         # Borrar bans/mutes asociados a este canal ANTES de borrar el canal
         Mute.query.filter_by(channel_id=channel_id).delete()
         Ban.query.filter_by(channel_id=channel_id).delete()
+        ChannelPresence.query.filter_by(channel_id=channel_id).delete()
         # Borrar canal (y mensajes por cascade)
         db.session.delete(channel_to_delete)
         db.session.commit()
+        note_dashboard_counts_changed()
+        recent_messages.invalidate(channel_id) # Descartar historial en memoria del canal borrado
+        moderation_cache.invalidate_channel(channel_id) # Sus bans/mutes ya no existen
+        sidebar_cache.channel_deleted(channel_id)
+        invalidation_bus.publish('channel_deleted', channel_id)
         flash(f'Canal "{channel_name}" y todos sus mensajes/bans/mutes asociados han sido eliminados.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -370,6 +413,8 @@ def admin_toggle_channel_write(channel_id):
         channel.is_writable = not channel.is_writable
         db.session.add(channel)
         db.session.commit()
+        sidebar_cache.channel_changed(channel.id)
+        invalidation_bus.publish('channel', channel.id)
         estado = "habilitada" if channel.is_writable else "deshabilitada"
         flash(f'La escritura en el canal "{channel.name}" ha sido {estado}.', 'success')
         # Notificar a clientes
@@ -399,6 +444,7 @@ def admin_create_user():
         try:
             db.session.add(new_user)
             db.session.commit()
+            note_dashboard_counts_changed()
             flash(f'Usuario "{new_user.username}" ({new_user.role}) creado exitosamente!', 'success')
             return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -426,6 +472,8 @@ def admin_edit_user_role(user_id):
         try:
             db.session.add(user)
             db.session.commit()
+            identity_cache.invalidate(user_id) # El nuevo rol se aplica en su siguiente petición/evento
+            invalidation_bus.publish('user', user_id)
             flash(f'Rol del usuario "{user.username}" actualizado a "{new_role}".', 'success')
             return redirect(url_for('admin_dashboard'))
         except Exception as e:
@@ -452,11 +500,18 @@ def admin_delete_user(user_id):
         # Borrar Mutes y Bans donde este usuario es el afectado O el admin que lo aplicó
         Mute.query.filter((Mute.user_id == user_id) | (Mute.admin_id == user_id)).delete()
         Ban.query.filter((Ban.user_id == user_id) | (Ban.admin_id == user_id)).delete()
+        ChannelPresence.query.filter_by(user_id=user_id).delete()
         # ¡Ojo! Mensajes quedan huérfanos (ForeignKey ON DELETE no configurado por defecto en SQLite)
         # Podrías añadir lógica para reasignarlos a un usuario "Eliminado" o borrarlos manualmente.
         # Message.query.filter_by(user_id=user_id).delete() # Descomentar si quieres borrar mensajes
         db.session.delete(user_to_delete)
         db.session.commit()
+        note_dashboard_counts_changed()
+        # Se borraron sanciones del usuario Y las que él aplicó a otros: vaciar la caché de moderación
+        moderation_cache.clear()
+        invalidation_bus.publish('moderation', None)
+        identity_cache.invalidate(user_id) # Su sesión deja de ser válida
+        invalidation_bus.publish('user', user_id)
         flash(f'Usuario "{username}" y sus mutes/bans asociados eliminados exitosamente.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -523,6 +578,8 @@ def admin_apply_mute():
                 if expires_at == 'remove':
                     if existing_mute:
                         db.session.delete(existing_mute); db.session.commit()
+                        moderation_cache.set_sanction('mute', user_id, channel_id, None)
+                        invalidation_bus.publish('moderation', user_id)
                         scope = f"en canal ID {channel_id}" if channel_id else "global"
                         flash(f'Mute para "{user.username}" {scope} eliminado.', 'success')
                     else: flash(f'No se encontró un mute activo para "{user.username}" en ese ámbito.', 'warning')
@@ -530,6 +587,8 @@ def admin_apply_mute():
                     existing_mute.expires_at = expires_at; existing_mute.reason = reason
                     existing_mute.admin_id = current_user.id; existing_mute.created_at = datetime.now(timezone.utc)
                     db.session.add(existing_mute); db.session.commit()
+                    moderation_cache.set_sanction('mute', user_id, channel_id, existing_mute)
+                    invalidation_bus.publish('moderation', user_id)
                     expiry_msg = f"hasta {expires_at.strftime('%Y-%m-%d %H:%M')}" if expires_at else "permanentemente"
                     scope = f"en canal ID {channel_id}" if channel_id else "global"
                     flash(f'Mute para "{user.username}" {scope} actualizado ({expiry_msg}).', 'success')
@@ -539,6 +598,8 @@ def admin_apply_mute():
                     else:
                         new_mute = Mute(user_id=user_id, admin_id=current_user.id, channel_id=channel_id, reason=reason, expires_at=expires_at)
                         db.session.add(new_mute); db.session.commit()
+                        moderation_cache.set_sanction('mute', user_id, channel_id, new_mute)
+                        invalidation_bus.publish('moderation', user_id)
                         expiry_msg = f"hasta {expires_at.strftime('%Y-%m-%d %H:%M')}" if expires_at else "permanentemente"
                         scope = f"en canal ID {channel_id}" if channel_id else "global"
                         flash(f'Usuario "{user.username}" silenciado {scope} ({expiry_msg}).', 'success')
@@ -587,6 +648,8 @@ def admin_apply_ban():
                 if expires_at == 'remove':
                     if existing_ban:
                         db.session.delete(existing_ban); db.session.commit()
+                        moderation_cache.set_sanction('ban', user_id, channel_id, None)
+                        invalidation_bus.publish('moderation', user_id)
                         scope = f"en canal ID {channel_id}" if channel_id else "global"
                         flash(f'Ban para "{user.username}" {scope} eliminado.', 'success')
                     else: flash(f'No se encontró un ban activo para "{user.username}" en ese ámbito.', 'warning')
@@ -594,6 +657,8 @@ def admin_apply_ban():
                     existing_ban.expires_at = expires_at; existing_ban.reason = reason
                     existing_ban.admin_id = current_user.id; existing_ban.created_at = datetime.now(timezone.utc)
                     db.session.add(existing_ban); db.session.commit()
+                    moderation_cache.set_sanction('ban', user_id, channel_id, existing_ban)
+                    invalidation_bus.publish('moderation', user_id)
                     expiry_msg = f"hasta {expires_at.strftime('%Y-%m-%d %H:%M')}" if expires_at else "permanentemente"
                     scope = f"en canal ID {channel_id}" if channel_id else "global"
                     flash(f'Ban para "{user.username}" {scope} actualizado ({expiry_msg}).', 'success')
@@ -603,6 +668,8 @@ def admin_apply_ban():
                     else:
                         new_ban = Ban(user_id=user_id, admin_id=current_user.id, channel_id=channel_id, reason=reason, expires_at=expires_at)
                         db.session.add(new_ban); db.session.commit()
+                        moderation_cache.set_sanction('ban', user_id, channel_id, new_ban)
+                        invalidation_bus.publish('moderation', user_id)
                         expiry_msg = f"hasta {expires_at.strftime('%Y-%m-%d %H:%M')}" if expires_at else "permanentemente"
                         scope = f"en canal ID {channel_id}" if channel_id else "global"
                         flash(f'Usuario "{user.username}" baneado {scope} ({expiry_msg}).', 'success')
@@ -667,12 +734,15 @@ def admin_approve_request(request_id):
              # O inserción directa:
              insert_stmt = channel_members.insert().values(
                  user_id=join_request.user_id,
-                 channel_id=join_request.channel_id
+                 channel_id=join_request.channel_id,
+                 last_read_seq=join_request.channel.last_seq # Un miembro nuevo no tiene mensajes pendientes
              )
              db.session.execute(insert_stmt)
 
         db.session.add(join_request) # Guardar cambios en la solicitud
         db.session.commit()
+        note_dashboard_counts_changed()
+        note_sidebar_changed(join_request.user_id)
 
         flash(f'Solicitud de {join_request.user.username} para unirse a "{join_request.channel.name}" aprobada.', 'success')
 
@@ -711,6 +781,7 @@ def admin_reject_request(request_id):
         join_request.reviewed_at = datetime.now(timezone.utc)
         db.session.add(join_request)
         db.session.commit()
+        note_dashboard_counts_changed()
         flash(f'Solicitud de {join_request.user.username} para unirse a "{join_request.channel.name}" rechazada.', 'info')
 
         # --- Notificar al usuario ---
@@ -760,6 +831,9 @@ def admin_kick_user_from_channel(user_id, channel_id):
         # -----------------------------------------------------
 
         db.session.commit() # Hacer commit DESPUÉS de ambas eliminaciones
+        recent_messages.invalidate(channel_id)
+        invalidation_bus.publish('history', channel_id)
+        note_sidebar_changed(user_id)
 
         if result.rowcount > 0 or deleted_requests_count > 0:
             flash(f'Usuario "{user.username}" kickeado del canal "{channel.name}". Sus solicitudes de unión para este canal también fueron eliminadas.', 'success')
@@ -773,8 +847,7 @@ def admin_kick_user_from_channel(user_id, channel_id):
             }, to=personal_room)
             # Notificar al resto del canal (si era miembro)
             if result.rowcount > 0:
-                system_message = { 'channel_id': channel_id, 'body': f'{user.username} ha sido kickeado del canal por {current_user.username}.', 'message_type': 'system', 'timestamp': datetime.now(timezone.utc).isoformat(), 'username': 'Sistema'}
-                socketio.emit('new_message', system_message, to=room_name)
+                broadcast_system_message(channel_id, f'{user.username} ha sido kickeado del canal por {current_user.username}.', datetime.now(timezone.utc))
             # Forzar desconexión de la sala SocketIO (implementación simple - ver comentarios anteriores)
             # ... (código opcional para buscar SID y llamar a socketio.leave_room) ...
         else:
@@ -792,25 +865,14 @@ def admin_kick_user_from_channel(user_id, channel_id):
 @admin_required
 def admin_toggle_maintenance():
     """Activa o desactiva el modo mantenimiento."""
-    setting_key = 'site_closed'
     try:
-        # Buscar la configuración existente o crearla si no existe
-        setting = Setting.query.filter_by(key=setting_key).first()
-        if not setting:
-            # Si no existe, la creamos como 'False' (abierto) por defecto
-            current_state = False
-            setting = Setting(key=setting_key, value=str(current_state))
-            db.session.add(setting)
-            # No hacemos commit aún, lo haremos después de cambiar el estado
-        else:
-            # Convertir valor guardado (string) a booleano
-            current_state = setting.value.lower() == 'true'
+        # Partir del valor actual de la BBDD (no del de memoria) por si otro worker lo cambió hace un instante
+        site_settings.invalidate()
+        current_state = site_settings.get('site_closed')
 
-        # Cambiar el estado
+        # Cambiar el estado (guarda, hace commit y avisa al resto de workers)
         new_state = not current_state
-        setting.value = str(new_state) # Guardar como string 'True' o 'False'
-        db.session.add(setting) # Marcar para guardar
-        db.session.commit()
+        site_settings.set('site_closed', new_state)
 
         estado_msg = "activado" if new_state else "desactivado"
         flash(f'Modo mantenimiento {estado_msg}.', 'success')
@@ -875,6 +937,7 @@ def upload_media():
                                       is_approved=False) # ¡IMPORTANTE! Marcar como no aprobado
                 db.session.add(new_sticker)
                 db.session.commit()
+                note_dashboard_counts_changed() # Un sticker más pendiente de aprobar
                 print(f"[DEBUG upload_media] Sticker PENDIENTE registrado en DB: ID {new_sticker.id}, Ruta DB: {db_path}")
 
                 return jsonify({'message': success_message}), 200
@@ -908,16 +971,12 @@ def upload_media():
 
             # Comprobar permisos para enviar a este canal (ban, mute, writable)
             now = datetime.now(timezone.utc)
-            active_ban = Ban.query.filter_by(user_id=current_user.id)\
-                                  .filter((Ban.channel_id == channel_id_int) | (Ban.channel_id == None))\
-                                  .filter((Ban.expires_at == None) | (Ban.expires_at > now)).first()
+            active_ban = moderation_cache.active_ban(current_user.id, channel_id_int)
             if active_ban:
                 print(f"[DEBUG upload_media] Denegado: Usuario {current_user.id} baneado en canal {channel_id_int} o global.")
                 return jsonify({'error': 'No puedes enviar imágenes, estás baneado.'}), 403
 
-            active_mute = Mute.query.filter_by(user_id=current_user.id)\
-                                   .filter((Mute.channel_id == channel_id_int) | (Mute.channel_id == None))\
-                                   .filter((Mute.expires_at == None) | (Mute.expires_at > now)).first()
+            active_mute = moderation_cache.active_mute(current_user.id, channel_id_int)
             if active_mute:
                  print(f"[DEBUG upload_media] Denegado: Usuario {current_user.id} muteado en canal {channel_id_int} o global.")
                  return jsonify({'error': 'No puedes enviar imágenes, estás silenciado.'}), 403
@@ -944,7 +1003,7 @@ def upload_media():
 
                 # Crear mensaje de tipo imagen y emitirlo
                 new_msg = Message(body=image_url, # Guardar URL relativa generada por url_for
-                                  author=current_user,
+                                  user_id=current_user.id,
                                   channel_id=channel_id_int,
                                   message_type='image') # Correcto
                 db.session.add(new_msg)
@@ -952,17 +1011,9 @@ def upload_media():
                 print(f"[DEBUG upload_media] Mensaje de imagen registrado en DB: ID {new_msg.id}, URL: {image_url}, Canal: {channel_id_int}")
 
                 # Emitir a la sala
-                message_data = {
-                    'id': new_msg.id,
-                    'body': image_url, # Enviar URL relativa
-                    'timestamp': new_msg.timestamp.replace(tzinfo=timezone.utc).isoformat().replace('+00:00', 'Z'),
-                    'user_id': current_user.id,
-                    'username': current_user.username,
-                    'channel_id': channel_id_int,
-                    'message_type': 'image',
-                    'is_pinned': False
-                }
-                socketio.emit('new_message', message_data, to=str(channel_id_int))
+                message_data = serialize_message(new_msg, username=current_user.username, channel_id=channel_id_int)
+                note_new_message(channel_id_int, message_data)
+                broadcast_message(message_data, channel_id_int)
                 print(f"[DEBUG upload_media] Emitido 'new_message' (imagen) a sala {channel_id_int}")
 
                 return jsonify({'message': success_message, 'image_url': image_url}), 200
@@ -983,21 +1034,21 @@ def upload_media():
 @app.route('/get-approved-stickers')
 @login_required
 def get_approved_stickers():
-    """Devuelve una lista de URLs de stickers aprobados."""
+    """
+    Lista de stickers aprobados ({id, url}) desde el manifiesto precalculado (app/stickers.py).
+    Con If-None-Match de la versión actual responde 304 sin cuerpo.
+    """
     try:
-        approved_stickers = Sticker.query.filter_by(is_approved=True).order_by(Sticker.id).all()
-        sticker_data = [
-            {
-                'id': sticker.id,
-                # sticker.file_path debe ser como 'uploads/stickers/filename.png'
-                'url': url_for('static', filename=sticker.file_path)
-            }
-            for sticker in approved_stickers
-        ]
-        return jsonify(sticker_data)
+        body, etag = sticker_manifest.get()
     except Exception as e:
+        db.session.rollback()
         print(f"Error al obtener stickers aprobados: {e}")
         return jsonify({"error": "No se pudieron cargar los stickers."}), 500
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True # Guardar, pero revalidar siempre con el ETag
+    return response.make_conditional(request)
 
 
 # --- Ruta Aprobar (Se mantiene, pero ahora redirige a 'manage_stickers') ---
@@ -1031,6 +1082,9 @@ def admin_approve_sticker(sticker_id):
         sticker.file_path = new_db_path # Guardar la nueva ruta relativa
         db.session.add(sticker)
         db.session.commit()
+        note_dashboard_counts_changed()
+        sticker_manifest.invalidate() # Cambió el conjunto de stickers aprobados
+        invalidation_bus.publish('stickers', sticker.id)
         flash(f'Sticker ID {sticker.id} aprobado.', 'success')
 
     except FileNotFoundError as fnf_error:
@@ -1070,6 +1124,7 @@ def admin_reject_sticker(sticker_id):
              # Consideramos esto un éxito parcial, el registro se elimina igual
 
         db.session.commit() # Commit DEPUÉS de intentar borrar el archivo
+        note_dashboard_counts_changed()
         flash(f'Sticker ID {sticker.id} rechazado y eliminado.', 'success')
 
     except Exception as e:
@@ -1113,6 +1168,9 @@ def admin_manage_stickers():
                                       is_approved=True) # <--- Marcar como True
                 db.session.add(new_sticker)
                 db.session.commit()
+                note_dashboard_counts_changed()
+                sticker_manifest.invalidate()
+                invalidation_bus.publish('stickers', new_sticker.id)
                 print(f"Sticker APROBADO registrado en DB: ID {new_sticker.id}, Ruta DB: {db_path}")
                 flash('Sticker subido y aprobado exitosamente!', 'success')
 
@@ -1178,6 +1236,9 @@ def admin_delete_sticker(sticker_id):
              print(f"WARN: Archivo no encontrado para eliminar en {fs_path_to_delete} para sticker {sticker_id}")
 
         db.session.commit()
+        note_dashboard_counts_changed()
+        sticker_manifest.invalidate()
+        invalidation_bus.publish('stickers', sticker_id)
         flash(f'Sticker ID {sticker_id} ({sticker_status}) eliminado exitosamente.', 'success')
 
     except Exception as e:
@@ -0,0 +1,93 @@
+# app/settings.py
+"""
+Registro tipado de ajustes globales (tabla Setting), servido desde memoria.
+
+Antes cada petición HTTP (incluidos los archivos estáticos) consultaba Setting 'site_closed'.
+Ahora todos los ajustes se cargan con una sola consulta y las lecturas no tocan la BBDD:
+
+- Cada ajuste se declara en SETTINGS con su tipo y valor por defecto; get() devuelve el valor ya convertido.
+- set() guarda en la BBDD, actualiza la memoria y avisa al resto de procesos por el bus de
+  invalidación ('setting'), que recargan en su siguiente lectura.
+- Por si se pierde algún aviso, los valores se recargan como muy tarde a los SETTINGS_CACHE_TTL_SECONDS.
+"""
+import threading
+import time
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Setting
+
+
+def _parse_bool(raw):
+    return raw.lower() in ['true', '1', 't']
+
+
+# clave -> (conversor desde el texto guardado, valor por defecto)
+SETTINGS = {
+    'site_closed': (_parse_bool, False), # Modo mantenimiento
+}
+
+
+class SettingsRegistry:
+
+    def __init__(self, definitions, ttl_seconds):
+        self.definitions = definitions
+        self.ttl = ttl_seconds
+        self._raw = {} # clave -> valor tal cual está en la BBDD (texto)
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return # Otro hilo ya recargó
+            self._raw = dict(db.session.query(Setting.key, Setting.value).all())
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+
+    def get(self, key):
+        """Valor tipado del ajuste (el de por defecto si no existe en la BBDD o no se puede convertir)."""
+        parse, default = self.definitions[key]
+        self._ensure_loaded()
+        raw = self._raw.get(key)
+        if raw is None:
+            return default
+        try:
+            return parse(raw)
+        except (ValueError, AttributeError):
+            print(f"[Settings] Valor inválido para '{key}': {raw!r}. Usando {default!r}.")
+            return default
+
+    def set(self, key, value):
+        """Guarda el ajuste (crea la fila si no existe), hace commit y avisa al resto de procesos."""
+        if key not in self.definitions:
+            raise KeyError(f"Ajuste desconocido: {key}")
+        setting = Setting.query.filter_by(key=key).first()
+        if setting is None:
+            setting = Setting(key=key)
+            db.session.add(setting)
+        setting.value = str(value) # Guardar como texto, ej: 'True' / 'False'
+        db.session.commit()
+        with self._lock:
+            self._raw[key] = setting.value
+        invalidation_bus.publish('setting', key)
+
+    def invalidate(self, key=None):
+        """Fuerza la recarga en la siguiente lectura (aviso de otro proceso)."""
+        self._loaded_at = None
+
+    def stats(self):
+        return {
+            'settings': len(self._raw),
+            'loads': self.loads,
+            'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at is not None else None,
+        }
+
+
+# Instancia global (una por proceso)
+site_settings = SettingsRegistry(SETTINGS, ttl_seconds=app.config['SETTINGS_CACHE_TTL_SECONDS'])
+
+invalidation_bus.subscribe('setting', site_settings.invalidate)
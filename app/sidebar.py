@@ -0,0 +1,199 @@
+# app/sidebar.py
+"""
+Lista de canales de la barra lateral (una por usuario) en una consulta y cacheada.
+
+Antes index consultaba los bans de canal, luego current_user.approved_channels con un NOT IN y
+después el ban global, y chat.js no sabía nada de cada canal (escritura, no leídos) hasta unirse
+a su sala. Ahora build() obtiene en UNA consulta (channel_members JOIN channel) los canales del
+usuario con sus indicadores (is_writable, is_protected) y su marca de lectura (last_read_seq).
+
+- index lo incrusta en la página y chat.js lo vuelve a pedir a /sidebar al reconectar: cargar la
+  página es una sola petición.
+- Caché por usuario (LRU, SIDEBAR_CACHE_MAX_USERS) de lo que cambia poco: canales, indicadores y
+  marcas de lectura. Los mensajes nuevos NO la invalidan.
+- No leídos = Channel.last_seq - last_read_seq, calculado al servir la entrada. El último seq de cada
+  canal se guarda en memoria y lo avanzan los mensajes nuevos (propios y de otros procesos, ver
+  history.note_new_messages); si falta (arranque, aviso 'history') se lee con una consulta por PK.
+  Es una cota: cuenta también los ya expirados, y los propios si el autor no estaba al día (si lo
+  estaba, su marca avanza en memoria hasta que chat.js la guarda con 'mark_read').
+- Canal editado: se descartan las entradas que lo incluyen. Canal borrado: además se olvida su seq.
+- Altas/bajas de miembros: note_sidebar_changed(user_id) descarta la entrada del usuario y avisa al
+  resto de procesos ('sidebar'). Las marcas de lectura ('mark_read') actualizan la entrada en sitio
+  (note_channel_read) y el resto de procesos descarta la suya.
+- Bans: no se guardan en la entrada, se aplican al servirla desde moderation_cache (en memoria),
+  así los bans nuevos, levantados o caducados se reflejan al momento sin invalidar nada.
+"""
+import threading
+from collections import OrderedDict
+
+from app import app, db
+from app.invalidation import invalidation_bus
+from app.models import Channel, channel_members
+from app.moderation import moderation_cache
+
+
+def build(user_id):
+    """Canales del usuario (orden por nombre) con sus indicadores, marca de lectura y último seq. Una consulta."""
+    rows = db.session.query(Channel.id, Channel.name, Channel.is_writable,
+                            (Channel.password_hash != None).label('is_protected'),
+                            Channel.last_seq, channel_members.c.last_read_seq)\
+                     .join(channel_members, channel_members.c.channel_id == Channel.id)\
+                     .filter(channel_members.c.user_id == user_id)\
+                     .order_by(Channel.name).all()
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'is_writable': row.is_writable,
+        'is_protected': bool(row.is_protected),
+        'last_seq': row.last_seq or 0,
+        'last_read_seq': row.last_read_seq or 0,
+    } for row in rows]
+
+
+class _Entry:
+    __slots__ = ('channels', 'last_read')
+
+    def __init__(self, channels, last_read):
+        self.channels = channels # [{'id', 'name', 'is_writable', 'is_protected'}] por nombre
+        self.last_read = last_read # channel_id -> last_read_seq
+
+
+class SidebarCache:
+
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self._entries = OrderedDict() # user_id -> _Entry (orden LRU)
+        self._last_seq = {} # channel_id -> último Message.seq conocido
+        self._generation = 0 # Crece en cada invalidación: una entrada construida antes no se guarda
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seq_queries = 0
+
+    def _entry(self, user_id):
+        """Entrada del usuario, desde la caché o de la BBDD."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self._generation
+        rows = build(user_id)
+        entry = _Entry([{key: row[key] for key in ('id', 'name', 'is_writable', 'is_protected')} for row in rows],
+                       {row['id']: row['last_read_seq'] for row in rows})
+        with self._lock:
+            for row in rows:
+                self._advance(row['id'], row['last_seq'])
+            if generation == self._generation:
+                self._entries[user_id] = entry
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def _advance(self, channel_id, seq):
+        """Se llama con el lock tomado."""
+        if seq is not None and seq > self._last_seq.get(channel_id, -1):
+            self._last_seq[channel_id] = seq
+
+    def _last_seqs(self, channel_ids):
+        """Último seq de cada canal: de memoria, y los que falten con una consulta por PK."""
+        with self._lock:
+            known = {channel_id: self._last_seq[channel_id] for channel_id in channel_ids if channel_id in self._last_seq}
+        missing = [channel_id for channel_id in channel_ids if channel_id not in known]
+        if missing:
+            rows = db.session.query(Channel.id, Channel.last_seq).filter(Channel.id.in_(missing)).all()
+            with self._lock:
+                self.seq_queries += 1
+                for channel_id, last_seq in rows:
+                    self._advance(channel_id, last_seq or 0)
+                    known[channel_id] = self._last_seq[channel_id]
+        return known
+
+    def payload(self, user_id):
+        """{'banned': ban global, 'channels': [...]} con no leídos y el ban de cada canal aplicado."""
+        if moderation_cache.active_ban(user_id):
+            return {'banned': True, 'channels': []}
+        entry = self._entry(user_id)
+        banned_ids = set(moderation_cache.banned_channel_ids(user_id))
+        last_seqs = self._last_seqs([channel['id'] for channel in entry.channels])
+        return {
+            'banned': False,
+            'channels': [dict(channel,
+                              unread=max(0, last_seqs.get(channel['id'], 0) - entry.last_read.get(channel['id'], 0)),
+                              is_banned=channel['id'] in banned_ids)
+                         for channel in entry.channels],
+        }
+
+    def message_added(self, channel_id, seq, author_id=None):
+        """Mensaje nuevo (de este proceso o de otro): avanza el último seq del canal y, si el autor lo tenía todo leído, su marca."""
+        with self._lock:
+            self._advance(channel_id, seq)
+            entry = self._entries.get(author_id)
+            if entry is not None and seq is not None and entry.last_read.get(channel_id) == seq - 1:
+                entry.last_read[channel_id] = seq # Solo en memoria: chat.js lo guardará con 'mark_read'
+
+    def forget_seq(self, channel_id):
+        """El último seq en memoria puede estar atrasado (aviso 'history'): se volverá a leer."""
+        with self._lock:
+            self._last_seq.pop(channel_id, None)
+
+    def mark_read(self, user_id, channel_id, seq):
+        """El usuario leyó hasta 'seq' (ya guardado): actualizar su entrada sin reconstruirla."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.last_read.get(channel_id, seq) < seq:
+                entry.last_read[channel_id] = seq
+            self._generation += 1 # Una entrada que se esté construyendo puede traer la marca anterior
+
+    def channel_changed(self, channel_id):
+        """Canal editado (nombre, escritura, contraseña): las entradas que lo incluyen dejan de valer."""
+        with self._lock:
+            stale = [user_id for user_id, entry in self._entries.items() if channel_id in entry.last_read]
+            for user_id in stale:
+                del self._entries[user_id]
+            self._generation += 1
+
+    def channel_deleted(self, channel_id):
+        self.channel_changed(channel_id)
+        self.forget_seq(channel_id)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'max_users': self.max_users,
+                'channels_seq': len(self._last_seq),
+                'hits': self.hits,
+                'misses': self.misses,
+                'seq_queries': self.seq_queries,
+            }
+
+
+# Instancia global (una por proceso)
+sidebar_cache = SidebarCache(max_users=app.config['SIDEBAR_CACHE_MAX_USERS'])
+
+
+def note_sidebar_changed(user_id):
+    """El usuario entró/salió de un canal: descartar su entrada aquí y en el resto de procesos."""
+    sidebar_cache.invalidate_user(user_id)
+    invalidation_bus.publish('sidebar', user_id)
+
+
+def note_channel_read(user_id, channel_id, seq):
+    """Marca de lectura ya guardada: actualizarla aquí y que el resto de procesos descarte su entrada."""
+    sidebar_cache.mark_read(user_id, channel_id, seq)
+    invalidation_bus.publish('sidebar', user_id)
+
+
+invalidation_bus.subscribe('sidebar', sidebar_cache.invalidate_user)
+invalidation_bus.subscribe('history', sidebar_cache.forget_seq)
+invalidation_bus.subscribe('channel', sidebar_cache.channel_changed)
+invalidation_bus.subscribe('channel_deleted', sidebar_cache.channel_deleted)
@@ -1,19 +1,39 @@
 // --- app/static/js/chat.js (v5 - Final Corregida) ---
 
 // --- Variables Globales ---
-const socket = io(); // Conexión Socket.IO
+const socket = io({ transports: SOCKETIO_TRANSPORTS }); // Conexión Socket.IO (transportes definidos en chat_interface.html)
 let currentChannelId = null; // ID del canal activo
 let currentChannelName = null; // Nombre del canal activo (para confirmación de salida)
 let typingTimer = null; // Timer para 'typing_stopped'
 const typingTimeout = 1500; // ms
 let isTyping = false; // Flag para estado de escritura local
-const usersTyping = {}; // Objeto para rastrear quién escribe { channel_id: { username: true } }
+let lastTypingPing = 0; // Último 'typing_started' enviado (se renueva mientras se sigue escribiendo)
+const typingRenewInterval = 3000; // ms (el servidor olvida a quien no renueva en TYPING_EXPIRY_SECONDS)
+const typingSnapshotTtl = 8000; // ms sin recibir 'typing_state' de un proceso antes de descartarlo
+const usersTyping = {}; // Quién escribe según cada proceso del servidor { channel_id: { source: { users, count, receivedAt } } }
+const onlineMembers = {}; // Conectados ahora en cada canal abierto { channel_id: Map(user_id -> username) } (ver app/presence.py)
 let currentChannelIsWritable = false; // Estado de escritura del canal actual
 let foundChannelInfo = null; // Guarda la info del canal encontrado en el modal de unión
 // USERNAME_GLOBAL se define en un <script> en chat_interface.html ANTES de este archivo
 let mediaPopoverInstance = null;
 let unreadCounts = {}; // <<< --- NUEVO: Objeto para contadores { channel_id: count }
 let originalTitle = document.title; // <<< --- NUEVO: Guardar título original
+const stickerManifestKey = 'approvedStickers'; // localStorage: { etag, stickers } de /get-approved-stickers
+// --- Paginación del historial (scroll hacia arriba) ---
+let oldestLoadedMessageId = null; // ID del mensaje más antiguo mostrado en el canal activo (cursor 'before_id')
+let hasMoreHistory = false; // ¿El servidor indicó que quedan mensajes más antiguos?
+let loadingOlderHistory = false; // Evita pedir la misma página varias veces mientras se hace scroll
+const historyScrollThreshold = 60; // px desde arriba para pedir la página anterior
+// --- Sincronización por número de secuencia (delta sync al reconectar / detección de huecos) ---
+let lastSeenSeq = null; // Último 'seq' del canal activo que tenemos en pantalla
+let syncInProgress = false; // Hay un 'channel_sync' pedido y aún sin respuesta
+let pendingSyncMessages = []; // Mensajes recibidos mientras se sincroniza (se aplican al terminar)
+// --- Marcas de lectura (no leídos de la barra lateral, ver app/sidebar.py) ---
+let pendingRead = null; // { channelId, seq } visto y aún sin enviar con 'mark_read'
+let markReadTimer = null;
+const markReadDelay = 2000; // ms: como mucho un 'mark_read' cada este tiempo
+const lastReadSent = {}; // Última marca enviada por canal { channel_id: seq }
+let sidebarStale = false; // Tras perder la conexión hay que volver a pedir /sidebar
 
 // --- Manejadores Socket.IO Globales (Conexión/Desconexión/Error) ---
 socket.on('connect', () => {
@@ -22,6 +42,7 @@ socket.on('connect', () => {
 
 socket.on('disconnect', (reason) => {
     console.log('Desconectado del servidor:', reason);
+    sidebarStale = true; // Los no leídos se quedan atrás mientras no hay conexión
     alert('Se ha perdido la conexión con el servidor de chat.');
     // Intentar deshabilitar si la función ya existe en el DOM
     if (typeof disableChatInput === "function") {
@@ -146,6 +167,103 @@ document.addEventListener('DOMContentLoaded', () => {
         if(messageArea) messageArea.scrollTop = messageArea.scrollHeight;
     }
 
+    function resetHistoryPagination() {
+        oldestLoadedMessageId = null;
+        hasMoreHistory = false;
+        loadingOlderHistory = false;
+        lastSeenSeq = null;
+        syncInProgress = false;
+        pendingSyncMessages = [];
+    }
+
+    function noteSeenSeq(seq) {
+        if (seq !== null && seq !== undefined && (lastSeenSeq === null || seq > lastSeenSeq)) {
+            lastSeenSeq = seq;
+            if (currentChannelId) scheduleMarkRead(seq);
+        }
+    }
+
+    function scheduleMarkRead(seq) {
+        // Agrupar las marcas de lectura del canal activo en un 'mark_read' cada markReadDelay ms
+        if (pendingRead && pendingRead.channelId !== currentChannelId) flushMarkRead(); // Cambio de canal
+        pendingRead = { channelId: currentChannelId, seq: seq };
+        if (!markReadTimer) markReadTimer = setTimeout(flushMarkRead, markReadDelay);
+    }
+
+    function flushMarkRead() {
+        clearTimeout(markReadTimer);
+        markReadTimer = null;
+        if (!pendingRead) return;
+        const { channelId, seq } = pendingRead;
+        pendingRead = null;
+        if (seq <= (lastReadSent[channelId] || 0)) return;
+        lastReadSent[channelId] = seq;
+        socket.emit('mark_read', { channel_id: channelId, seq: seq });
+    }
+
+    function setUnreadBadge(channelId, count) {
+        unreadCounts[channelId] = count;
+        const notificationDot = document.getElementById(`notification-${channelId}`);
+        if (!notificationDot) return;
+        notificationDot.textContent = count > 0 ? count : '';
+        notificationDot.classList.toggle('d-none', !(count > 0));
+    }
+
+    function applySidebar(payload) {
+        // Sincroniza la lista de canales con el payload de /sidebar (o el incrustado en la página)
+        const channels = payload?.channels || [];
+        const listedIds = new Set(channels.map(channel => channel.id.toString()));
+        channelList?.querySelectorAll('.channel-item').forEach(item => {
+            if (listedIds.has(item.dataset.channelId)) return;
+            // Ya no es miembro (kick o salida mientras estaba desconectado)
+            delete unreadCounts[item.dataset.channelId];
+            item.remove();
+            if (item.dataset.channelId === currentChannelId) resetChatUI();
+        });
+        channels.forEach(channel => {
+            const idStr = channel.id.toString();
+            const item = channelList?.querySelector(`.channel-item[data-channel-id="${idStr}"]`) || addChannelToList(channel.id, channel.name);
+            if (!item) return;
+            item.dataset.requiresPassword = channel.is_protected ? 'true' : 'false';
+            item.dataset.banned = channel.is_banned ? 'true' : 'false';
+            item.classList.toggle('text-muted', !!channel.is_banned);
+            setUnreadBadge(idStr, idStr === currentChannelId || channel.is_banned ? 0 : channel.unread);
+        });
+        updateTotalUnreadTitle();
+    }
+
+    function refreshSidebar() {
+        fetch('/sidebar', { cache: 'no-store' })
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
+            .then(applySidebar)
+            .catch(error => console.error('Error refrescando la lista de canales:', error));
+    }
+
+    function requestChannelSync() {
+        // Pedir solo los mensajes posteriores al último 'seq' que tenemos
+        if (!currentChannelId || lastSeenSeq === null || syncInProgress) return;
+        syncInProgress = true;
+        console.log(`Hueco detectado en canal ${currentChannelId}, sincronizando desde seq ${lastSeenSeq}`);
+        socket.emit('request_history', { channel_id: currentChannelId, since_seq: lastSeenSeq });
+    }
+
+    function appendLiveMessage(data) {
+        // Añade un mensaje al final del canal activo (descartando duplicados ya mostrados)
+        if (!messageArea) return;
+        if (data.seq !== null && data.seq !== undefined && lastSeenSeq !== null && data.seq <= lastSeenSeq) return;
+        document.getElementById('chat-placeholder')?.remove();
+        messageArea.appendChild(createMessageElement(data));
+        noteSeenSeq(data.seq);
+    }
+
+    function requestOlderHistory() {
+        // Pedir la página anterior al mensaje más antiguo que tenemos
+        if (!currentChannelId || !hasMoreHistory || loadingOlderHistory || oldestLoadedMessageId === null) return;
+        loadingOlderHistory = true;
+        console.log(`Pidiendo historial anterior a ${oldestLoadedMessageId} en canal ${currentChannelId}`);
+        socket.emit('request_history', { channel_id: currentChannelId, before_id: oldestLoadedMessageId });
+    }
+
     function escapeHTML(str) {
         if (!str) return '';
         const div = document.createElement('div');
@@ -235,16 +353,34 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function updateTypingIndicator() {
         if (!typingIndicator) return;
-        if (!currentChannelId || !usersTyping[currentChannelId] || Object.keys(usersTyping[currentChannelId]).length === 0) {
-            typingIndicator.textContent = ''; return;
+        // Unir los snapshots de todos los procesos (descartando los caducados) y quitarme a mí
+        const typingUsernames = [];
+        let numTyping = 0;
+        const now = Date.now();
+        const sources = (currentChannelId && usersTyping[currentChannelId]) || {};
+        for (const [source, snapshot] of Object.entries(sources)) {
+            if (now - snapshot.receivedAt > typingSnapshotTtl) { delete sources[source]; continue; }
+            // Si mi nombre quedó fuera de 'users' el servidor me lo indica con 'self_included'
+            const selfIncluded = snapshot.selfIncluded || snapshot.users.includes(USERNAME_GLOBAL);
+            numTyping += snapshot.count - (selfIncluded ? 1 : 0);
+            snapshot.users.forEach(name => { if (name !== USERNAME_GLOBAL) typingUsernames.push(name); });
         }
-        const typingUsernames = Object.keys(usersTyping[currentChannelId]);
-        const numTyping = typingUsernames.length;
+        if (numTyping <= 0) { typingIndicator.textContent = ''; return; }
         if (numTyping === 1) { typingIndicator.textContent = `${escapeHTML(typingUsernames[0])} está escribiendo...`; }
         else if (numTyping === 2) { typingIndicator.textContent = `${escapeHTML(typingUsernames[0])} y ${escapeHTML(typingUsernames[1])} están escribiendo...`; }
         else { typingIndicator.textContent = `Varios usuarios están escribiendo...`; }
     }
 
+    function updateOnlineCount() {
+        const onlineCountBadge = document.getElementById('online-count');
+        if (!onlineCountBadge) return;
+        const members = currentChannelId && onlineMembers[currentChannelId];
+        if (!members) { onlineCountBadge.classList.add('d-none'); return; }
+        onlineCountBadge.textContent = `${members.size} en línea`;
+        onlineCountBadge.title = Array.from(members.values()).join(', ');
+        onlineCountBadge.classList.remove('d-none');
+    }
+
     function flashFeedback(message) {
         if(typingIndicator) {
             const originalText = typingIndicator.textContent;
@@ -284,12 +420,14 @@ document.addEventListener('DOMContentLoaded', () => {
         currentChannelId = null;
         currentChannelName = null;
         currentChannelIsWritable = false;
+        resetHistoryPagination();
         clearMessageArea();
         if(messageArea) messageArea.innerHTML = '<p ...>Selecciona un canal</p>';
         if(currentChannelNameHeader) currentChannelNameHeader.textContent = 'Selecciona un canal';
         disableChatInput(); // <-- Llama a la función que deshabilita todo
         leaveChannelButton?.classList.add('d-none');
         updateTypingIndicator();
+        updateOnlineCount();
         channelList?.querySelector('.active')?.classList.remove('active', 'bg-primary', 'text-white', 'rounded');
         document.title = originalTitle
          const activeChannel = channelList?.querySelector('.active');
@@ -324,6 +462,7 @@ document.addEventListener('DOMContentLoaded', () => {
             currentChannelId = channelIdStr;
             currentChannelName = channelName;
             currentChannelIsWritable = false;
+            resetHistoryPagination();
 
             channelList?.querySelector('.active')?.classList.remove('active', 'bg-primary', 'text-white', 'rounded');
             const channelItem = channelList?.querySelector(`.channel-item[data-channel-id="${channelId}"]`);
@@ -337,6 +476,7 @@ document.addEventListener('DOMContentLoaded', () => {
             leaveChannelButton?.classList.remove('d-none');
             if(typingIndicator) typingIndicator.textContent = '';
             usersTyping[currentChannelId] = usersTyping[currentChannelId] || {};
+            updateOnlineCount(); // Se completa al llegar 'presence_state'
 
             console.log(`UI actualizada para canal activo: ${channelName} (ID: ${channelId})`);
             socket.emit('request_history', { channel_id: currentChannelId });
@@ -350,12 +490,19 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // Si el mensaje es para el canal ACTIVO, simplemente añadirlo
         if (msgChannelId === currentChannelId) {
-            if (messageArea) {
-                document.getElementById('chat-placeholder')?.remove();
-                const messageElement = createMessageElement(data);
-                messageArea.appendChild(messageElement);
-                scrollToBottom();
+            const hasSeq = data.seq !== null && data.seq !== undefined;
+            if (hasSeq && syncInProgress) {
+                pendingSyncMessages.push(data); // Se aplicará cuando llegue 'channel_sync'
+                return;
+            }
+            if (hasSeq && lastSeenSeq !== null && data.seq > lastSeenSeq + 1) {
+                // Falta algún mensaje entre el último visto y este: pedir el hueco (incluye este mensaje)
+                pendingSyncMessages.push(data);
+                requestChannelSync();
+                return;
             }
+            appendLiveMessage(data);
+            scrollToBottom();
         }
         // Si el mensaje es para un canal INACTIVO
         else if (msgChannelId) {
@@ -381,41 +528,145 @@ document.addEventListener('DOMContentLoaded', () => {
     socket.on('channel_history', (data) => {
         // Solo mostrar historial si es para el canal activo
          if (data.channel_id?.toString() === currentChannelId) {
-            console.log(`Historial recibido para canal activo ${currentChannelId}: ${data.messages?.length} mensajes`);
-            if(messageArea){
-                clearMessageArea(); // Limpiar "Cargando..."
-                if (data.messages && data.messages.length > 0) {
-                    data.messages.forEach(messageData => {
-                        const messageElement = createMessageElement(messageData);
-                        messageArea.appendChild(messageElement);
-                    });
-                    scrollToBottom();
-                } else {
-                    messageArea.innerHTML = '<p class="text-muted text-center" id="chat-placeholder">No hay mensajes en este canal. ¡Sé el primero!</p>';
-                }
+            console.log(`Historial recibido para canal activo ${currentChannelId}: ${data.messages?.length} mensajes (has_more=${data.has_more})`);
+            if (!messageArea) return;
+            const messages = data.messages || [];
+
+            // --- Página ANTERIOR (scroll hacia arriba): insertar arriba manteniendo la posición ---
+            if (data.before_id !== null && data.before_id !== undefined) {
+                loadingOlderHistory = false;
+                if (data.before_id?.toString() !== oldestLoadedMessageId?.toString()) return; // Respuesta obsoleta
+                hasMoreHistory = !!data.has_more;
+                if (messages.length === 0) return;
+                const previousHeight = messageArea.scrollHeight;
+                const fragment = document.createDocumentFragment();
+                messages.forEach(messageData => fragment.appendChild(createMessageElement(messageData)));
+                messageArea.insertBefore(fragment, messageArea.firstChild);
+                oldestLoadedMessageId = messages[0].id;
+                // Compensar la altura añadida para que el usuario no "salte"
+                messageArea.scrollTop += messageArea.scrollHeight - previousHeight;
+                return;
+            }
+
+            // --- Página inicial (los N mensajes más recientes) ---
+            clearMessageArea(); // Limpiar "Cargando..."
+            hasMoreHistory = !!data.has_more;
+            loadingOlderHistory = false;
+            if (messages.length > 0) {
+                const fragment = document.createDocumentFragment();
+                messages.forEach(messageData => fragment.appendChild(createMessageElement(messageData)));
+                messageArea.appendChild(fragment);
+                oldestLoadedMessageId = messages[0].id;
+                noteSeenSeq(messages[messages.length - 1].seq);
+                scrollToBottom();
+            } else {
+                oldestLoadedMessageId = null;
+                messageArea.innerHTML = '<p class="text-muted text-center" id="chat-placeholder">No hay mensajes en este canal. ¡Sé el primero!</p>';
             }
          } else {
               console.log(`Historial recibido para canal INACTIVO (${data.channel_id}), ignorando.`);
          }
     });
 
-    socket.on('user_typing', (data) => {
-        if (data.channel_id?.toString() === currentChannelId && data.username !== USERNAME_GLOBAL) {
-            usersTyping[currentChannelId] = usersTyping[currentChannelId] || {};
-            usersTyping[currentChannelId][data.username] = true;
-            updateTypingIndicator();
+    socket.on('channel_sync', (data) => {
+        // Respuesta a join_channel/request_history con 'last_seq'/'since_seq': solo el hueco
+        if (data.channel_id?.toString() !== currentChannelId) return;
+        syncInProgress = false;
+        if (data.reset) {
+            // Demasiado atrás: recargar la página más reciente desde cero
+            console.log(`Canal ${currentChannelId}: demasiados mensajes perdidos, recargando historial.`);
+            resetHistoryPagination();
+            socket.emit('request_history', { channel_id: currentChannelId });
+            return;
         }
+        const queued = pendingSyncMessages;
+        pendingSyncMessages = [];
+        (data.messages || []).forEach(appendLiveMessage);
+        noteSeenSeq(data.last_seq); // Los seq borrados (limpieza) no deben contarse como hueco
+        queued.sort((a, b) => a.seq - b.seq).forEach(appendLiveMessage);
+        console.log(`Canal ${currentChannelId} sincronizado: ${data.messages?.length || 0} mensajes nuevos (seq ${lastSeenSeq}).`);
+        scrollToBottom();
     });
 
-    socket.on('user_stopped_typing', (data) => {
-        if (data.channel_id?.toString() === currentChannelId) {
-            if (usersTyping[currentChannelId]?.[data.username]) {
-                delete usersTyping[currentChannelId][data.username];
-                updateTypingIndicator();
-            }
+    socket.on('messages_expired', (data) => {
+        // El servidor borró mensajes que superaron la retención del canal: quitarlos sin recargar
+        if (data.channel_id?.toString() !== currentChannelId || !messageArea) return;
+        const expiredIds = new Set((data.message_ids || []).map(id => id.toString()));
+        messageArea.querySelectorAll('.message-row').forEach(row => {
+            if (expiredIds.has(row.dataset.messageId)) row.remove();
+        });
+        if (oldestLoadedMessageId !== null && expiredIds.has(oldestLoadedMessageId.toString())) {
+            // Se expiran los más antiguos primero: ya no queda historial anterior que pedir
+            const firstRow = Array.from(messageArea.querySelectorAll('.message-row'))
+                .find(row => row.dataset.messageId && row.dataset.messageId !== 'undefined'); // Los de sistema no tienen id
+            oldestLoadedMessageId = firstRow ? firstRow.dataset.messageId : null;
+            hasMoreHistory = false;
         }
     });
 
+    // Al RECONECTAR (no en la primera conexión) volver a la sala del canal activo pidiendo solo lo que falta
+    socket.on('connect', () => {
+        if (sidebarStale) {
+            sidebarStale = false;
+            refreshSidebar(); // No leídos de los mensajes que llegaron mientras no había conexión
+        }
+        if (!currentChannelId) return;
+        if (lastSeenSeq !== null) {
+            syncInProgress = true;
+            socket.emit('join_channel', { channel_id: currentChannelId, last_seq: lastSeenSeq });
+        } else {
+            socket.emit('join_channel', { channel_id: currentChannelId });
+            socket.emit('request_history', { channel_id: currentChannelId });
+        }
+    });
+
+    // Snapshot agregado de quién escribe en un canal (uno por proceso del servidor, ver app/typing_state.py)
+    socket.on('typing_state', (data) => {
+        const channelKey = data.channel_id?.toString();
+        if (!channelKey) return;
+        usersTyping[channelKey] = usersTyping[channelKey] || {};
+        if (data.count > 0) {
+            usersTyping[channelKey][data.source] = {
+                users: data.users || [], count: data.count, selfIncluded: !!data.self_included, receivedAt: Date.now()
+            };
+        } else {
+            delete usersTyping[channelKey][data.source];
+        }
+        if (channelKey === currentChannelId) updateTypingIndicator();
+    });
+    setInterval(updateTypingIndicator, 2000); // Quitar snapshots caducados aunque no lleguen eventos
+
+    // El servidor va a cerrar la conexión porque no dábamos abasto (ver app/backpressure.py).
+    // Socket.IO se reconecta solo y 'connect' pide el hueco con last_seq.
+    socket.on('resync', (data) => {
+        console.warn('Conexión demasiado lenta, resincronizando:', data.reason);
+        flashFeedback('Conexión lenta: resincronizando...');
+    });
+
+    // Evento rechazado por el límite de frecuencia o el modo lento del canal (ver app/rate_limit.py)
+    socket.on('rate_limited', (data) => {
+        console.warn(`Evento '${data.event}' limitado, reintentar en ${data.retry_after}s`);
+        if (data.event === 'request_history') loadingOlderHistory = false; // Permitir pedir la página de nuevo
+        flashFeedback(data.message);
+    });
+
+    // Lista completa de conectados al entrar en la sala de un canal
+    socket.on('presence_state', (data) => {
+        const channelKey = data.channel_id?.toString();
+        if (!channelKey) return;
+        onlineMembers[channelKey] = new Map((data.members || []).map(member => [member.id, member.username]));
+        if (channelKey === currentChannelId) updateOnlineCount();
+    });
+
+    // Cambios agrupados desde el último aviso (entradas y salidas de la sala, de todos los workers)
+    socket.on('presence_diff', (data) => {
+        const members = onlineMembers[data.channel_id?.toString()];
+        if (!members) return; // Aún sin 'presence_state' de ese canal
+        (data.joined || []).forEach(member => members.set(member.id, member.username));
+        (data.left || []).forEach(userId => members.delete(userId));
+        if (data.channel_id?.toString() === currentChannelId) updateOnlineCount();
+    });
+
     socket.on('channel_status', (data) => {
         // Solo actualizar si el status es para el canal actualmente activo en el cliente
         if (data.channel_id?.toString() === currentChannelId) {
@@ -591,6 +842,10 @@ document.addEventListener('DOMContentLoaded', () => {
             const requiresPassword = channelItem.dataset.requiresPassword === 'true';
 
             if (newChannelId === currentChannelId) return; // No hacer nada si ya está activo
+            if (channelItem.dataset.banned === 'true') {
+                flashFeedback(`Estás baneado en "${newChannelName}".`);
+                return;
+            }
 
             console.log(`Intentando cambiar a canal: ${newChannelName} (ID: ${newChannelId}), Protegido: ${requiresPassword}`);
 
@@ -598,6 +853,7 @@ document.addEventListener('DOMContentLoaded', () => {
             if (currentChannelId !== null) {
                 socket.emit('leave_channel', { channel_id: currentChannelId });
                 if(usersTyping[currentChannelId]) delete usersTyping[currentChannelId]; // Limpiar typing local
+                delete onlineMembers[currentChannelId]; // Ya no llegarán sus presence_diff
             }
 
             // Mostrar feedback inmediato y deshabilitar
@@ -653,6 +909,18 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     } else { console.error("#channel-list-column no encontrado"); }
 
+    // No leídos iniciales: vienen incrustados en la página (sin petición extra)
+    if (typeof SIDEBAR_INITIAL !== 'undefined') applySidebar(SIDEBAR_INITIAL);
+
+    // --- Listener Scroll del Área de Mensajes: cargar historial anterior al llegar arriba ---
+    if (messageArea) {
+        messageArea.addEventListener('scroll', () => {
+            if (messageArea.scrollTop <= historyScrollThreshold) {
+                requestOlderHistory();
+            }
+        });
+    }
+
     if (messageForm) {
         messageForm.addEventListener('submit', (event) => {
             event.preventDefault();
@@ -668,7 +936,10 @@ document.addEventListener('DOMContentLoaded', () => {
     if (messageInput) {
         messageInput.addEventListener('input', () => {
             if (!currentChannelId || !currentChannelIsWritable) return;
-            if (!isTyping) { socket.emit('typing_started', { channel_id: currentChannelId }); isTyping = true; }
+            // Avisar al empezar y renovar cada typingRenewInterval mientras se sigue escribiendo
+            if (!isTyping || Date.now() - lastTypingPing > typingRenewInterval) {
+                socket.emit('typing_started', { channel_id: currentChannelId }); isTyping = true; lastTypingPing = Date.now();
+            }
             clearTimeout(typingTimer);
             typingTimer = setTimeout(() => { if(isTyping) { socket.emit('typing_stopped', { channel_id: currentChannelId }); isTyping = false; } }, typingTimeout);
         });
@@ -859,8 +1130,24 @@ document.addEventListener('DOMContentLoaded', () => {
         console.log("!!! DEBUG loadStickers: Grid encontrado, poniendo 'Cargando...'");
         stickerGrid.innerHTML = '<span class="text-muted small">Cargando stickers...</span>';
         // ... (Resto de la función fetch sin cambios) ...
-        fetch('/get-approved-stickers')
-            .then(response => { /* ... */ return response.json(); })
+        // Manifiesto guardado en localStorage con su versión: si no cambió, el servidor responde 304 sin cuerpo
+        const cached = loadCachedStickerManifest();
+        fetch('/get-approved-stickers', {
+            cache: 'no-store', // La revalidación la hacemos nosotros con If-None-Match
+            headers: cached ? { 'If-None-Match': cached.etag } : {}
+        })
+            .then(response => {
+                if (response.status === 304 && cached) return cached.stickers;
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                const etag = response.headers.get('ETag');
+                return response.json().then(stickers => {
+                    if (etag) {
+                        try { localStorage.setItem(stickerManifestKey, JSON.stringify({ etag: etag, stickers: stickers })); }
+                        catch (e) { /* localStorage lleno o desactivado: solo se pierde la caché */ }
+                    }
+                    return stickers;
+                });
+            })
             .then(stickers => {
                 console.log("!!! DEBUG loadStickers: Fetch OK, mostrando stickers.");
                 stickerGrid.innerHTML = '';
@@ -869,14 +1156,27 @@ document.addEventListener('DOMContentLoaded', () => {
                         const stickerDiv = document.createElement('div');
                         stickerDiv.className = 'popover-sticker-item';
                         stickerDiv.dataset.stickerUrl = sticker.url;
-                        stickerDiv.innerHTML = `<img src="${escapeHTML(sticker.url)}" alt="Sticker ${sticker.id}" title="Sticker ${sticker.id}">`;
+                        // loading="lazy": solo se descargan las imágenes visibles del selector
+                        stickerDiv.innerHTML = `<img src="${escapeHTML(sticker.url)}" alt="Sticker ${sticker.id}" title="Sticker ${sticker.id}" loading="lazy" decoding="async">`;
                         stickerGrid.appendChild(stickerDiv);
                     });
                 } else {
                     stickerGrid.innerHTML = '<span class="text-muted small">No hay stickers.</span>';
                 }
             })
-            .catch(error => { /* ... */ });
+            .catch(error => {
+                console.error('Error cargando stickers:', error);
+                stickerGrid.innerHTML = '<span class="text-danger small">No se pudieron cargar los stickers.</span>';
+            });
+    }
+
+    function loadCachedStickerManifest() {
+        try {
+            const cached = JSON.parse(localStorage.getItem(stickerManifestKey));
+            return cached && cached.etag && Array.isArray(cached.stickers) ? cached : null;
+        } catch (e) {
+            return null;
+        }
     }
 
     // --- Función para Subir Archivo (AJAX) ---
@@ -0,0 +1,65 @@
+# app/stickers.py
+"""
+Manifiesto de stickers aprobados, precalculado y servido con ETag.
+
+chat.js pedía /get-approved-stickers cada vez que se abría el selector de stickers, y cada
+petición consultaba todos los stickers aprobados y construía su URL. Ahora la respuesta (JSON ya
+serializado) se construye una sola vez y solo se recalcula cuando cambia el conjunto:
+admin_approve_sticker, admin_delete_sticker y la subida directa de admin_manage_stickers llaman a
+invalidate() y avisan al resto de procesos por el bus ('stickers').
+
+La versión (ETag) es un hash del contenido: el cliente la guarda junto al manifiesto y la envía
+en If-None-Match; si no cambió recibe un 304 sin cuerpo.
+"""
+import hashlib
+import json
+import threading
+
+from flask import url_for
+
+from app import db
+from app.invalidation import invalidation_bus
+from app.models import Sticker
+
+
+class StickerManifest:
+
+    def __init__(self):
+        self._body = None # JSON ya serializado
+        self._etag = None
+        self._generation = 0 # Crece en cada invalidate(): un manifiesto construido antes no se guarda
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def get(self):
+        """(cuerpo JSON, etag) del manifiesto actual. Necesita contexto de petición (url_for)."""
+        with self._lock:
+            if self._body is not None:
+                return self._body, self._etag
+            generation = self._generation
+        rows = db.session.query(Sticker.id, Sticker.file_path)\
+                         .filter(Sticker.is_approved == True).order_by(Sticker.id).all()
+        # file_path es como 'uploads/stickers/filename.png'
+        body = json.dumps([{'id': sticker_id, 'url': url_for('static', filename=file_path)}
+                           for sticker_id, file_path in rows], separators=(',', ':'))
+        etag = hashlib.sha1(body.encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            if generation == self._generation:
+                self._body, self._etag = body, etag
+            self.builds += 1
+        return body, etag
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._body = self._etag = None
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {'version': self._etag, 'builds': self.builds}
+
+
+# Instancia global (una por proceso)
+sticker_manifest = StickerManifest()
+
+invalidation_bus.subscribe('stickers', sticker_manifest.invalidate)
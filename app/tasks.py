@@ -1,85 +1,78 @@
 # app/tasks.py
 from datetime import datetime, timedelta, timezone
 # QUITAR la importación de app y db de aquí
-from app.models import Message # Mantener esta
+from app.models import Channel, Message # Mantener esta
+from sqlalchemy import delete
 from urllib.parse import urlparse, unquote
 import os
+import time
+
+
+# Progreso/resultado de la última limpieza (se muestra en /admin/stats)
+last_sweep_stats = {}
+
+
+def channel_retention(app, retention_minutes):
+    """Ventana de retención de un canal (timedelta): la suya propia o MESSAGE_RETENTION_MINUTES."""
+    return timedelta(minutes=retention_minutes or app.config['MESSAGE_RETENTION_MINUTES'])
 
 
 def delete_old_messages():
     """
-    Tarea para eliminar mensajes con más de 3 horas de antigüedad
-    y los archivos de IMAGEN asociados (no stickers).
+    Tarea para eliminar los mensajes que han superado la retención de su canal
+    (Channel.retention_minutes o MESSAGE_RETENTION_MINUTES) y los archivos de IMAGEN asociados (no stickers).
+
+    La expiración normal la hace app/expiry.py mensaje a mensaje; esta limpieza completa queda
+    para ejecutarla a mano (Procfile 'worker') o como red de seguridad.
+
+    Se trabaja por tramos (RETENTION_SWEEP_CHUNK_SIZE mensajes) y canal a canal: de cada tramo solo
+    se leen las columnas id, message_type y body, se borran los archivos de imagen y las filas se
+    eliminan con un único DELETE ... WHERE id IN (...) y su propio commit. Así la memoria no depende
+    del número de mensajes caducados y cada transacción mantiene el bloqueo de escritura muy poco tiempo.
+
+    La tarea corre dentro del proceso web (scheduler): los archivos se borran en un pool acotado
+    de RETENTION_FILE_DELETE_WORKERS hilos nativos para no bloquear el hub de eventlet.
     """
     # Importar 'app' y 'db' AQUÍ DENTRO, cuando la función se ejecute
     from app import db, app
 
     # Necesitamos un contexto de aplicación para acceder a db y app.static_folder
     with app.app_context():
+        chunk_size = app.config['RETENTION_SWEEP_CHUNK_SIZE']
+        sweep_started = time.perf_counter()
+        last_sweep_stats.clear()
+        last_sweep_stats.update(started_at=datetime.now(timezone.utc).isoformat(), running=True,
+                                chunks=0, messages=0, files_deleted=0, files_failed=0)
+        count = 0
+        chunks = 0
+        deleted_files_count = 0
+        failed_deletions = []
         try:
-            three_hours_ago = datetime.now(timezone.utc) - timedelta(hours=3)
-            print(f"[{datetime.now(timezone.utc).isoformat()}] Ejecutando tarea: Eliminando mensajes y archivos de imagen anteriores a {three_hours_ago.isoformat()}...")
+            now = datetime.now(timezone.utc)
+            print(f"[{now.isoformat()}] Ejecutando tarea: Eliminando mensajes que superan la retención de su canal...")
 
-            messages_to_delete = Message.query.filter(Message.timestamp < three_hours_ago).all()
-            count = len(messages_to_delete)
-            deleted_files_count = 0
-            failed_deletions = []
+            for channel_id, retention_minutes in db.session.query(Channel.id, Channel.retention_minutes).all():
+                cutoff = now - channel_retention(app, retention_minutes)
+                while True:
+                    result = delete_expired_chunk(channel_id, cutoff, chunk_size)
+                    if result['messages'] == 0:
+                        break
+                    count += result['messages']
+                    chunks += 1
+                    deleted_files_count += result['files_deleted']
+                    failed_deletions.extend(result['failed_paths'])
+                    # Métricas de progreso por tramo
+                    print(f"  Tramo {chunks} (canal {channel_id}): {result['messages']} mensajes (total {count}), "
+                          f"archivos {result['files_deleted']} borrados / {result['files_missing']} no encontrados / "
+                          f"{len(result['failed_paths'])} con error en {result['files_seconds']:.3f}s, "
+                          f"BBDD {result['db_seconds']:.3f}s")
+                    last_sweep_stats.update(chunks=chunks, messages=count, files_deleted=deleted_files_count,
+                                            files_failed=len(failed_deletions))
+                    if result['messages'] < chunk_size:
+                        break # Último tramo de este canal
 
             if count > 0:
-                print(f"Encontrados {count} mensajes para eliminar.")
-                # --- Bucle para intentar borrar archivos ANTES de borrar de la DB ---
-                for msg in messages_to_delete:
-                    # Solo intentar borrar si es un mensaje de tipo 'image'
-                    if msg.message_type == 'image':
-                        try:
-                            # msg.body contiene la URL relativa, ej: /static/uploads/images/uuid.jpg
-                            url_path = urlparse(msg.body).path # Extrae la parte de la ruta
-
-                            # Quitar el prefijo '/static/' para obtener la ruta relativa al static folder
-                            # Usar unquote para manejar posibles caracteres especiales en nombres de archivo
-                            relative_path = unquote(url_path.removeprefix('/static/'))
-
-                            # Asegurarse que la ruta sea segura y esté dentro de la carpeta esperada
-                            # (Evitar ataques tipo Path Traversal)
-                            image_upload_folder = os.path.join('uploads', 'images') # Carpeta relativa esperada
-                            if relative_path.startswith(image_upload_folder):
-                                # Construir ruta absoluta del sistema de archivos
-                                fs_path = os.path.join(app.static_folder, relative_path)
-                                # Normalizar ruta por seguridad
-                                fs_path = os.path.normpath(fs_path)
-
-                                # Doble check para asegurar que estamos dentro de static_folder
-                                if fs_path.startswith(os.path.normpath(app.static_folder)) and os.path.exists(fs_path):
-                                    print(f"Intentando eliminar archivo de imagen: {fs_path}")
-                                    os.remove(fs_path)
-                                    deleted_files_count += 1
-                                    print(f"Archivo eliminado: {fs_path}")
-                                elif not os.path.exists(fs_path):
-                                     print(f"Archivo no encontrado (ya borrado?): {fs_path}")
-                                else:
-                                     print(f"WARN: Ruta calculada {fs_path} parece insegura o fuera de {app.static_folder}. No se elimina.")
-                                     failed_deletions.append(fs_path)
-
-                            else:
-                                 print(f"WARN: La ruta en msg {msg.id} ('{relative_path}') no empieza con '{image_upload_folder}'. No se elimina.")
-                                 # Podría ser una URL externa o un sticker guardado incorrectamente como imagen?
-
-                        except OSError as e:
-                             # Error al borrar archivo (permisos, etc.)
-                            print(f"Error al eliminar archivo {fs_path if 'fs_path' in locals() else msg.body}: {e}")
-                            failed_deletions.append(fs_path if 'fs_path' in locals() else msg.body)
-                        except Exception as e:
-                             # Otro error inesperado procesando el mensaje/ruta
-                            print(f"Error procesando archivo para msg {msg.id} ({msg.body}): {e}")
-                            failed_deletions.append(msg.body)
-
-                # --- Borrar TODOS los mensajes encontrados de la DB ---
-                # Se hace después de intentar borrar los archivos asociados
-                for msg in messages_to_delete:
-                    db.session.delete(msg)
-
-                db.session.commit()
-                print(f"Tarea completada: {count} mensajes antiguos eliminados de la DB.")
+                print(f"Tarea completada: {count} mensajes antiguos eliminados de la DB en {chunks} tramos.")
                 if deleted_files_count > 0:
                      print(f"Se eliminaron {deleted_files_count} archivos de imagen asociados.")
                 if failed_deletions:
@@ -90,5 +83,150 @@ def delete_old_messages():
                 print("Tarea completada: No se encontraron mensajes antiguos para eliminar.")
 
         except Exception as e:
-            db.session.rollback() # Rollback si falla la consulta o el commit de la DB
-            print(f"Error CRÍTICO en la tarea delete_old_messages (DB): {e}")
\ No newline at end of file
+            db.session.rollback() # Rollback del tramo en curso (los tramos anteriores ya están confirmados)
+            print(f"Error CRÍTICO en la tarea delete_old_messages (DB) tras {count} mensajes eliminados: {e}")
+            last_sweep_stats['error'] = str(e)
+        finally:
+            last_sweep_stats.update(running=False, seconds=round(time.perf_counter() - sweep_started, 3))
+
+
+def delete_expired_chunk(channel_id, cutoff, limit):
+    """
+    Borra como mucho 'limit' mensajes del canal anteriores a 'cutoff' (los más antiguos primero),
+    junto con sus archivos de imagen, en una sola transacción. Emite 'messages_expired' a la sala
+    para que los clientes los quiten de pantalla. Necesita contexto de aplicación.
+    Devuelve un dict con las métricas del tramo.
+    """
+    from app import db, app, socketio
+    from app.history import note_messages_expired
+
+    chunk = db.session.query(Message.id, Message.message_type, Message.body)\
+                      .filter(Message.channel_id == channel_id, Message.timestamp < cutoff)\
+                      .order_by(Message.timestamp, Message.id)\
+                      .limit(limit)\
+                      .all()
+    result = {'messages': len(chunk), 'files_deleted': 0, 'files_missing': 0, 'failed_paths': [],
+              'files_seconds': 0.0, 'db_seconds': 0.0}
+    if not chunk:
+        return result
+
+    # --- Borrar archivos de imagen del tramo ANTES de borrar sus filas (en el pool) ---
+    files_started = time.perf_counter()
+    paths = []
+    for msg in chunk:
+        # Solo intentar borrar si es un mensaje de tipo 'image'
+        if msg.message_type == 'image':
+            fs_path, failed_path = _resolve_image_path(app, msg.id, msg.body)
+            if fs_path:
+                paths.append(fs_path)
+            if failed_path:
+                result['failed_paths'].append(failed_path)
+    deleted, missing, failed = _remove_files_in_pool(paths, app.config['RETENTION_FILE_DELETE_WORKERS'])
+    for fs_path, error in failed:
+        print(f"Error al eliminar archivo {fs_path}: {error}")
+        result['failed_paths'].append(fs_path)
+    result.update(files_deleted=deleted, files_missing=missing, files_seconds=time.perf_counter() - files_started)
+
+    # --- Borrar las filas del tramo con una sola sentencia y confirmar ---
+    db_started = time.perf_counter()
+    chunk_ids = [msg.id for msg in chunk]
+    db.session.execute(
+        delete(Message).where(Message.id.in_(chunk_ids)).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    note_messages_expired(channel_id, chunk_ids) # Quitar solo esos del historial en memoria (aquí y en otros procesos)
+    result['db_seconds'] = time.perf_counter() - db_started
+
+    socketio.emit('messages_expired', {'channel_id': channel_id, 'message_ids': chunk_ids}, to=str(channel_id))
+    return result
+
+
+def _resolve_image_path(app, message_id, body):
+    """
+    Convierte la URL de un mensaje de imagen en la ruta absoluta del archivo, validando que esté
+    dentro de static/uploads/images. Devuelve (ruta, ruta_fallida): solo una de las dos es no-None,
+    o ambas None si no hay nada que borrar (ej: URL externa).
+    """
+    try:
+        # body contiene la URL relativa, ej: /static/uploads/images/uuid.jpg
+        url_path = urlparse(body).path # Extrae la parte de la ruta
+
+        # Quitar el prefijo '/static/' para obtener la ruta relativa al static folder
+        # Usar unquote para manejar posibles caracteres especiales en nombres de archivo
+        relative_path = unquote(url_path.removeprefix('/static/'))
+
+        # Asegurarse que la ruta sea segura y esté dentro de la carpeta esperada
+        # (Evitar ataques tipo Path Traversal)
+        image_upload_folder = os.path.join('uploads', 'images') # Carpeta relativa esperada
+        if not relative_path.startswith(image_upload_folder):
+            print(f"WARN: La ruta en msg {message_id} ('{relative_path}') no empieza con '{image_upload_folder}'. No se elimina.")
+            # Podría ser una URL externa o un sticker guardado incorrectamente como imagen?
+            return None, None
+
+        # Construir ruta absoluta del sistema de archivos y normalizarla por seguridad
+        fs_path = os.path.normpath(os.path.join(app.static_folder, relative_path))
+
+        # Doble check para asegurar que estamos dentro de static_folder
+        if not fs_path.startswith(os.path.normpath(app.static_folder)):
+            print(f"WARN: Ruta calculada {fs_path} parece insegura o fuera de {app.static_folder}. No se elimina.")
+            return None, fs_path
+        return fs_path, None
+
+    except Exception as e:
+        # Error inesperado procesando el mensaje/ruta
+        print(f"Error procesando archivo para msg {message_id} ({body}): {e}")
+        return None, body
+
+
+def _remove_files(paths):
+    """
+    Borra una lista de archivos. Se ejecuta en un hilo del pool (E/S bloqueante fuera del hub).
+    Devuelve (borrados, no_encontrados, fallidos) con fallidos = [(ruta, error), ...].
+    """
+    deleted, missing, failed = 0, 0, []
+    for fs_path in paths:
+        try:
+            os.remove(fs_path)
+            deleted += 1
+        except FileNotFoundError:
+            missing += 1 # Ya borrado
+        except OSError as e:
+            # Error al borrar archivo (permisos, etc.)
+            failed.append((fs_path, str(e)))
+    return deleted, missing, failed
+
+
+def _remove_files_in_pool(paths, workers):
+    """
+    Reparte 'paths' en 'workers' lotes y los borra en paralelo sin bloquear el servidor:
+    - Con eventlet parcheado (gunicorn --worker-class eventlet) cada lote va a eventlet.tpool
+      (hilos nativos), así el hub sigue atendiendo websockets mientras se hace la E/S.
+    - Sin eventlet (ej: 'flask run' o el proceso worker) se usa un ThreadPoolExecutor acotado.
+    """
+    if not paths:
+        return 0, 0, []
+    workers = max(1, min(workers, len(paths)))
+    batches = [paths[i::workers] for i in range(workers)]
+
+    if _eventlet_patched():
+        import eventlet
+        from eventlet import tpool
+        pool = eventlet.GreenPool(workers)
+        results = list(pool.imap(lambda batch: tpool.execute(_remove_files, batch), batches))
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_remove_files, batches))
+
+    deleted = sum(r[0] for r in results)
+    missing = sum(r[1] for r in results)
+    failed = [item for r in results for item in r[2]]
+    return deleted, missing, failed
+
+
+def _eventlet_patched():
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('thread')
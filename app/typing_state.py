@@ -0,0 +1,138 @@
+# app/typing_state.py
+"""
+Indicador de "está escribiendo" agregado por canal.
+
+Antes cada typing_started/typing_stopped se reenviaba a toda la sala (N personas escribiendo en
+una sala de M miembros = O(N·M) paquetes). Ahora los eventos solo actualizan el conjunto de
+personas escribiendo de cada canal (con caducidad) y una tarea en segundo plano emite, como mucho
+cada TYPING_FLUSH_INTERVAL_MS, UN 'typing_state' por canal y solo si el conjunto cambió:
+
+    {'channel_id': 5, 'source': '<proceso>', 'users': ['ana', 'luis'], 'count': 2}
+
+- 'users' lleva como mucho TYPING_MAX_NAMES nombres; 'count' es el total. Quien escribe pero se
+  queda fuera de 'users' no recibe el paquete de la sala sino una copia con 'self_included': true,
+  para que su cliente se descuente del total (el paquete de la sala se sigue codificando una vez).
+- Los clientes renuevan typing_started mientras siguen escribiendo; quien no lo hace en
+  TYPING_EXPIRY_SECONDS desaparece (ej: se desconectó sin enviar typing_stopped).
+- Con varios workers cada uno agrega a sus propios clientes: 'source' identifica el proceso y el
+  cliente une los conjuntos de todos. Los conjuntos no vacíos se reenvían cada
+  TYPING_KEEPALIVE_SECONDS para que el cliente descarte los de procesos que ya no existen.
+"""
+import threading
+import time
+
+from app import app, socketio
+from app.invalidation import invalidation_bus
+
+
+class TypingAggregator:
+
+    def __init__(self, flush_interval_ms, expiry_seconds, keepalive_seconds, max_names):
+        self.flush_interval = max(50, flush_interval_ms) / 1000.0
+        self.expiry = expiry_seconds
+        self.keepalive = keepalive_seconds
+        self.max_names = max_names
+        self._typists = {} # channel_id -> {username: [caduca_en (monotonic), último sid]}
+        self._dirty = set() # Canales cuyo conjunto cambió desde el último envío
+        self._last_sent = {} # channel_id -> (usernames ordenados, enviado_en)
+        self._lock = threading.Lock()
+        self._started = False
+        self.events = 0
+        self.snapshots = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run)
+
+    # --- Eventos de los clientes ---
+
+    def started(self, channel_id, username, sid):
+        self._ensure_started()
+        with self._lock:
+            self.events += 1
+            typists = self._typists.setdefault(channel_id, {})
+            if username not in typists:
+                self._dirty.add(channel_id)
+            typists[username] = [time.monotonic() + self.expiry, sid]
+
+    def stopped(self, channel_id, username):
+        with self._lock:
+            self.events += 1
+            typists = self._typists.get(channel_id)
+            if typists and typists.pop(username, None) is not None:
+                self._dirty.add(channel_id)
+                if not typists:
+                    del self._typists[channel_id]
+
+    # --- Envío de snapshots ---
+
+    def _collect(self):
+        """Caduca a quien dejó de renovar y devuelve [(channel_id, usernames, sids fuera de 'users')] a emitir."""
+        now = time.monotonic()
+        pending = []
+        with self._lock:
+            for channel_id, typists in list(self._typists.items()):
+                for username in [u for u, (expires, _) in typists.items() if expires <= now]:
+                    del typists[username]
+                    self._dirty.add(channel_id)
+                if not typists:
+                    del self._typists[channel_id]
+                else:
+                    last = self._last_sent.get(channel_id)
+                    if last is not None and now - last[1] >= self.keepalive:
+                        self._dirty.add(channel_id)
+            for channel_id in self._dirty:
+                usernames = sorted(self._typists.get(channel_id, ()))
+                last = self._last_sent.get(channel_id)
+                if last is not None and last[0] == usernames and now - last[1] < self.keepalive:
+                    continue # Mismo conjunto que el último enviado (ej: entró y salió en el mismo intervalo)
+                if not usernames and last is None:
+                    continue
+                typists = self._typists.get(channel_id, {})
+                hidden_sids = [typists[username][1] for username in usernames[self.max_names:]]
+                pending.append((channel_id, usernames, hidden_sids))
+                if usernames:
+                    self._last_sent[channel_id] = (usernames, now)
+                else:
+                    self._last_sent.pop(channel_id, None)
+            self._dirty.clear()
+        return pending
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                for channel_id, usernames, hidden_sids in self._collect():
+                    self.snapshots += 1
+                    state = {
+                        'channel_id': channel_id,
+                        'source': invalidation_bus.origin,
+                        'users': usernames[:self.max_names],
+                        'count': len(usernames),
+                    }
+                    socketio.emit('typing_state', state, to=str(channel_id), skip_sid=hidden_sids or None)
+                    for sid in hidden_sids:
+                        socketio.emit('typing_state', dict(state, self_included=True), to=sid)
+            except Exception as e: # El bucle nunca debe morir
+                print(f"[Typing] Error emitiendo estado de escritura: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._typists),
+                'typists': sum(len(t) for t in self._typists.values()),
+                'events': self.events,
+                'snapshots': self.snapshots,
+            }
+
+
+# Instancia global (una por proceso)
+typing_aggregator = TypingAggregator(
+    flush_interval_ms=app.config['TYPING_FLUSH_INTERVAL_MS'],
+    expiry_seconds=app.config['TYPING_EXPIRY_SECONDS'],
+    keepalive_seconds=app.config['TYPING_KEEPALIVE_SECONDS'],
+    max_names=app.config['TYPING_MAX_NAMES']
+)
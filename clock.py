@@ -0,0 +1,17 @@
+# clock.py
+# Proceso dedicado al scheduler (Procfile: 'clock'). Ejecuta las tareas programadas
+# para que los web workers puedan arrancar con SCHEDULER_ENABLED=false.
+import os
+os.environ['SCHEDULER_ENABLED'] = 'true' # Este proceso SIEMPRE arranca el scheduler
+os.environ.setdefault('SOCKETIO_WRITE_ONLY', 'true') # Solo publica emits en el broker (no tiene clientes)
+
+import time
+from app import app
+
+if __name__ == '__main__':
+    print("Proceso clock iniciado: el scheduler ejecutará las tareas si este proceso es el líder.")
+    try:
+        while True:
+            time.sleep(60) # El scheduler corre en segundo plano; solo mantenemos vivo el proceso
+    except (KeyboardInterrupt, SystemExit):
+        print("Proceso clock detenido.")
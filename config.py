@@ -1,4 +1,5 @@
 import os
+import tempfile
 basedir = os.path.abspath(os.path.dirname(__file__))
 # Importamos la función para cargar variables de entorno desde .env
 from dotenv import load_dotenv
@@ -37,5 +38,161 @@ class Config:
     # Tamaño máximo (opcional, ej: 16MB)
     MAX_CONTENT_LENGTH = 16 * 2000 * 2000
 
+    # --- Historial de Mensajes ---
+    # Número de mensajes por página al pedir historial (carga inicial y scroll hacia arriba).
+    HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', 50))
+    # Límite máximo que un cliente puede pedir en una sola página.
+    HISTORY_MAX_PAGE_SIZE = 200
+    # Consultas SQL esperadas como máximo por página de historial (las que la superan se registran, ver /admin/stats).
+    HISTORY_MAX_QUERIES_PER_PAGE = 2
+    # Buffer en memoria con los mensajes más recientes de cada canal (ya serializados).
+    # Sirve la primera página del historial sin tocar la BBDD.
+    HISTORY_BUFFER_PER_CHANNEL = int(os.environ.get('HISTORY_BUFFER_PER_CHANNEL', 200))
+    # Presupuesto global de memoria del buffer (bytes aprox.). Al superarlo se descartan los canales menos usados.
+    HISTORY_BUFFER_MAX_BYTES = int(os.environ.get('HISTORY_BUFFER_MAX_BYTES', 16 * 1024 * 1024))
+    # Sincronización al reconectar: si al cliente le faltan más mensajes que esto, se le pide
+    # que recargue el historial en lugar de enviarle el hueco completo.
+    HISTORY_SYNC_MAX_GAP = int(os.environ.get('HISTORY_SYNC_MAX_GAP', 200))
+    # Exportación del historial completo en streaming (?export=json|ndjson): filas leídas de la BBDD
+    # y escritas en la respuesta por lotes de este tamaño (la memoria no depende del tamaño del canal).
+    HISTORY_EXPORT_BATCH_SIZE = int(os.environ.get('HISTORY_EXPORT_BATCH_SIZE', 500))
+
+    # --- Retención y Expiración de Mensajes (app/expiry.py, app/tasks.py) ---
+    # Minutos que se conservan los mensajes si el canal no define su propia retención.
+    MESSAGE_RETENTION_MINUTES = int(os.environ.get('MESSAGE_RETENTION_MINUTES', 180))
+    # Cada cuántos segundos se revisa el heap de expiración (precisión de la expiración).
+    MESSAGE_EXPIRY_TICK_SECONDS = int(os.environ.get('MESSAGE_EXPIRY_TICK_SECONDS', 5))
+    # Máximo de mensajes que se borran de un canal en cada revisión (lotes pequeños y repartidos).
+    MESSAGE_EXPIRY_BATCH_SIZE = int(os.environ.get('MESSAGE_EXPIRY_BATCH_SIZE', 200))
+    # Cada cuántos segundos se recalcula el heap desde la BBDD (canales nuevos, mensajes de otros procesos).
+    MESSAGE_EXPIRY_REFRESH_SECONDS = int(os.environ.get('MESSAGE_EXPIRY_REFRESH_SECONDS', 60))
+    # Mensajes borrados por transacción: limita la memoria y el tiempo que se bloquea la BBDD.
+    RETENTION_SWEEP_CHUNK_SIZE = int(os.environ.get('RETENTION_SWEEP_CHUNK_SIZE', 1000))
+    # Hilos para borrar los archivos de imagen de cada tramo (eventlet.tpool o ThreadPoolExecutor).
+    RETENTION_FILE_DELETE_WORKERS = int(os.environ.get('RETENTION_FILE_DELETE_WORKERS', 4))
+
+    # --- Scheduler (tareas programadas) ---
+    # Poner a 'false' en los procesos que NO deben arrancar el scheduler (ej: web workers si existe 'clock').
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'True').lower() in ['true', '1', 't']
+    # Duración del lease del líder: si el líder muere, otro proceso toma el relevo pasado este tiempo.
+    SCHEDULER_LEASE_TTL_SECONDS = int(os.environ.get('SCHEDULER_LEASE_TTL_SECONDS', 60))
+
+    # --- Caché de Moderación (bans/mutes activos, ver app/moderation.py) ---
+    MODERATION_CACHE_MAX_USERS = int(os.environ.get('MODERATION_CACHE_MAX_USERS', 10000))
+    # Cada usuario se recarga de la BBDD como muy tarde tras este tiempo (cambios hechos desde otros procesos).
+    MODERATION_CACHE_TTL_SECONDS = int(os.environ.get('MODERATION_CACHE_TTL_SECONDS', 60))
+
+    # --- Barra lateral de canales (lista + no leídos por usuario, ver app/sidebar.py) ---
+    SIDEBAR_CACHE_MAX_USERS = int(os.environ.get('SIDEBAR_CACHE_MAX_USERS', 10000))
+
+    # --- Caché de Identidades (current_user, ver app/identity.py) ---
+    IDENTITY_CACHE_MAX_USERS = int(os.environ.get('IDENTITY_CACHE_MAX_USERS', 10000))
+    # Cada identidad se recarga de la BBDD como muy tarde tras este tiempo.
+    IDENTITY_CACHE_TTL_SECONDS = int(os.environ.get('IDENTITY_CACHE_TTL_SECONDS', 300))
+
+    # --- Escritura Agrupada de Mensajes (group commit, ver app/message_writer.py) ---
+    # Si está activo, los mensajes que llegan en pocos milisegundos se guardan con un solo INSERT + COMMIT.
+    MESSAGE_WRITE_BATCHING = os.environ.get('MESSAGE_WRITE_BATCHING', 'False').lower() in ['true', '1', 't']
+    # Máximo de mensajes por lote.
+    MESSAGE_WRITE_BATCH_MAX_SIZE = int(os.environ.get('MESSAGE_WRITE_BATCH_MAX_SIZE', 100))
+    # Espera máxima (ms) desde el primer mensaje pendiente antes de escribir el lote.
+    MESSAGE_WRITE_BATCH_MAX_DELAY_MS = int(os.environ.get('MESSAGE_WRITE_BATCH_MAX_DELAY_MS', 5))
+
+    # --- Panel de Administración (ver app/dashboard.py) ---
+    # Usuarios/canales por página en las tablas del panel.
+    ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+    # Los contadores del panel (usuarios, canales, pendientes) se recalculan como muy tarde tras este tiempo.
+    DASHBOARD_COUNTS_TTL_SECONDS = int(os.environ.get('DASHBOARD_COUNTS_TTL_SECONDS', 60))
+
+    # --- Ajustes Globales (tabla Setting, ver app/settings.py) ---
+    # Los ajustes se sirven desde memoria y se recargan como muy tarde tras este tiempo.
+    SETTINGS_CACHE_TTL_SECONDS = int(os.environ.get('SETTINGS_CACHE_TTL_SECONDS', 30))
+
+    # --- Socket.IO con varios workers/máquinas (broker, ver app/broker.py) ---
+    # Vacío = un solo proceso. 'unix:///ruta' (misma máquina, desarrollo/tests), 'redis://...', 'amqp://...', etc.
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+    # Canal del broker (permite que varias instancias de la app compartan el mismo Redis).
+    SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'appmensajeria')
+    # Procesos que solo emiten y no atienden clientes (clock, worker): publican sin escuchar el broker.
+    SOCKETIO_WRITE_ONLY = os.environ.get('SOCKETIO_WRITE_ONLY', 'False').lower() in ['true', '1', 't']
+    # Solo WebSocket (sin long-polling): no hacen falta sticky sessions con 'gunicorn -w N'.
+    SOCKETIO_WEBSOCKET_ONLY = os.environ.get('SOCKETIO_WEBSOCKET_ONLY', 'False').lower() in ['true', '1', 't']
+    # El balanceador fija cada cliente a un mismo worker (afinidad), así que el long-polling funciona con varios.
+    SOCKETIO_STICKY_SESSIONS = os.environ.get('SOCKETIO_STICKY_SESSIONS', 'False').lower() in ['true', '1', 't']
+    # Workers de gunicorn del proceso web (Procfile: -w ${WEB_WORKERS:-1}). No se usa WEB_CONCURRENCY
+    # porque algunas plataformas lo fijan solas. Con más de 1, la app no arranca sin broker, sin
+    # WebSocket-only/afinidad y sin un INVALIDATION_BACKEND compartido (ver app/__init__.py).
+    WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 1))
+
+    # --- Indicador de Escritura (ver app/typing_state.py) ---
+    # Como mucho un 'typing_state' por canal en cada intervalo (y solo si cambió quién escribe).
+    TYPING_FLUSH_INTERVAL_MS = int(os.environ.get('TYPING_FLUSH_INTERVAL_MS', 300))
+    # Quien no renueva typing_started en este tiempo deja de aparecer como escribiendo.
+    TYPING_EXPIRY_SECONDS = int(os.environ.get('TYPING_EXPIRY_SECONDS', 6))
+    # Reenvío periódico de los conjuntos no vacíos (el cliente descarta los que no se renuevan).
+    TYPING_KEEPALIVE_SECONDS = int(os.environ.get('TYPING_KEEPALIVE_SECONDS', 5))
+    # Nombres como mucho en cada snapshot (el resto solo cuenta en 'count').
+    TYPING_MAX_NAMES = 3
+
+    # --- Presencia por canal (ver app/presence.py) ---
+    # Las entradas/salidas de las salas se escriben en ChannelPresence y se anuncian ('presence_diff') en lote cada intervalo.
+    PRESENCE_FLUSH_INTERVAL_MS = int(os.environ.get('PRESENCE_FLUSH_INTERVAL_MS', 1000))
+    # Cada cuánto renueva cada proceso last_seen de sus conexiones.
+    PRESENCE_HEARTBEAT_SECONDS = int(os.environ.get('PRESENCE_HEARTBEAT_SECONDS', 20))
+    # Filas sin renovar en este tiempo (proceso caído) dejan de contar y se borran.
+    PRESENCE_TIMEOUT_SECONDS = int(os.environ.get('PRESENCE_TIMEOUT_SECONDS', 60))
+
+    # --- Avisos de altas/bajas de miembros (ver app/membership_notices.py) ---
+    # Como mucho un aviso "X se ha unido." por canal en cada intervalo.
+    MEMBERSHIP_NOTICE_WINDOW_MS = int(os.environ.get('MEMBERSHIP_NOTICE_WINDOW_MS', 2000))
+    # Hasta este número de usuarios se nombran; con más solo se indica cuántos.
+    MEMBERSHIP_NOTICE_MAX_NAMES = 3
+    # Salas con al menos estas conexiones: un aviso (solo el número) cada MEMBERSHIP_NOTICE_BUSY_INTERVAL_SECONDS.
+    MEMBERSHIP_NOTICE_BUSY_ROOM = int(os.environ.get('MEMBERSHIP_NOTICE_BUSY_ROOM', 100))
+    MEMBERSHIP_NOTICE_BUSY_INTERVAL_SECONDS = int(os.environ.get('MEMBERSHIP_NOTICE_BUSY_INTERVAL_SECONDS', 60))
+
+    # --- Límite de frecuencia de eventos Socket.IO (token bucket, ver app/rate_limit.py) ---
+    # evento -> (fichas por segundo, ráfaga máxima) por usuario. El modo lento se configura por canal.
+    RATE_LIMITS = {
+        'send_message': (2, 10),
+        'typing_started': (1, 5),
+        'join_channel': (2, 10),
+        'find_channel_info': (0.5, 5),
+        'attempt_join': (0.5, 5),
+        'join_channel_with_password': (0.2, 5), # También frena probar contraseñas a ciegas
+        'request_history': (2, 10),
+        'mark_read': (1, 5),
+    }
+    # Máximo de cubos (usuario, evento) en memoria; al llegar se olvidan los de usuarios inactivos.
+    RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+
+    # --- Contrapresión con clientes lentos (ver app/backpressure.py) ---
+    # Pendientes de escribir por conexión: al superar cualquiera se cierra con 'resync' y el cliente se resincroniza.
+    OUTBOUND_QUEUE_MAX_MESSAGES = int(os.environ.get('OUTBOUND_QUEUE_MAX_MESSAGES', 1000))
+    OUTBOUND_QUEUE_MAX_BYTES = int(os.environ.get('OUTBOUND_QUEUE_MAX_BYTES', 4 * 1024 * 1024))
+    # A partir de esta fracción de los límites se descartan los eventos prescindibles.
+    OUTBOUND_DROPPABLE_RATIO = 0.25
+    OUTBOUND_DROPPABLE_EVENTS = ('typing_state', 'presence_diff')
+
+    # --- Archivos estáticos (WhiteNoise + 'flask build-assets', ver app/assets.py) ---
+    # Directorios de app/static que se versionan (nombre.<hash>.ext) y se precomprimen (.gz y, si hay brotli, .br).
+    ASSET_DIRS = ('css', 'js')
+    # Manifiesto 'original -> versionado' que genera el build; sin él se sirven los nombres originales.
+    ASSETS_MANIFEST = os.path.join(basedir, 'app', 'static', 'assets-manifest.json')
+    # Caché de los estáticos sin versionar (stickers de ejemplo, o css/js si no se ejecutó el build).
+    STATIC_MAX_AGE_SECONDS = int(os.environ.get('STATIC_MAX_AGE_SECONDS', 3600))
+    # Desarrollo: ignorar el manifiesto y que WhiteNoise vuelva a mirar el disco en cada petición.
+    # Se lee al importar la app (antes que app.debug, que run.py activa después); run.py lo enciende.
+    ASSETS_AUTOREFRESH = os.environ.get('ASSETS_AUTOREFRESH', 'False').lower() in ['true', '1', 't']
+
+    # --- Bus de Invalidación entre procesos (ver app/invalidation.py) ---
+    # 'local' (un solo proceso), 'unix' (varios procesos en la misma máquina: desarrollo/tests)
+    # o 'postgres' (LISTEN/NOTIFY, requiere DATABASE_URL de PostgreSQL).
+    INVALIDATION_BACKEND = os.environ.get('INVALIDATION_BACKEND', 'local').lower()
+    # Directorio de los sockets del backend 'unix' (uno por proceso).
+    INVALIDATION_SOCKET_DIR = os.environ.get('INVALIDATION_SOCKET_DIR') or os.path.join(tempfile.gettempdir(), 'appmensajeria-invalidation')
+    # Canal de LISTEN/NOTIFY del backend 'postgres'.
+    INVALIDATION_PG_CHANNEL = os.environ.get('INVALIDATION_PG_CHANNEL', 'appmensajeria_invalidation')
+
     # Configuración específica para el modo Mantenimiento (ejemplo)
     # SITE_CLOSED = os.environ.get('SITE_CLOSED', 'False').lower() in ['true', '1', 't']
\ No newline at end of file
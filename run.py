@@ -1,5 +1,11 @@
 # run.py
 
+import os
+
+# Servidor de desarrollo: estáticos sin versionar y recargados del disco (ver app/assets.py).
+# Tiene que estar antes de importar la app, que monta WhiteNoise al importarse.
+os.environ.setdefault('ASSETS_AUTOREFRESH', 'True')
+
 # Importar el MÓDULO 'app' y la INSTANCIA 'app' con un alias si quieres
 from app import app as flask_app, socketio, db # Renombramos la instancia importada
 import app.models